@@ -0,0 +1,172 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Dict, Optional, Hashable
+from collections import OrderedDict
+import asyncio
+import json
+import time
+import logging
+import tornado.ioloop
+import tornado.websocket
+
+if TYPE_CHECKING:
+    from .server import Socket
+
+log = logging.getLogger(__name__)
+
+
+class BroadcastStats:
+    """
+    Counters of what happened to websocket messages
+    """
+    def __init__(self):
+        # Messages written to sockets
+        self.sent = 0
+        # Messages discarded because a client queue was full
+        self.dropped = 0
+        # Messages replaced by a more recent one with the same key
+        self.coalesced = 0
+        # Clients disconnected because they stopped responding
+        self.pruned = 0
+
+
+class ClientQueue:
+    """
+    Bounded queue of messages waiting to be sent to a websocket client.
+
+    Messages are written one at a time, waiting for each write to complete, so
+    that a slow client accumulates messages here, where they can be coalesced
+    or dropped, instead of in tornado's write buffers
+    """
+    def __init__(self, broadcaster: "Broadcaster", socket: Socket):
+        self.broadcaster = broadcaster
+        self.socket = socket
+        self.stats = broadcaster.stats
+        # Pending messages by coalescing key
+        self.pending: Dict[Hashable, str] = OrderedDict()
+        # Sequence number used as key for messages that cannot be coalesced
+        self.seq = 0
+        self.last_pong = time.monotonic()
+        self.wakeup = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def put(self, payload: str, key: Optional[Hashable] = None):
+        """
+        Enqueue a message.
+
+        If key is given, it replaces a pending message with the same key
+        """
+        if key is None:
+            key = ("seq", self.seq)
+            self.seq += 1
+        elif self.pending.pop(key, None) is not None:
+            self.stats.coalesced += 1
+        self.pending[key] = payload
+        while len(self.pending) > self.broadcaster.queue_size:
+            self.pending.popitem(last=False)
+            self.stats.dropped += 1
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            await self.wakeup.wait()
+            self.wakeup.clear()
+            while self.pending:
+                key, payload = self.pending.popitem(last=False)
+                try:
+                    done, pending = await asyncio.wait(
+                            [self.socket.write_message(payload)], timeout=self.broadcaster.write_timeout)
+                except tornado.websocket.WebSocketClosedError:
+                    return
+                if pending:
+                    log.info("Websocket client stalled on write: disconnecting it")
+                    self.stats.pruned += 1
+                    self.socket.close()
+                    return
+                if done.pop().exception() is not None:
+                    return
+                self.stats.sent += 1
+
+    def close(self):
+        self.task.cancel()
+
+
+class Broadcaster:
+    """
+    Send messages to websocket clients, with per-client bounded queues and
+    liveness checks
+    """
+    # Events for which only the latest message matters
+    COALESCE_EVENTS = ("reload", "uploaded_media_changed")
+
+    def __init__(self, queue_size: int = 64, write_timeout: float = 30, ping_interval: float = 20):
+        """
+        :arg queue_size: maximum number of messages queued for each client
+        :arg write_timeout: disconnect clients whose write does not complete
+                            in this number of seconds
+        :arg ping_interval: seconds between pings. Clients that do not reply
+                            within two ping intervals are disconnected
+        """
+        self.queue_size = queue_size
+        self.write_timeout = write_timeout
+        self.ping_interval = ping_interval
+        self.clients: Dict[Socket, ClientQueue] = {}
+        self.stats = BroadcastStats()
+        self.ping_task: Optional[tornado.ioloop.PeriodicCallback] = None
+
+    def start(self):
+        self.ping_task = tornado.ioloop.PeriodicCallback(self.check_liveness, self.ping_interval * 1000)
+        self.ping_task.start()
+
+    def add(self, socket: Socket):
+        self.clients[socket] = ClientQueue(self, socket)
+
+    def remove(self, socket: Socket):
+        client = self.clients.pop(socket, None)
+        if client is not None:
+            client.close()
+
+    def on_pong(self, socket: Socket):
+        client = self.clients.get(socket)
+        if client is not None:
+            client.last_pong = time.monotonic()
+
+    def check_liveness(self):
+        """
+        Disconnect clients that stopped answering pings, and ping the others
+        """
+        threshold = time.monotonic() - 2 * self.ping_interval
+        for socket, client in list(self.clients.items()):
+            if client.last_pong < threshold:
+                log.info("Websocket client not answering pings: disconnecting it")
+                self.stats.pruned += 1
+                self.remove(socket)
+                socket.close()
+                continue
+            try:
+                socket.ping(b"")
+            except tornado.websocket.WebSocketClosedError:
+                self.remove(socket)
+
+    def get_key(self, data: dict) -> Optional[Hashable]:
+        event = data.get("event")
+        if event in self.COALESCE_EVENTS:
+            return event
+        return None
+
+    def send(self, socket: Socket, data: dict):
+        """
+        Send a message to one client
+        """
+        client = self.clients.get(socket)
+        if client is None:
+            return
+        client.put(json.dumps(data), self.get_key(data))
+
+    def broadcast(self, data: dict):
+        """
+        Send a message to all clients
+        """
+        payload = json.dumps(data)
+        key = self.get_key(data)
+        for client in self.clients.values():
+            client.put(payload, key)
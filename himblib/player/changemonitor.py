@@ -1,31 +1,56 @@
 from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, Optional
 import asyncio
 import logging
 import os
 import pyinotify
+from .mediadir import TYPES
+
+if TYPE_CHECKING:
+    from .commands import CommandBus
 
 log = logging.getLogger(__name__)
 
 
 class ChangeMonitor:
     """
-    Trigger an event when a file is removed, then recreate the file
+    Trigger an event when a file is removed, then recreate the file.
+
+    In auto mode, also trigger an event when new media files have been written
+    to the media directory, once writes have stopped for a while and file
+    sizes are stable.
     """
-    def __init__(self, queue: asyncio.Queue, media_dir: str, monitor_file_name: str = "remove-when-done"):
+    MASK = pyinotify.IN_DELETE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+
+    # Interval between checks that file sizes are stable, in seconds
+    STABILITY_INTERVAL = 2
+
+    def __init__(self, commands: CommandBus, media_dir: str, monitor_file_name: str = "remove-when-done",
+                 get_auto_delay: Optional[Callable[[], int]] = None):
         """
-        :arg queue: queue where we send notifications
+        :arg commands: command bus where we send notifications
         :arg media_dir: directory where we manage the monitor file
         :arg monitor_file_name: name to use for the monitor file
+        :arg get_auto_delay: function returning how many seconds without
+                             changes to wait before triggering an event, or
+                             0 to only trigger when the monitor file is
+                             removed
         """
-        self.queue = queue
+        self.commands = commands
         self.media_dir = os.path.abspath(media_dir)
         self.monitor_file_name = monitor_file_name
         self.monitor_file = os.path.join(self.media_dir, self.monitor_file_name)
+        self.get_auto_delay = get_auto_delay
+        self.loop = asyncio.get_event_loop()
+        # Quiescence timer for auto mode
+        self.timer: Optional[asyncio.TimerHandle] = None
+        # File sizes seen at the last check for stability
+        self.sizes: Optional[Dict[str, int]] = None
 
         # Set up pyinotify.
         # See https://stackoverflow.com/questions/26414052/watch-for-a-file-with-asyncio
         self.watch_manager = pyinotify.WatchManager()
-        self.watch = self.watch_manager.add_watch(self.media_dir, pyinotify.IN_DELETE)
+        self.watch = self.watch_manager.add_watch(self.media_dir, self.MASK)
         self.notifier = pyinotify.AsyncioNotifier(
                 self.watch_manager, asyncio.get_event_loop(), default_proc_fun=self.on_event)
 
@@ -49,16 +74,69 @@ class ChangeMonitor:
 
         # Filter out spurious events
         if event.path != self.media_dir:
-            log.warn("%s: event %r received for a directory we were not monitoring", event.path, event)
+            log.warning("%s: event %r received for a directory we were not monitoring", event.path, event)
+            return
+
+        if event.name == self.monitor_file_name:
+            if not event.mask & pyinotify.IN_DELETE:
+                return
+
+            # Queueing commands does not block. This is handy because
+            # pyinotify does not seem to support async callbacks
+            self.cancel_timer()
+            self.commands.put("rescan", "remove-when-done", user=True)
+
+            # Recreate the monitor file, to be ready for the next notification
+            self.create_monitor_file()
             return
 
-        if event.name != self.monitor_file_name:
+        if event.dir or event.name.startswith("."):
             return
 
-        # We can shamelessly use put_nowait, since the queue has no size bound.
-        # This is handy because pyinotify does not seem to support async
-        # callbacks
-        self.queue.put_nowait("rescan")
+        delay = self.get_auto_delay() if self.get_auto_delay is not None else 0
+        if delay <= 0:
+            return
 
-        # Recreate the monitor file, to be ready for the next notification
-        self.create_monitor_file()
+        # Restart the quiescence timer at each change
+        self.cancel_timer()
+        self.sizes = None
+        self.timer = self.loop.call_later(delay, self.check_quiet)
+
+    def cancel_timer(self):
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+    def get_sizes(self) -> Dict[str, int]:
+        """
+        Return the sizes of the media files waiting to be activated
+        """
+        res = {}
+        for de in os.scandir(self.media_dir):
+            if de.name.startswith(".") or de.name == self.monitor_file_name or not de.is_file():
+                continue
+            st = de.stat()
+            if TYPES.get(de.path, st) is None:
+                continue
+            res[de.name] = st.st_size
+        return res
+
+    def check_quiet(self):
+        """
+        Trigger a rescan if there are new media files and their sizes did not
+        change since the last check
+        """
+        self.timer = None
+        sizes = self.get_sizes()
+        if not sizes:
+            # Nothing to activate, for example after media has been moved
+            # away by the player itself
+            self.sizes = None
+            return
+        if sizes != self.sizes:
+            self.sizes = sizes
+            self.timer = self.loop.call_later(self.STABILITY_INTERVAL, self.check_quiet)
+            return
+        log.info("%s: media files stable, rescanning", self.media_dir)
+        self.sizes = None
+        self.commands.put("rescan", "auto activate")
@@ -0,0 +1,121 @@
+from __future__ import annotations
+from typing import Dict, Optional
+from collections import OrderedDict
+import asyncio
+import time
+import logging
+from . import metrics
+
+log = logging.getLogger(__name__)
+
+
+class QueuedCommand:
+    """
+    A request to the player main loop
+    """
+    def __init__(self, name: str, source: str, delay: float = 0):
+        self.name = name
+        # What sent the command, for logging and metrics
+        self.source = source
+        # When the command was queued, as time.monotonic()
+        self.queued = time.monotonic()
+        # When the command can be returned, as time.monotonic()
+        self.not_before = self.queued + delay
+
+    def __str__(self):
+        return f"{self.name} from {self.source}"
+
+
+class CommandBus:
+    """
+    Queue of commands for the player main loop.
+
+    Commands that restart the presentation are coalesced while they wait,
+    since one restart serves them all, and are not returned more often than
+    every min_restart_interval seconds. quit is returned before anything
+    else.
+
+    Commands can be queued with a delay, and are held until it expires. A
+    delay, like the backoff after a player crash, is not shortened by commands
+    coalesced into it, unless they are explicit requests from a user.
+    """
+    # Commands that cause a new presentation to be started
+    RESTART_COMMANDS = ("rescan", "player_exited")
+
+    def __init__(self, min_restart_interval: float = 2):
+        self.min_restart_interval = min_restart_interval
+        # Pending commands, at most one per kind, in arrival order
+        self.pending: Dict[str, QueuedCommand] = OrderedDict()
+        self.changed = asyncio.Event()
+        # Set when quit is requested, to interrupt long waits outside get()
+        self.quit_requested = asyncio.Event()
+        # When the last restart command was returned
+        self.last_restart: Optional[float] = None
+
+    def key(self, name: str) -> str:
+        if name in self.RESTART_COMMANDS:
+            return "restart"
+        return name
+
+    def put(self, name: str, source: str, delay: float = 0, user: bool = False):
+        """
+        Queue a command, to be returned not earlier than delay seconds from
+        now.
+
+        :arg user: True if the command was explicitly requested by a user, and
+                   should not wait for the delay of a pending command
+        """
+        metrics.COMMANDS.inc(command=name, source=source)
+        key = self.key(name)
+        cmd = QueuedCommand(name, source, delay)
+        pending = self.pending.get(key)
+        if pending is not None:
+            # Keep the older command, so its wait time is measured from the
+            # first request. Only a user request cuts its delay short
+            log.debug("coalescing %s into %s", cmd, pending)
+            metrics.COMMANDS_COALESCED.inc(command=name)
+            if user:
+                pending.not_before = min(pending.not_before, cmd.not_before)
+            else:
+                pending.not_before = max(pending.not_before, cmd.not_before)
+        else:
+            self.pending[key] = cmd
+        if key == "quit":
+            self.quit_requested.set()
+        self.changed.set()
+
+    def pop(self, key: str) -> QueuedCommand:
+        cmd = self.pending.pop(key)
+        metrics.COMMAND_WAIT_SECONDS.observe(time.monotonic() - cmd.queued, command=cmd.name)
+        return cmd
+
+    async def get(self) -> QueuedCommand:
+        """
+        Wait for the next command
+        """
+        while True:
+            if "quit" in self.pending:
+                return self.pop("quit")
+
+            # Return the first command that is ready, or wait until the
+            # earliest one will be
+            now = time.monotonic()
+            delay = None
+            for key, cmd in self.pending.items():
+                ready = cmd.not_before
+                if key == "restart" and self.last_restart is not None:
+                    ready = max(ready, self.last_restart + self.min_restart_interval)
+                if ready <= now:
+                    if key == "restart":
+                        self.last_restart = now
+                    return self.pop(key)
+                if delay is None or ready - now < delay:
+                    delay = ready - now
+            if delay is not None:
+                log.info("delaying pending commands by %.1fs", delay)
+
+            self.changed.clear()
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,95 @@
+from __future__ import annotations
+from typing import Dict, Optional, Tuple
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def file_sha256(pathname: str, bufsize: int = 1024 * 1024) -> str:
+    """
+    Compute the sha256 hexdigest of the contents of a file
+    """
+    hash = hashlib.sha256()
+    with open(pathname, "rb") as fd:
+        while True:
+            buf = fd.read(bufsize)
+            if not buf:
+                break
+            hash.update(buf)
+    return hash.hexdigest()
+
+
+class HashCache:
+    """
+    Cache of sha256 hashes of media files.
+
+    Files are identified by name, size and modification time, so that a hash
+    stays valid when a file is moved from the upload directory to the current
+    media directory.
+    """
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.hashes: Dict[Tuple[str, int, int], str] = OrderedDict()
+        # Hashes being computed
+        self.pending: Dict[Tuple[str, int, int], asyncio.Future] = {}
+
+    def get_key(self, pathname: str, st: os.stat_result) -> Tuple[str, int, int]:
+        return (os.path.basename(pathname), st.st_size, st.st_mtime_ns)
+
+    def get_cached(self, pathname: str, st: os.stat_result) -> Optional[str]:
+        """
+        Return the hash of a file if it is known, else None
+        """
+        key = self.get_key(pathname, st)
+        res = self.hashes.get(key)
+        if res is not None:
+            self.hashes.move_to_end(key)
+        return res
+
+    def set(self, pathname: str, st: os.stat_result, sha256: str):
+        """
+        Record the hash of a file computed elsewhere
+        """
+        self.hashes[self.get_key(pathname, st)] = sha256
+        while len(self.hashes) > self.max_entries:
+            self.hashes.popitem(last=False)
+
+    async def get(self, pathname: str, st: os.stat_result) -> str:
+        """
+        Return the hash of a file, computing it in a worker thread if needed
+        """
+        res = self.get_cached(pathname, st)
+        if res is not None:
+            return res
+
+        key = self.get_key(pathname, st)
+        pending = self.pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        loop = asyncio.get_event_loop()
+        future = self.pending[key] = loop.run_in_executor(None, file_sha256, pathname)
+        try:
+            res = await future
+        finally:
+            del self.pending[key]
+        self.set(pathname, st, res)
+        return res
+
+    def prefetch(self, pathname: str, st: os.stat_result):
+        """
+        Start computing the hash of a file in the background, if not known
+        """
+        key = self.get_key(pathname, st)
+        if key in self.hashes or key in self.pending:
+            return
+        task = asyncio.ensure_future(self.get(pathname, st))
+        task.add_done_callback(self._log_failure)
+
+    def _log_failure(self, task: asyncio.Future):
+        if not task.cancelled() and task.exception() is not None:
+            log.warning("cannot hash file: %s", task.exception())
@@ -1,23 +1,142 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from collections import OrderedDict
 import os
 import mimetypes
-import shutil
 import logging
-from . import presentation
+from . import presentation, metrics
+from .scanindex import ScanIndex
 
 if TYPE_CHECKING:
     from ..settings import PlayerSettings
+    from .store import MediaStore, Generation
 
 log = logging.getLogger(__name__)
 
 
+def media_type(fn: str) -> Optional[str]:
+    """
+    Return the kind of presentation that can play a file: one of "pdf",
+    "image", "video", "odp", or None if the file is not supported.
+
+    This only looks at the file extension.
+    """
+    base, ext = os.path.splitext(fn)
+    mimetype = mimetypes.types_map.get(ext.lower())
+    if mimetype is None:
+        return None
+    if mimetype == "application/pdf":
+        return "pdf"
+    elif mimetype.startswith("image/"):
+        return "image"
+    elif mimetype.startswith("video/"):
+        return "video"
+    elif mimetype == "application/vnd.oasis.opendocument.presentation":
+        return "odp"
+    else:
+        return None
+
+
+# ISO base media brands used by still images rather than videos
+IMAGE_BRANDS = (b"heic", b"heix", b"mif1", b"msf1", b"avif")
+
+ODP_MIMETYPE = b"application/vnd.oasis.opendocument.presentation"
+
+
+def sniff_media_type(head: bytes) -> Optional[str]:
+    """
+    Return the media type of a file given the first few KB of its contents,
+    or None if it is not recognised
+    """
+    if head.startswith(b"\xff\xd8\xff"):
+        return "image"
+    elif head.startswith(b"\x89PNG\r\n\x1a\n"):
+        return "image"
+    elif head.startswith((b"GIF87a", b"GIF89a")):
+        return "image"
+    elif head.startswith(b"RIFF") and head[8:12] == b"WEBP":
+        return "image"
+    elif head.startswith(b"RIFF") and head[8:12] == b"AVI ":
+        return "video"
+    elif b"%PDF-" in head[:1024]:
+        # PDF allows garbage before the header
+        return "pdf"
+    elif head.startswith(b"PK\x03\x04"):
+        # OpenDocument files start with an uncompressed mimetype member
+        if head[30:38] == b"mimetype" and head[38:38 + len(ODP_MIMETYPE)] == ODP_MIMETYPE:
+            return "odp"
+        return None
+    elif head[4:8] == b"ftyp":
+        if head[8:12] in IMAGE_BRANDS:
+            return "image"
+        return "video"
+    elif head.startswith(b"\x1a\x45\xdf\xa3"):
+        # Matroska and WebM
+        return "video"
+    return None
+
+
+def classify(pathname: str) -> Optional[str]:
+    """
+    Return the media type of a file looking at its contents, falling back
+    to its extension
+    """
+    try:
+        with open(pathname, "rb") as fd:
+            head = fd.read(4096)
+    except OSError as e:
+        log.warning("%s: cannot read file: %s", pathname, e)
+        head = b""
+    res = sniff_media_type(head)
+    if res is None:
+        res = media_type(pathname)
+    return res
+
+
+class TypeCache:
+    """
+    Cache of the media types found by classify().
+
+    Files are identified by pathname, inode, size and modification time, so
+    each version of a file is only read once, whoever asks for its type
+    """
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self.types: Dict[Tuple[str, int, int, int], Optional[str]] = OrderedDict()
+
+    def get(self, pathname: str, st: Optional[os.stat_result] = None) -> Optional[str]:
+        """
+        Return the media type of a file, looking at its contents if needed
+        """
+        if st is None:
+            try:
+                st = os.stat(pathname)
+            except OSError as e:
+                log.warning("%s: cannot access file: %s", pathname, e)
+                return None
+        key = (pathname, st.st_ino, st.st_size, st.st_mtime_ns)
+        try:
+            res = self.types[key]
+        except KeyError:
+            res = self.types[key] = classify(pathname)
+            while len(self.types) > self.max_entries:
+                self.types.popitem(last=False)
+        else:
+            self.types.move_to_end(key)
+        return res
+
+
+# Media types of the files seen by the player
+TYPES = TypeCache()
+
+
 class MediaDir:
-    def __init__(self, settings: PlayerSettings, path, backup_to: Optional["MediaDir"] = None):
+    def __init__(self, settings: PlayerSettings, path):
         self.settings = settings
         self.path = os.path.abspath(path)
-        # MediaDir to which we backup files if requested
-        self.backup_media_dir = backup_to
+        # Persistent index of the directory contents, to avoid examining
+        # unchanged files at each scan
+        self.index = ScanIndex(self.path, TYPES.get)
         self.pdf = None
         self.videos = None
         self.images = None
@@ -42,8 +161,23 @@ class MediaDir:
         if not os.path.isdir(self.path):
             return None
 
-        for fn in os.listdir(self.path):
-            self.add(fn)
+        with metrics.SCAN_SECONDS.time(dir=os.path.basename(self.path)):
+            for entry in self.index.scan():
+                self.add(entry.name, entry.type, entry.mtime)
+
+        return self.select()
+
+    def select(self):
+        """
+        Choose the presentation to show.
+
+        If there are files of different types and mixed media is enabled, this
+        is a timeline of all of them, else the presentation with the most
+        recent files
+        """
+        if self.settings.mixed_media and sum(1 for pres in self.all if pres) > 1:
+            self.pres = presentation.TimelinePresentation(self.settings, items=self.timeline_items())
+            return self.pres
 
         pres = max(self.all, key=lambda x: x.mtime)
         if not pres:
@@ -51,63 +185,105 @@ class MediaDir:
         self.pres = pres
         return self.pres
 
-    def add(self, fn):
-        base, ext = os.path.splitext(fn)
-        mimetype = mimetypes.types_map.get(ext)
-        if mimetype is None:
-            log.info("%s: %s: mime type unknown", self, fn)
-            return False
-        log.info("%s: %s: mime type %s", self, fn, mimetype)
-
-        if mimetype == "application/pdf":
-            self.pdf.add(fn)
-            return True
-        elif mimetype.startswith("image/"):
-            self.images.add(fn)
-            return True
-        elif mimetype.startswith("video/"):
-            self.videos.add(fn)
-            return True
-        elif mimetype == "application/vnd.oasis.opendocument.presentation":
-            self.odp.add(fn)
-            return True
-        else:
-            return False
+    def timeline_items(self) -> List[presentation.FilePresentation]:
+        """
+        Return the presentations of a timeline of all the media, sorted by
+        file name.
+
+        Images and videos are shown as a single slideshow or playlist each,
+        and every document as a presentation of its own
+        """
+        items = [pres for pres in (self.images, self.videos) if pres]
+        items.extend(self.pdf.split())
+        items.extend(self.odp.split())
+        items.sort(key=lambda pres: min(pres.fnames))
+        return items
 
-    def move_assets_to(self, other: "MediaDir"):
+    def pathname(self, fn: str) -> Optional[str]:
         """
-        If we contain assets, move them to other and empty this MediaDir
+        Return the pathname of the contents of a media file
         """
-        log.info("%s: moving assets to %s", self, other)
-        # Let other backup its assets if configured
-        other.backup_assets()
-
-        # Clean the other's media directory
-        if os.path.exists(other.path):
-            shutil.rmtree(other.path)
-        os.makedirs(other.path, exist_ok=True)
-
-        # Move all our assets to other
-        for p in self.all:
-            p.move_assets_to(other.path)
-        other.pdf = self.pdf
-        other.videos = self.videos
-        other.images = self.images
-        other.odp = self.odp
-        other.all = self.all
-        other.pres = self.pres
-
-        # Empty our record of media files
-        self.clear()
+        return os.path.join(self.path, os.path.basename(fn))
+
+    def file_type(self, fn: str) -> Optional[str]:
+        """
+        Return the media type of a file, as found by the last scan if
+        possible
+        """
+        entry = self.index.entries.get(fn)
+        if entry is not None:
+            return entry.type
+        return media_type(fn)
 
-    def backup_assets(self):
+    def file_sha256(self, fn: str) -> Optional[str]:
         """
-        If we have a backup_media_dir configured and we contain assets, move
-        them to the backup_media_dir
+        Return the sha256 of a media file if it is known without reading it
         """
-        if self.backup_media_dir is None:
-            return
-        if not self.scan():
-            return
-        self.move_assets_to(self.backup_media_dir)
+        return None
+
+    def add(self, fn, type: Optional[str], mtime: Optional[float] = None, path: Optional[str] = None):
+        if type is None:
+            log.info("%s: %s: media type unknown", self, fn)
+            return False
+        log.info("%s: %s: media type %s", self, fn, type)
+
+        if type == "pdf":
+            self.pdf.add(fn, mtime, path)
+        elif type == "image":
+            self.images.add(fn, mtime, path)
+        elif type == "video":
+            self.videos.add(fn, mtime, path)
+        elif type == "odp":
+            self.odp.add(fn, mtime, path)
+        return True
+
+
+class StoreDir(MediaDir):
+    """
+    MediaDir with the contents of a generation of a MediaStore, by default
+    the active one
+    """
+    def __init__(self, settings: PlayerSettings, store: MediaStore, name: Optional[str] = None):
+        super().__init__(settings, store.root)
+        self.store = store
+        # Name of the generation to show, if not the active one
+        self.name = name
+        self.generation: Optional[Generation] = None
+
+    def scan(self):
         self.clear()
+        if self.name is not None:
+            self.generation = self.store.get(self.name)
+        else:
+            self.generation = self.store.active
+        if self.generation is None:
+            return None
+
+        for file in self.generation.files.values():
+            self.add(file.name, file.type, file.mtime, self.store.blob_path(file))
+
+        return self.select()
+
+    def pathname(self, fn: str) -> Optional[str]:
+        if self.generation is None:
+            return None
+        file = self.generation.files.get(fn)
+        if file is None:
+            return None
+        return self.store.blob_path(file)
+
+    def file_type(self, fn: str) -> Optional[str]:
+        if self.generation is None:
+            return None
+        file = self.generation.files.get(fn)
+        if file is None:
+            return None
+        return file.type
+
+    def file_sha256(self, fn: str) -> Optional[str]:
+        if self.generation is None:
+            return None
+        file = self.generation.files.get(fn)
+        if file is None:
+            return None
+        return file.sha256
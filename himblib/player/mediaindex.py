@@ -0,0 +1,116 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Callable
+import asyncio
+import os
+import logging
+import pyinotify
+from .mediadir import TYPES
+
+log = logging.getLogger(__name__)
+
+
+class MediaEntry:
+    """
+    Information about a file in the media directory
+    """
+    def __init__(self, name: str, size: int, mtime: float, type: Optional[str]):
+        self.name = name
+        self.size = size
+        self.mtime = mtime
+        self.type = type
+
+    def to_json(self):
+        return {"name": self.name, "size": self.size, "mtime": self.mtime, "type": self.type}
+
+
+class MediaIndex:
+    """
+    In-memory index of the files uploaded to the media directory, kept up to
+    date using inotify
+    """
+    # Names in the media directory that are not uploaded media
+    EXCLUDE = ("current", "previous", "logo", "himblick.conf", "remove-when-done")
+
+    MASK = (pyinotify.IN_CREATE | pyinotify.IN_CLOSE_WRITE | pyinotify.IN_MOVED_TO
+            | pyinotify.IN_MOVED_FROM | pyinotify.IN_DELETE)
+
+    def __init__(self, media_dir: str):
+        self.media_dir = os.path.abspath(media_dir)
+        self.entries: Dict[str, MediaEntry] = {}
+        # Sorted list of entries, cached until the next change
+        self._sorted: Optional[List[MediaEntry]] = None
+        # Functions called when the index changes
+        self.listeners: List[Callable[[], None]] = []
+        self.watch_manager = None
+        self.notifier = None
+
+    def start(self):
+        """
+        Start watching the media directory, and load its current contents
+        """
+        self.watch_manager = pyinotify.WatchManager()
+        self.watch_manager.add_watch(self.media_dir, self.MASK)
+        self.notifier = pyinotify.AsyncioNotifier(
+                self.watch_manager, asyncio.get_event_loop(), default_proc_fun=self.on_event)
+        # Scan after adding the watch, so no change can be missed
+        self.rescan()
+
+    def is_media(self, name: str) -> bool:
+        return not name.startswith(".") and name not in self.EXCLUDE
+
+    def rescan(self):
+        """
+        Rebuild the index from the contents of the directory
+        """
+        entries = {}
+        for de in os.scandir(self.media_dir):
+            if not self.is_media(de.name) or de.is_dir():
+                continue
+            st = de.stat()
+            entries[de.name] = MediaEntry(de.name, st.st_size, st.st_mtime, TYPES.get(de.path, st))
+        self.entries = entries
+        self.changed()
+
+    def update(self, name: str):
+        """
+        Refresh the information about a file
+        """
+        pathname = os.path.join(self.media_dir, name)
+        try:
+            st = os.stat(pathname)
+        except FileNotFoundError:
+            self.remove(name)
+            return
+        self.entries[name] = MediaEntry(name, st.st_size, st.st_mtime, TYPES.get(pathname, st))
+        self.changed()
+
+    def remove(self, name: str):
+        if self.entries.pop(name, None) is not None:
+            self.changed()
+
+    def changed(self):
+        self._sorted = None
+        for listener in self.listeners:
+            listener()
+
+    def list(self) -> List[MediaEntry]:
+        """
+        Return the entries sorted by name
+        """
+        if self._sorted is None:
+            self._sorted = sorted(self.entries.values(), key=lambda e: e.name)
+        return self._sorted
+
+    def on_event(self, event):
+        if event.mask & pyinotify.IN_Q_OVERFLOW:
+            log.warning("%s: inotify queue overflow, rescanning", self.media_dir)
+            self.rescan()
+            return
+
+        if event.path != self.media_dir or event.dir or not self.is_media(event.name):
+            return
+
+        if event.mask & (pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM):
+            self.remove(event.name)
+        else:
+            self.update(event.name)
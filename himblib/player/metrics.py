@@ -0,0 +1,208 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Sequence, Tuple, Callable
+from contextlib import contextmanager
+import abc
+import bisect
+import time
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, int) or value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+def format_labels(names: Sequence[str], values: Sequence[str], extra: Optional[Tuple[str, str]] = None) -> str:
+    pairs = list(zip(names, values))
+    if extra is not None:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"'))
+        for name, value in pairs)
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+class Metric(abc.ABC):
+    """
+    Base class for metrics exported in Prometheus text format
+    """
+    type = "untyped"
+
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        # Function computing the value at collection time, for unlabeled
+        # metrics whose value is kept elsewhere
+        self.function: Optional[Callable[[], float]] = None
+        REGISTRY.register(self)
+
+    def label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def set_function(self, function: Callable[[], float]):
+        self.function = function
+
+    @abc.abstractmethod
+    def samples(self) -> List[str]:
+        """
+        Return the lines with the values of the metric
+        """
+
+    def expose(self) -> str:
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.type}"]
+        if self.function is not None:
+            lines.append(f"{self.name} {format_value(self.function())}")
+        else:
+            lines.extend(self.samples())
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        self.values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self) -> List[str]:
+        return [f"{self.name}{format_labels(self.labelnames, key)} {format_value(value)}"
+                for key, value in sorted(self.values.items())]
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def set(self, value: float, **labels):
+        self.values[self.label_values(labels)] = value
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+    def __init__(self, *args, buckets: Sequence[float] = DEFAULT_BUCKETS, **kw):
+        super().__init__(*args, **kw)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        # Per-bucket (not cumulative) counts, sum and count for each label set
+        self.values: Dict[Tuple[str, ...], Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self.label_values(labels)
+        entry = self.values.get(key)
+        if entry is None:
+            entry = self.values[key] = ([0] * len(self.buckets), [0.0])
+        counts, total = entry
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        total[0] += value
+
+    @contextmanager
+    def time(self, **labels):
+        """
+        Observe the time spent running the body of the with statement
+        """
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - start, **labels)
+
+    def samples(self) -> List[str]:
+        lines = []
+        for key, (counts, total) in sorted(self.values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = format_labels(self.labelnames, key, ("le", format_value(bound)))
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            labels = format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {format_value(total[0])}")
+            lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Metric] = []
+
+    def register(self, metric: Metric):
+        self.metrics.append(metric)
+
+    def expose(self) -> str:
+        """
+        Return all metrics in Prometheus text exposition format
+        """
+        return "\n".join(metric.expose() for metric in self.metrics) + "\n"
+
+
+REGISTRY = Registry()
+
+SCAN_SECONDS = Histogram(
+        "himblick_scan_seconds", "Time spent scanning media directories", ["dir"])
+MAKE_PRESENTATION_SECONDS = Histogram(
+        "himblick_make_presentation_seconds", "Time spent choosing and preparing the next presentation")
+PRESENTATION_START_SECONDS = Histogram(
+        "himblick_presentation_start_seconds",
+        "Time from the creation of a presentation to the start of its player", ["type"])
+PLAYER_STARTS = Counter(
+        "himblick_player_starts_total", "Number of media players started", ["type"])
+PLAYER_EXITS = Counter(
+        "himblick_player_exits_total", "Number of media players that exited without being stopped", ["type"])
+PLAYER_STOP_SECONDS = Histogram(
+        "himblick_player_stop_seconds", "Time taken to stop a media player", ["type"])
+PLAYER_HANGS = Counter(
+        "himblick_player_hangs_total", "Media players restarted because they looked stuck", ["type"])
+PLAYER_FALLBACKS = Counter(
+        "himblick_player_fallbacks_total", "Switches to fallback media after players kept exiting", ["to"])
+PLAYER_KILLS = Counter(
+        "himblick_player_kills_total", "Media players killed for not stopping within the grace period", ["type"])
+WEBSOCKET_CLIENTS = Gauge(
+        "himblick_websocket_clients", "Number of connected websocket clients")
+WEBSOCKET_MESSAGES_SENT = Counter(
+        "himblick_websocket_messages_sent_total", "Websocket messages sent to clients")
+WEBSOCKET_MESSAGES_DROPPED = Counter(
+        "himblick_websocket_messages_dropped_total", "Websocket messages dropped because a client queue was full")
+WEBSOCKET_MESSAGES_COALESCED = Counter(
+        "himblick_websocket_messages_coalesced_total", "Websocket messages replaced by a more recent one")
+WEBSOCKET_CLIENTS_PRUNED = Counter(
+        "himblick_websocket_clients_pruned_total", "Websocket clients disconnected for not responding")
+UPLOADS = Counter(
+        "himblick_uploads_total", "Number of completed media uploads", ["method"])
+UPLOAD_BYTES = Counter(
+        "himblick_upload_bytes_total", "Bytes of media received by uploads", ["method"])
+SYNC_SECONDS = Histogram(
+        "himblick_sync_seconds", "Time spent synchronizing media to another unit", ["host"],
+        buckets=(1, 5, 10, 30, 60, 120, 300, 600, 1800))
+SYNC_BYTES = Counter(
+        "himblick_sync_bytes_total", "Bytes of media synchronized to another unit", ["host"])
+SYNC_FAILURES = Counter(
+        "himblick_sync_failures_total", "Failed attempts at synchronizing media to another unit", ["host"])
+PREFLIGHT_SECONDS = Histogram(
+        "himblick_preflight_seconds", "Time spent validating a media file", ["type"])
+PREFLIGHT_REJECTED = Counter(
+        "himblick_preflight_rejected_total", "Media files rejected by validation", ["type"])
+COMMANDS = Counter(
+        "himblick_commands_total", "Commands sent to the player main loop", ["command", "source"])
+COMMANDS_COALESCED = Counter(
+        "himblick_commands_coalesced_total", "Commands merged into an equivalent pending one", ["command"])
+COMMAND_WAIT_SECONDS = Histogram(
+        "himblick_command_wait_seconds", "Time commands wait in the queue before being handled", ["command"])
+PRESENTATION_VISIBLE_SECONDS = Histogram(
+        "himblick_presentation_visible_seconds",
+        "Time from the creation of a presentation to its player showing a fullscreen window", ["type"])
+HANDOVER_TIMEOUTS = Counter(
+        "himblick_handover_timeouts_total",
+        "Presentation switches where the new player did not show up in time", ["type"])
+PLAYER_UPDATES = Counter(
+        "himblick_player_updates_total", "Media changes applied to a running player without restarting it", ["type"])
+RAM_STAGE_BYTES = Gauge(
+        "himblick_ram_stage_bytes", "Size of the copies of media files staged in RAM")
@@ -1,16 +1,30 @@
 from __future__ import annotations
+from typing import Dict, Optional, Set, Tuple
 from ..cmdline import Command
 from ..settings import Settings, PlayerSettings
 from ..utils import run
-from . import presentation
+from . import presentation, metrics
 from .changemonitor import ChangeMonitor
-from .mediadir import MediaDir
+from .commands import CommandBus
+from .mediadir import MediaDir, StoreDir
+from .mediaindex import MediaIndex
+from .preflight import Preflight, video_duration
+from .render import RenderCache, DisplayImageCache
+from .restarts import RestartPolicy, HangDetector
+from .hashes import HashCache
+from .sampler import SystemSampler
+from .schedule import ScheduleRule, Scheduler, load_rules
+from .staging import RamStage
 from .server import WebUI
+from .store import MediaStore, StoredFile, Generation
 from .syncer import Syncer
+from .workers import WorkerPool
 import re
 import mimetypes
 import os
 import signal
+import subprocess
+import shutil
 import asyncio
 import logging
 
@@ -36,16 +50,56 @@ class Player(Command):
         self.settings = Settings(self.args.config)
         self.player_settings = PlayerSettings(os.path.join(self.args.media, "himblick.conf"))
         self.media_dir = MediaDir(self.player_settings, self.args.media)
-        self.previous_dir = MediaDir(self.player_settings, os.path.join(self.args.media, "previous"))
-        self.current_dir = MediaDir(
-                self.player_settings, os.path.join(self.args.media, "current"), backup_to=self.previous_dir)
+        self.store = MediaStore(os.path.join(self.args.media, ".store"))
+        self.current_dir = StoreDir(self.player_settings, self.store)
         self.logo_dir = MediaDir(self.player_settings, os.path.join(self.args.media, "logo"))
+        self.media_index = MediaIndex(self.args.media)
+        self.sampler = SystemSampler()
+        self.restarts = RestartPolicy(self.player_settings)
+        self.hangs = HangDetector(self.sampler, self.player_settings)
+        # Set when the active generation has been rolled back because its
+        # players kept exiting, to do it only once for each new media
+        self.rolled_back = False
+        # Workers for short jobs: scaling images, thumbnails, probing videos
+        self.workers = WorkerPool(max_workers=os.cpu_count() or 1)
+        # Rendering decks can take minutes, and gets its own worker so that it
+        # does not hold up the short jobs
+        self.render_workers = WorkerPool()
+        self.hashes = HashCache()
+        self.preflight = Preflight(
+                os.path.join(self.args.media, ".preflight"), lambda: self.player_settings.preflight_timeout)
+        # Screen resolution, updated by configure_screen
+        self.screen_size = (1920, 1080)
+        self.renders = RenderCache(
+                os.path.join(self.args.media, ".cache", "renders"), self.render_workers,
+                lambda: self.screen_size,
+                lambda: {"pdf": self.player_settings.pdf_render_command,
+                         "odp": self.player_settings.odp_render_command})
+        self.renders.listeners.append(self.on_render_complete)
+        self.display_images = DisplayImageCache(
+                os.path.join(self.args.media, ".cache", "display"), self.workers, lambda: self.screen_size)
+        self.display_images.listeners.append(self.on_render_complete)
+        # Copies in RAM of the media being played. /dev/shm is a tmpfs
+        # larger than the user runtime directory
+        if os.path.isdir("/dev/shm"):
+            stage_root = os.path.join("/dev/shm", f"himblick-stage-{os.getuid()}")
+        else:
+            stage_root = presentation.runtime_path("himblick-stage")
+        self.ram_stage = RamStage(stage_root, self.staging_budget)
+        metrics.RAM_STAGE_BYTES.set_function(lambda: self.ram_stage.used)
+        # Length of videos in seconds by sha256, None if it cannot be found
+        self.video_durations: Dict[str, Optional[float]] = {}
         self.web_ui = WebUI(self)
         self.current_presentation = None
         self.syncers = []
         for hostname in self.settings.general("replicate to").split():
             self.syncers.append(Syncer(hostname, self.current_dir))
-        self.command_queue = None
+        self.commands: Optional[CommandBus] = None
+        self.scheduler: Optional[Scheduler] = None
+        # Directories with the content of schedule rules, by (kind, name)
+        self.schedule_dirs: Dict[Tuple[str, str], MediaDir] = {}
+        # Serializes scanning the content of schedule rules
+        self.schedule_lock: Optional[asyncio.Lock] = None
 
     def configure_screen(self):
         """
@@ -69,6 +123,27 @@ class Player(Command):
                 output_name = None
             run(["xrandr", "--output", output_name, "--mode", mode])
 
+        screen_size = self.detect_screen_size()
+        if screen_size is not None:
+            self.screen_size = screen_size
+        log.info("Screen size: %dx%d", *self.screen_size)
+
+    def detect_screen_size(self) -> Optional[Tuple[int, int]]:
+        """
+        Return the current (width, height) of the first connected output
+        """
+        try:
+            res = run(["xrandr", "--query"], capture_output=True, text=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            log.warning("cannot query screen size: %s", e)
+            return None
+        re_output = re.compile(r"^\S+ connected (?:primary )?(\d+)x(\d+)\+")
+        for line in res.stdout.splitlines():
+            mo = re_output.match(line)
+            if mo:
+                return int(mo.group(1)), int(mo.group(2))
+        return None
+
     def run(self):
         # Errors go to the logs, which go to stderr, which is saved in
         # ~/.xsession-errors
@@ -79,59 +154,392 @@ class Player(Command):
         asyncio.run(self.main_loop())
 
     async def make_presentation(self):
+        with metrics.MAKE_PRESENTATION_SECONDS.time():
+            pres = await self._make_presentation()
+        # Copy the media into RAM before starting the players. Meanwhile, the
+        # previous presentation stays on screen
+        pres.use_staged(self.ram_stage.paths)
+        await self.ram_stage.stage(pres.media_pathnames(), interrupt=self.commands.quit_requested)
+        return pres
+
+    def staging_budget(self) -> int:
+        """
+        Return how many bytes of media can be copied into RAM
+        """
+        budget = self.player_settings.ram_staging_size * 1024 * 1024
+        sample = self.sampler.latest
+        if sample is not None and "MemAvailable" in sample.meminfo:
+            # Leave at least half of the available memory to the players
+            budget = min(budget, self.ram_stage.used + sample.meminfo["MemAvailable"] // 2)
+        return budget
+
+    async def _make_presentation(self):
         # Reload configuration
         self.player_settings.reload()
+        self.scheduler.set_rules(load_rules(self.player_settings), self.player_settings.schedule_staging_time)
+
+        # Look in the media directory, and validate new media before
+        # activating it
+        if self.media_dir.scan() and await self.preflight.run(self.media_dir, self.hashes):
+            self.media_dir.scan()
+        if self.media_dir.pres:
+            generation = await self.import_media(self.media_dir)
+            self.store.activate(generation.name)
+            self.rolled_back = False
+            self.store.gc(self.player_settings.media_store_size * 1024 * 1024,
+                          keep=(rule.generation for rule in self.scheduler.rules if rule.generation))
+            stored = {f.sha256 for g in self.store.list() for f in g.files.values()}
+            stored.update(await self.scheduled_hashes())
+            self.renders.prune(stored)
+            self.display_images.prune(stored)
+        else:
+            log.info("%s: no new media found", self.media_dir)
 
-        # Look in the media directory
-        if self.media_dir.scan():
-            self.media_dir.move_assets_to(self.current_dir)
-            for syncer in self.syncers:
-                syncer.rescan()
-            return self.current_dir.pres
+        # Scheduled content replaces the active generation while its time
+        # window lasts
+        rule = self.scheduler.active_rule()
+        if rule is not None:
+            pres = await self.make_scheduled_presentation(rule)
+            if pres is not None:
+                return pres
 
-        log.warn("%s: no media found, trying an old current dir", self.media_dir)
         if self.current_dir.scan():
-            for syncer in self.syncers:
-                syncer.rescan()
-            return self.current_dir.pres
+            source = f"generation {self.current_dir.generation.name}"
+            if self.restarts.failing(source) and not self.rolled_back:
+                self.rolled_back = True
+                previous = self.store.rollback()
+                if previous is not None:
+                    log.warning("%s: players keep exiting, restoring generation %s", source, previous.name)
+                    metrics.PLAYER_FALLBACKS.inc(to="previous")
+                    self.current_dir.scan()
+                    source = f"generation {previous.name}"
+            if not self.restarts.failing(source):
+                for syncer in self.syncers:
+                    syncer.rescan()
+                pres = await self.prepare_presentation(self.current_dir)
+                pres.source = source
+                return pres
+            log.warning("%s: players keep exiting, trying logo", source)
+            metrics.PLAYER_FALLBACKS.inc(to="logo")
+        else:
+            # If there is no media to play there, look into the 'logo' directory
+            log.warning("%s: no media found, trying logo", self.current_dir)
 
-        # If there is no media to play there, look into the 'logo' directory
-        log.warn("%s: no media found, trying logo", self.current_dir)
-        if self.logo_dir.scan():
-            return self.logo_dir.pres
+        if self.logo_dir.scan() and not self.restarts.failing("logo"):
+            pres = await self.prepare_presentation(self.logo_dir)
+            pres.source = "logo"
+            return pres
 
         # Else, do nothing
-        log.warn("%s: no media found, doing nothing", self.logo_dir)
+        log.warning("%s: no media found, doing nothing", self.logo_dir)
         return presentation.EmptyPresentation(self.player_settings)
 
+    def schedule_dir(self, rule: ScheduleRule) -> MediaDir:
+        """
+        Return the MediaDir with the content of a schedule rule
+        """
+        if rule.media is not None:
+            key = ("media", rule.media)
+        else:
+            key = ("generation", rule.generation)
+        media_dir = self.schedule_dirs.get(key)
+        if media_dir is None:
+            if rule.media is not None:
+                media_dir = MediaDir(self.player_settings, os.path.join(self.args.media, rule.media))
+            else:
+                media_dir = StoreDir(self.player_settings, self.store, rule.generation)
+            self.schedule_dirs[key] = media_dir
+        return media_dir
+
+    async def scan_scheduled(self, rule: ScheduleRule) -> Optional[MediaDir]:
+        """
+        Scan and validate the content of a schedule rule, returning its
+        MediaDir, or None if there is nothing to show
+        """
+        media_dir = self.schedule_dir(rule)
+        if not media_dir.scan():
+            log.warning("%s: no media found for schedule %s", media_dir, rule)
+            return None
+        # Generations have been validated when they were uploaded
+        if not isinstance(media_dir, StoreDir) and await self.preflight.run(media_dir, self.hashes):
+            if not media_dir.scan():
+                return None
+        return media_dir
+
+    async def make_scheduled_presentation(self, rule: ScheduleRule) -> Optional[presentation.Presentation]:
+        """
+        Return the presentation for a schedule rule, or None if it cannot be
+        shown
+        """
+        source = f"schedule {rule}"
+        if self.restarts.failing(source):
+            log.warning("%s: players keep exiting, ignoring the schedule", source)
+            return None
+        async with self.schedule_lock:
+            media_dir = await self.scan_scheduled(rule)
+            if media_dir is None:
+                return None
+            pres = await self.prepare_presentation(media_dir)
+        pres.source = source
+        return pres
+
+    async def stage(self, rule: ScheduleRule):
+        """
+        Validate the content of a schedule rule before its time window
+        begins, and start rendering what it needs, so that switching to it is
+        quick
+        """
+        log.info("schedule %s: staging content", rule)
+        try:
+            async with self.schedule_lock:
+                media_dir = await self.scan_scheduled(rule)
+                if media_dir is not None:
+                    await self.prepare_presentation(media_dir)
+        except Exception:
+            log.exception("schedule %s: cannot stage content", rule)
+
+    async def scheduled_hashes(self) -> Set[str]:
+        """
+        Return the sha256 of the files in the directories of schedule rules,
+        as found by their last scan
+        """
+        res = set()
+        for media_dir in self.schedule_dirs.values():
+            if isinstance(media_dir, StoreDir):
+                continue
+            for entry in media_dir.index.entries.values():
+                if entry.type is None:
+                    continue
+                pathname = media_dir.pathname(entry.name)
+                try:
+                    res.add(await self.hashes.get(pathname, os.stat(pathname)))
+                except FileNotFoundError:
+                    pass
+        return res
+
+    async def prepare_presentation(self, media_dir: MediaDir):
+        """
+        Set up the presentation chosen by the last scan of media_dir to use
+        prerendered versions of its media, if available.
+
+        Missing renderings are started in the background, and the presentation
+        is restarted once they are ready.
+        """
+        pres = media_dir.pres
+        if isinstance(pres, presentation.TimelinePresentation):
+            for item in pres.items:
+                await self.prepare_item(media_dir, item)
+                if isinstance(item, presentation.VideoPresentation):
+                    await self.measure_videos(media_dir, item)
+        else:
+            await self.prepare_item(media_dir, pres)
+        return pres
+
+    async def prepare_item(self, media_dir: MediaDir, pres: presentation.Presentation):
+        """
+        Set up a presentation to use prerendered versions of its media
+        """
+        if isinstance(pres, presentation.DeckPresentation):
+            fname = pres.most_recent_fname
+            pathname = pres.most_recent_pathname
+            sha256 = media_dir.file_sha256(fname)
+            if sha256 is None:
+                sha256 = await self.hashes.get(pathname, os.stat(pathname))
+            pres.slides = self.renders.get(sha256)
+            if pres.slides is None:
+                self.renders.request(pathname, sha256, media_dir.file_type(fname))
+        elif isinstance(pres, presentation.ImagePresentation):
+            missing = []
+            for fname in pres.fnames:
+                pathname = pres.pathname(fname)
+                sha256 = media_dir.file_sha256(fname)
+                if sha256 is None:
+                    sha256 = await self.hashes.get(pathname, os.stat(pathname))
+                scaled = self.display_images.get(pathname, sha256)
+                if scaled is None:
+                    missing.append((pathname, sha256))
+                else:
+                    pres.scaled[fname] = scaled
+            if missing:
+                pres.scaling = True
+                self.display_images.request(missing)
+
+    async def measure_videos(self, media_dir: MediaDir, pres: presentation.VideoPresentation):
+        """
+        Find the length of the videos of a presentation, to know for how long
+        to play them in a timeline
+        """
+        for fname in pres.fnames:
+            pathname = pres.pathname(fname)
+            sha256 = media_dir.file_sha256(fname)
+            if sha256 is None:
+                sha256 = await self.hashes.get(pathname, os.stat(pathname))
+            if sha256 not in self.video_durations:
+                self.video_durations[sha256] = await self.workers.run(video_duration, pathname)
+            duration = self.video_durations[sha256]
+            if duration is not None:
+                pres.durations[fname] = duration
+
+    def on_render_complete(self):
+        """
+        Restart the current presentation if it is waiting for prerendered
+        media
+        """
+        pres = self.current_presentation
+        if isinstance(pres, presentation.TimelinePresentation):
+            items = pres.items
+        else:
+            items = [pres]
+        for item in items:
+            if isinstance(item, presentation.DeckPresentation) and item.slides is None:
+                self.commands.put("rescan", "render")
+            elif isinstance(item, presentation.ImagePresentation) and item.scaling:
+                self.commands.put("rescan", "render")
+
+    async def import_media(self, media_dir: MediaDir) -> Generation:
+        """
+        Move the media files found by the last scan of media_dir into a new
+        generation in the store
+        """
+        files = []
+        for entry in media_dir.index.entries.values():
+            if entry.type is None:
+                continue
+            pathname = media_dir.pathname(entry.name)
+            st = os.stat(pathname)
+            sha256 = await self.hashes.get(pathname, st)
+            files.append(StoredFile(entry.name, sha256, st.st_size, st.st_mtime, entry.type))
+        generation = self.store.add(media_dir.path, files)
+        # Hashes are keyed by file name, so record them also for the blobs
+        for file in files:
+            pathname = self.store.blob_path(file)
+            self.hashes.set(pathname, os.stat(pathname), file.sha256)
+        return generation
+
+    async def import_legacy_dirs(self):
+        """
+        Move media from the current/ and previous/ directories used by older
+        versions into the store
+        """
+        for name in ("previous", "current"):
+            media_dir = MediaDir(self.player_settings, os.path.join(self.args.media, name))
+            if not os.path.isdir(media_dir.path):
+                continue
+            if media_dir.scan():
+                log.info("%s: importing media into %s", media_dir, self.store)
+                generation = await self.import_media(media_dir)
+                self.store.activate(generation.name)
+            # Remove the directory only if nothing else is left in it
+            shutil.rmtree(media_dir.index.index_dir, ignore_errors=True)
+            try:
+                os.rmdir(media_dir.path)
+            except OSError:
+                log.warning("%s: leaving files that are not media in place", media_dir)
+
     async def main_loop(self):
         # We need to start the server inside asyncio.run, otherwise it won't
         # start
+        await self.import_legacy_dirs()
+        self.media_index.start()
         self.web_ui.start_server()
+        self.sampler.start()
+        asyncio.create_task(self.watch_players())
 
         loop = asyncio.get_event_loop()
-        self.command_queue = asyncio.Queue()
-        monitor = ChangeMonitor(self.command_queue, self.args.media)  # noqa
+        self.commands = CommandBus()
+        self.schedule_lock = asyncio.Lock()
+        self.scheduler = Scheduler(
+                on_switch=lambda rule: self.commands.put("rescan", "schedule"),
+                on_stage=lambda rule: asyncio.create_task(self.stage(rule)))
+        self.scheduler.start()
+        monitor = ChangeMonitor(  # noqa
+                self.commands, self.args.media,
+                get_auto_delay=lambda: self.player_settings.auto_activate_delay)
 
         def do_terminate():
-            self.command_queue.put_nowait("quit")
+            self.commands.put("quit", "signal")
 
         loop.add_signal_handler(signal.SIGINT, do_terminate)
         loop.add_signal_handler(signal.SIGTERM, do_terminate)
 
+        # Presentation being replaced
+        previous = None
         while True:
-            self.current_presentation = await self.make_presentation()
-            asyncio.create_task(self.current_presentation.run(self.command_queue))
+            pres = await self.make_presentation()
+            if "quit" in self.commands.pending:
+                # Quit was requested while preparing: do not start the new
+                # presentation
+                cmd = self.commands.pop("quit")
+                log.info("Queue command: %s", cmd)
+                if previous is not None and previous.is_running():
+                    await previous.stop()
+                break
+            if previous is not None and previous.is_running() and await previous.update(pres):
+                # The running player switched to the new media by itself
+                metrics.PLAYER_UPDATES.inc(type=previous.__class__.__name__)
+                previous.source = pres.source
+                self.current_presentation = previous
+            else:
+                if previous is not None and previous.is_running() and self.player_settings.handover_timeout <= 0:
+                    await previous.stop()
+                self.current_presentation = pres
+                asyncio.create_task(self.run_presentation(pres))
+                if previous is not None and previous.is_running():
+                    await self.handover(previous, pres)
+            previous = None
+            # The old player is gone: copies of media it used can be dropped
+            self.ram_stage.release(self.current_presentation.media_pathnames())
             self.web_ui.trigger_reload()
-            cmd = await self.command_queue.get()
+            cmd = await self.commands.get()
             log.info("Queue command: %s", cmd)
-            if cmd == "rescan":
-                if self.current_presentation.is_running():
-                    await self.current_presentation.stop()
-            elif cmd == "player_exited":
-                pass
-            elif cmd == "quit":
+            if cmd.name == "quit":
                 if self.current_presentation.is_running():
                     await self.current_presentation.stop()
                 break
-            self.current_presentation = None
+            # The running player, if any, is stopped or updated once we know
+            # what comes next
+            previous = self.current_presentation
+
+    async def handover(self, old: presentation.Presentation, new: presentation.Presentation):
+        """
+        Stop the old presentation once the new one is on screen
+        """
+        timeout = self.player_settings.handover_timeout
+        if not await new.wait_visible(timeout):
+            log.warning("%s: new player not visible after %ds, stopping the old one anyway", new.unit, timeout)
+            metrics.HANDOVER_TIMEOUTS.inc(type=new.__class__.__name__)
+        await old.stop()
+
+    async def run_presentation(self, pres: presentation.Presentation):
+        """
+        Run a presentation, and schedule its restart if the player exits by
+        itself
+        """
+        if not await pres.run():
+            return
+        delay = 0
+        if pres.source is not None:
+            delay = self.restarts.record_exit(pres.source)
+            if delay > 0:
+                log.warning("%s: player exited %d times in the last %ds, restarting in %ds",
+                         pres.source, self.restarts.recent_exits(pres.source),
+                         self.player_settings.restart_window, delay)
+        self.commands.put("player_exited", pres.__class__.__name__, delay=delay)
+
+    async def watch_players(self):
+        """
+        Restart the current player if it looks stuck
+        """
+        while True:
+            await asyncio.sleep(self.sampler.interval)
+            pres = self.current_presentation
+            if pres is None or not pres.is_running():
+                continue
+            # In a timeline, check the player of the current item
+            pres = pres.playing()
+            reason = self.hangs.check(pres)
+            if reason is None:
+                continue
+            log.warning("%s: player looks stuck, %s: restarting it", pres.unit, reason)
+            metrics.PLAYER_HANGS.inc(type=pres.__class__.__name__)
+            await pres.abort()
@@ -0,0 +1,446 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Tuple
+import asyncio
+import concurrent.futures
+import json
+import os
+import struct
+import subprocess
+import time
+import zipfile
+import logging
+from ..utils import atomic_writer
+from . import metrics
+from .workers import WorkerPool
+try:
+    import PIL.Image
+except ModuleNotFoundError:
+    PIL = None
+
+if TYPE_CHECKING:
+    from .hashes import HashCache
+    from .mediadir import MediaDir
+
+log = logging.getLogger(__name__)
+
+
+def read_vint(fd) -> Tuple[Optional[int], int]:
+    """
+    Read an EBML variable length integer, returning its value with the length
+    marker removed (None if all bits are set, meaning unknown) and its length
+    """
+    first = fd.read(1)
+    if not first:
+        raise EOFError("truncated EBML element")
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 8 and not (first & mask):
+        mask >>= 1
+        length += 1
+    if length > 8:
+        raise ValueError("invalid EBML variable length integer")
+    rest = fd.read(length - 1)
+    if len(rest) != length - 1:
+        raise EOFError("truncated EBML element")
+    value = first & (mask - 1)
+    for b in rest:
+        value = (value << 8) | b
+    if value == (1 << (7 * length)) - 1:
+        return None, length
+    return value, length
+
+
+def check_isobmff(fd, size: int) -> Optional[str]:
+    """
+    Check the top level boxes of an MP4/MOV file
+    """
+    offset = 0
+    boxes = set()
+    while offset < size:
+        fd.seek(offset)
+        header = fd.read(16)
+        if len(header) < 8:
+            return "truncated box header"
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        if box_size == 1:
+            if len(header) < 16:
+                return "truncated box header"
+            box_size = struct.unpack(">Q", header[8:16])[0]
+        elif box_size == 0:
+            # Box extending to the end of the file
+            box_size = size - offset
+        if box_size < 8:
+            return f"invalid size for {box_type!r} box"
+        if offset + box_size > size:
+            return f"{box_type.decode(errors='replace')} box is truncated"
+        boxes.add(box_type)
+        offset += box_size
+    if b"moov" not in boxes:
+        return "no movie header"
+    return None
+
+
+def check_matroska(fd, size: int) -> Optional[str]:
+    """
+    Check the EBML header and segment of a Matroska/WebM file
+    """
+    try:
+        fd.seek(4)
+        header_size, length = read_vint(fd)
+        if header_size is None:
+            return "invalid EBML header"
+        fd.seek(4 + length + header_size)
+        segment_id = fd.read(4)
+        if segment_id != b"\x18\x53\x80\x67":
+            return "no segment found"
+        segment_size, length = read_vint(fd)
+        if segment_size is not None and fd.tell() + segment_size > size:
+            return "segment is truncated"
+    except (EOFError, ValueError) as e:
+        return str(e)
+    return None
+
+
+def isobmff_duration(fd, size: int) -> Optional[float]:
+    """
+    Return the duration in seconds from the movie header of an MP4/MOV file
+    """
+    offset = 0
+    end = size
+    while offset + 8 <= end:
+        fd.seek(offset)
+        header = fd.read(16)
+        if len(header) < 8:
+            return None
+        box_size, box_type = struct.unpack(">I4s", header[:8])
+        header_size = 8
+        if box_size == 1:
+            if len(header) < 16:
+                return None
+            box_size = struct.unpack(">Q", header[8:16])[0]
+            header_size = 16
+        elif box_size == 0:
+            box_size = end - offset
+        if box_size < header_size:
+            return None
+        if box_type == b"moov":
+            # Look inside the movie box
+            end = min(offset + box_size, size)
+            offset += header_size
+            continue
+        if box_type == b"mvhd":
+            fd.seek(offset + header_size)
+            data = fd.read(32)
+            if len(data) < 20:
+                return None
+            if data[0] == 1:
+                if len(data) < 32:
+                    return None
+                timescale, duration = struct.unpack(">IQ", data[20:32])
+            else:
+                timescale, duration = struct.unpack(">II", data[12:20])
+            if not timescale or duration in (0xffffffff, 0xffffffffffffffff):
+                return None
+            return duration / timescale
+        offset += box_size
+    return None
+
+
+def read_element_id(fd) -> int:
+    """
+    Read an EBML element ID, keeping its length marker
+    """
+    first = fd.read(1)
+    if not first:
+        raise EOFError("truncated EBML element")
+    first = first[0]
+    length = 1
+    mask = 0x80
+    while length <= 4 and not (first & mask):
+        mask >>= 1
+        length += 1
+    if length > 4:
+        raise ValueError("invalid EBML element ID")
+    rest = fd.read(length - 1)
+    if len(rest) != length - 1:
+        raise EOFError("truncated EBML element")
+    return int.from_bytes(bytes([first]) + rest, "big")
+
+
+def matroska_duration(fd, size: int) -> Optional[float]:
+    """
+    Return the duration in seconds from the segment information of a
+    Matroska/WebM file
+    """
+    try:
+        fd.seek(4)
+        header_size, length = read_vint(fd)
+        if header_size is None:
+            return None
+        fd.seek(4 + length + header_size)
+        if read_element_id(fd) != 0x18538067:
+            return None
+        segment_size, length = read_vint(fd)
+        end = size if segment_size is None else min(fd.tell() + segment_size, size)
+
+        # Look for the Info element among the first children of the segment
+        info_end = None
+        while fd.tell() < end:
+            element_id = read_element_id(fd)
+            element_size, length = read_vint(fd)
+            if element_id == 0x1549A966 and element_size is not None:
+                info_end = fd.tell() + element_size
+                break
+            if element_id == 0x1F43B675 or element_size is None:
+                # Clusters come after the information we need
+                return None
+            fd.seek(element_size, os.SEEK_CUR)
+        if info_end is None:
+            return None
+
+        timecode_scale = 1000000
+        duration = None
+        while fd.tell() < info_end:
+            element_id = read_element_id(fd)
+            element_size, length = read_vint(fd)
+            if element_size is None:
+                return None
+            data = fd.read(element_size)
+            if element_id == 0x2AD7B1:
+                timecode_scale = int.from_bytes(data, "big")
+            elif element_id == 0x4489 and element_size in (4, 8):
+                duration = struct.unpack(">f" if element_size == 4 else ">d", data)[0]
+    except (EOFError, ValueError):
+        return None
+    if duration is None:
+        return None
+    return duration * timecode_scale / 1000000000
+
+
+def video_duration(pathname: str) -> Optional[float]:
+    """
+    Return the duration in seconds of a video, or None if it cannot be found
+    from its container.
+
+    This is run in a worker process.
+    """
+    try:
+        size = os.path.getsize(pathname)
+        with open(pathname, "rb") as fd:
+            head = fd.read(12)
+            if head[4:8] == b"ftyp":
+                return isobmff_duration(fd, size)
+            elif head.startswith(b"\x1a\x45\xdf\xa3"):
+                return matroska_duration(fd, size)
+    except OSError as e:
+        log.warning("%s: cannot read video: %s", pathname, e)
+    return None
+
+
+def check_file(pathname: str, type: str) -> Optional[str]:
+    """
+    Check that a media file can be played.
+
+    This is run in a worker process. Return None if the file looks fine, or a
+    description of the problem.
+    """
+    try:
+        if type == "image":
+            if PIL is None:
+                log.warning("install python3-pil to validate images")
+                return None
+            with PIL.Image.open(pathname) as img:
+                # Decode the whole image, to catch truncated files
+                img.load()
+        elif type == "pdf":
+            res = subprocess.run(
+                    ["pdfinfo", pathname],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+            if res.returncode != 0:
+                return res.stderr.strip() or "cannot be read"
+            for line in res.stdout.splitlines():
+                if line.startswith("Pages:") and int(line[6:].strip()) == 0:
+                    return "document has no pages"
+        elif type == "video":
+            size = os.path.getsize(pathname)
+            with open(pathname, "rb") as fd:
+                head = fd.read(12)
+                if head[4:8] == b"ftyp":
+                    return check_isobmff(fd, size)
+                elif head.startswith(b"\x1a\x45\xdf\xa3"):
+                    return check_matroska(fd, size)
+        elif type == "odp":
+            with zipfile.ZipFile(pathname) as zf:
+                bad = zf.testzip()
+                if bad is not None:
+                    return f"{bad} is corrupted"
+                if "content.xml" not in zf.namelist():
+                    return "content.xml is missing"
+    except Exception as e:
+        return str(e) or e.__class__.__name__
+    return None
+
+
+class Quarantine:
+    """
+    Directory where media files that failed validation are kept, with the
+    reason for rejecting them
+    """
+    def __init__(self, root: str):
+        self.root = root
+        self.index = os.path.join(self.root, "reasons.json")
+        # (original name, reason, time) by name in the quarantine directory
+        self.entries: Dict[str, Tuple[str, str, float]] = {}
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.index, "rt") as fd:
+                entries = json.load(fd)
+            for name, val in entries.items():
+                if len(val) == 2:
+                    # Entries written before files were renamed in quarantine
+                    val = [name] + val
+                self.entries[name] = tuple(val)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning("%s: ignoring corrupted quarantine index: %s", self.index, e)
+
+    def add(self, pathname: str, reason: str):
+        """
+        Move a file to quarantine.
+
+        The file is renamed with a timestamp prefix, so that files with the
+        same name rejected at different times do not overwrite each other
+        """
+        os.makedirs(self.root, exist_ok=True)
+        name = os.path.basename(pathname)
+        stored = f"{time.time_ns()}-{name}"
+        os.rename(pathname, os.path.join(self.root, stored))
+        self.entries[stored] = (name, reason, time.time())
+        with atomic_writer(self.index, "wt", sync=False) as fd:
+            json.dump(self.entries, fd)
+
+    def list(self) -> List[Tuple[str, str, float]]:
+        """
+        Return (name, reason, time) for quarantined files, most recent first
+        """
+        return sorted(self.entries.values(), key=lambda x: x[2], reverse=True)
+
+
+class Preflight:
+    """
+    Validate media files in parallel worker processes before activating them.
+
+    Results are cached by the sha256 of the file contents, so each file is
+    only checked once. Checks that time out or lose their worker give no
+    verdict, and are tried again at the next scan
+    """
+    def __init__(self, root: str, get_timeout: Callable[[], int], max_workers: Optional[int] = None):
+        """
+        :arg root: directory where cached results and quarantined files are
+                   stored
+        :arg get_timeout: function returning the maximum time in seconds that
+                          checking a file can take
+        """
+        self.root = root
+        self.get_timeout = get_timeout
+        self.workers = WorkerPool(max_workers=max_workers or os.cpu_count() or 1)
+        # Submit no more checks than there are workers, so that a check starts
+        # running as soon as it is submitted and its timeout does not include
+        # time spent waiting in the queue. Created with the event loop
+        self.slots: Optional[asyncio.Semaphore] = None
+        self.results_file = os.path.join(self.root, "results.json")
+        # Check results by sha256: None if the file is good, else the reason
+        # it was rejected
+        self.results: Dict[str, Optional[str]] = {}
+        self.quarantine = Quarantine(os.path.join(self.root, "quarantine"))
+        self.load()
+
+    def load(self):
+        try:
+            with open(self.results_file, "rt") as fd:
+                self.results = json.load(fd)
+        except FileNotFoundError:
+            pass
+        except ValueError as e:
+            log.warning("%s: ignoring corrupted preflight results: %s", self.results_file, e)
+
+    def save(self):
+        with atomic_writer(self.results_file, "wt", sync=False) as fd:
+            json.dump(self.results, fd)
+
+    async def check(self, pathname: str, type: str) -> Optional[str]:
+        """
+        Check a file in a worker process, enforcing the timeout.
+
+        Raise asyncio.TimeoutError if the check takes too long, or
+        BrokenProcessPool if its worker keeps dying
+        """
+        timeout = self.get_timeout()
+        if self.slots is None:
+            self.slots = asyncio.Semaphore(self.workers.max_workers)
+        # A worker can die because the pool was killed to stop another check
+        # that timed out: in that case, try again
+        attempt = 0
+        while True:
+            async with self.slots:
+                try:
+                    with metrics.PREFLIGHT_SECONDS.time(type=type):
+                        return await asyncio.wait_for(self.workers.run(check_file, pathname, type), timeout)
+                except asyncio.TimeoutError:
+                    # The only way to stop a stuck check is to kill its worker
+                    self.workers.kill()
+                    raise
+                except concurrent.futures.process.BrokenProcessPool:
+                    attempt += 1
+                    if attempt >= 3:
+                        raise
+                    log.info("%s: worker pool restarted, checking again", pathname)
+
+    async def run(self, media_dir: MediaDir, hashes: HashCache) -> List[str]:
+        """
+        Check the files found by the last scan of media_dir, quarantining the
+        bad ones.
+
+        Return the names of the files that have been quarantined.
+        """
+        # (name, pathname, sha256, type) of files without a cached result
+        to_check = []
+        rejected: Dict[str, str] = {}
+        for entry in media_dir.index.entries.values():
+            if entry.type is None:
+                continue
+            pathname = media_dir.pathname(entry.name)
+            sha256 = await hashes.get(pathname, os.stat(pathname))
+            if sha256 not in self.results:
+                to_check.append((entry.name, pathname, sha256, entry.type))
+            elif self.results[sha256] is not None:
+                rejected[entry.name] = self.results[sha256]
+
+        if to_check:
+            log.info("%s: checking %d files", media_dir, len(to_check))
+            results = await asyncio.gather(
+                    *(self.check(pathname, type) for name, pathname, sha256, type in to_check),
+                    return_exceptions=True)
+            for (name, pathname, sha256, type), result in zip(to_check, results):
+                if isinstance(result, asyncio.TimeoutError):
+                    log.warning("%s: %s: check timed out after %ds, trying again at the next scan",
+                                media_dir, name, self.get_timeout())
+                    continue
+                elif isinstance(result, BaseException):
+                    log.warning("%s: %s: check failed, trying again at the next scan: %r", media_dir, name, result)
+                    continue
+                self.results[sha256] = result
+                if result is not None:
+                    metrics.PREFLIGHT_REJECTED.inc(type=type)
+                    rejected[name] = result
+            self.save()
+
+        for name, reason in rejected.items():
+            log.warning("%s: %s: rejected: %s", media_dir, name, reason)
+            self.quarantine.add(media_dir.pathname(name), reason)
+
+        return list(rejected.keys())
@@ -1,32 +1,166 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING
+from typing import TYPE_CHECKING, Dict, List, Optional
 import time
 import asyncio
+import itertools
 import shlex
 import os
 import shutil
+import signal
 import tempfile
 import logging
+from ..utils import atomic_writer, readahead
+from . import metrics
+from .sampler import find_cgroup_v2_dir
 
 if TYPE_CHECKING:
     from ..settings import PlayerSettings
 
 log = logging.getLogger(__name__)
 
+# Used to give each player its own systemd scope
+UNIT_SEQUENCE = itertools.count(1)
+
+
+def runtime_path(name: str) -> str:
+    """
+    Return the pathname of a file in the user runtime directory
+    """
+    return os.path.join(os.environ.get("XDG_RUNTIME_DIR") or tempfile.gettempdir(), name)
+
+
+class Supervisor:
+    """
+    Track the processes of a player through its process group and cgroup, and
+    stop them
+    """
+    # Interval for checking if processes have exited, in seconds
+    POLL_INTERVAL = 0.05
+
+    def __init__(self, proc: asyncio.subprocess.Process):
+        # The player is started in its own session, so its pid is also its
+        # process group id
+        self.proc = proc
+        self.pgid = proc.pid
+        # cgroup directory of the player scope, once known
+        self.cgroup: Optional[str] = None
+
+    def find_cgroup(self) -> Optional[str]:
+        """
+        Return the cgroup directory of the player, looking it up if needed
+        """
+        if self.cgroup is not None:
+            return self.cgroup
+        try:
+            with open(f"/proc/{self.pgid}/cgroup", "rt") as fd:
+                for line in fd:
+                    if line.startswith("0::"):
+                        relpath = line[3:].strip()
+                        break
+                else:
+                    return None
+        except OSError:
+            return None
+        # Until systemd-run has moved into the scope, we would find the
+        # cgroup of the player daemon itself, which must not be signalled
+        if not os.path.basename(relpath).startswith("himblick-player-"):
+            return None
+        path = find_cgroup_v2_dir(relpath)
+        if path is None:
+            return None
+        self.cgroup = path
+        return path
+
+    def pids(self) -> List[int]:
+        """
+        Return the pids of the processes of the player
+        """
+        cgroup = self.find_cgroup()
+        if cgroup is not None:
+            try:
+                with open(os.path.join(cgroup, "cgroup.procs"), "rt") as fd:
+                    return [int(line) for line in fd]
+            except (OSError, ValueError):
+                pass
+        return [self.pgid] if self.proc.returncode is None else []
+
+    def send_signal(self, sig: int):
+        """
+        Send a signal to all the processes of the player
+        """
+        try:
+            os.killpg(self.pgid, sig)
+        except ProcessLookupError:
+            pass
+        # Also reach processes that left the process group
+        for pid in self.pids():
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                pass
+
+    def is_alive(self) -> bool:
+        return self.proc.returncode is None or bool(self.pids())
+
+    async def stop(self, grace: float) -> bool:
+        """
+        Send SIGTERM to the player, then SIGKILL to whatever is left after
+        grace seconds.
+
+        Return True if the player had to be killed.
+        """
+        # Look up the cgroup while the main process is still there
+        self.find_cgroup()
+        self.send_signal(signal.SIGTERM)
+        deadline = time.monotonic() + grace
+        while time.monotonic() < deadline:
+            if not self.is_alive():
+                return False
+            await asyncio.sleep(self.POLL_INTERVAL)
+
+        log.warning("player %d did not stop after %.1fs, killing it", self.pgid, grace)
+        killed = False
+        if self.cgroup is not None:
+            # cgroup.kill is available since Linux 5.14
+            try:
+                with open(os.path.join(self.cgroup, "cgroup.kill"), "wt") as fd:
+                    fd.write("1")
+                killed = True
+            except OSError:
+                pass
+        if not killed:
+            self.send_signal(signal.SIGKILL)
+        return True
+
 
 class Presentation:
     """
     Base class for all presentation types
     """
+    # True if the player keeps using CPU while it works, so that a player
+    # using none has stalled. Otherwise, a player keeping the CPU busy is
+    # considered stuck in a loop
+    PLAYS_CONTINUOUSLY = False
+
     def __init__(self, settings: PlayerSettings):
         self.settings = settings
         self.loop = asyncio.get_event_loop()
         # Subprocess used to track the player
         self.proc = None
+        # Supervisor of the player processes
+        self.supervisor: Optional[Supervisor] = None
         # If not None, it's a future set when the player has quit
         self.quit = None
         # Time when the presentation started
         self.started = time.time()
+        # Set to True when run() is done
+        self.finished = False
+        # Name of the systemd scope running the player, so that it can be
+        # stopped without affecting other players
+        self.unit = f"himblick-player-{os.getpid()}-{next(UNIT_SEQUENCE)}"
+        # Name of the media the presentation shows, used to track player
+        # failures. None if failures are not tracked
+        self.source: Optional[str] = None
 
     def is_running(self):
         """
@@ -48,31 +182,126 @@ class Presentation:
         #   xset -dpms
         #
         # See also: https://stackoverflow.com/questions/10885337/inhibit-screensaver-with-python
-        cmd = ["systemd-run", "--scope", "--slice=himblick-player", "--user", "caffeinate", "--"] + cmd
+        cmd = ["systemd-run", "--scope", f"--unit={self.unit}", "--slice=himblick-player", "--user",
+               "caffeinate", "--"] + cmd
         log.info("Run %s", " ".join(shlex.quote(x) for x in cmd))
-        self.proc = await asyncio.create_subprocess_exec(*cmd)
+        self.proc = await asyncio.create_subprocess_exec(*cmd, start_new_session=True)
+        self.supervisor = Supervisor(self.proc)
         log.info("player %d started", self.proc.pid)
+        metrics.PLAYER_STARTS.inc(type=self.__class__.__name__)
+        metrics.PRESENTATION_START_SECONDS.observe(time.time() - self.started, type=self.__class__.__name__)
         returncode = await self.proc.wait()
         log.info("player %d exited with return code %d", self.proc.pid, returncode)
         self.proc = None
 
-    async def run(self, queue):
-        await self._run()
+    def player_pids(self) -> List[int]:
+        """
+        Return the pids of the processes of the running player
+        """
+        if self.proc is None or self.supervisor is None:
+            return []
+        return self.supervisor.pids()
+
+    async def has_fullscreen_window(self) -> bool:
+        """
+        Check if the player is showing a fullscreen window
+        """
+        for pid in self.player_pids():
+            proc = await asyncio.create_subprocess_exec(
+                    "xdotool", "search", "--onlyvisible", "--pid", str(pid),
+                    stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+            stdout, stderr = await proc.communicate()
+            for window in stdout.decode().split():
+                proc = await asyncio.create_subprocess_exec(
+                        "xprop", "-id", window, "_NET_WM_STATE",
+                        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.DEVNULL)
+                stdout, stderr = await proc.communicate()
+                if b"_NET_WM_STATE_FULLSCREEN" in stdout:
+                    return True
+        return False
+
+    async def wait_visible(self, timeout: float) -> bool:
+        """
+        Wait until the player shows a fullscreen window.
+
+        Return False if it did not happen within timeout seconds, or if the
+        player exited.
+        """
+        deadline = time.monotonic() + timeout
+        try:
+            while time.monotonic() < deadline and not self.finished:
+                if self.proc is not None and await self.has_fullscreen_window():
+                    metrics.PRESENTATION_VISIBLE_SECONDS.observe(
+                            time.time() - self.started, type=self.__class__.__name__)
+                    return True
+                await asyncio.sleep(0.2)
+        except FileNotFoundError as e:
+            log.warning("cannot look for player windows: %s", e)
+        return False
+
+    def playing(self) -> "Presentation":
+        """
+        Return the presentation whose player is currently on screen
+        """
+        return self
+
+    def media_pathnames(self) -> List[str]:
+        """
+        Return the pathnames of the files read by the player, in the order
+        they are shown
+        """
+        return []
+
+    def use_staged(self, staged: Dict[str, str]):
+        """
+        Make the player read copies of its files, given as a dict mapping
+        original pathnames to the pathnames of their copies. The dict can
+        change while the presentation runs
+        """
+        pass
+
+    async def update(self, new: "Presentation") -> bool:
+        """
+        Switch the running player to the media of the new presentation,
+        without restarting it.
+
+        Return False if this is not possible, and the new presentation needs
+        to be started instead.
+        """
+        return False
+
+    async def run(self) -> bool:
+        """
+        Run the presentation until the player exits.
+
+        Return True if the player exited by itself, False if it was stopped
+        """
+        try:
+            await self._run()
+        finally:
+            self.finished = True
         if self.quit:
             self.quit.set_result(True)
-        else:
-            queue.put_nowait("player_exited")
+            return False
+        metrics.PLAYER_EXITS.inc(type=self.__class__.__name__)
+        return True
+
+    async def abort(self):
+        """
+        Kill a player that stopped working, so that it is handled as if it
+        had exited by itself
+        """
+        if self.supervisor is not None:
+            await self.supervisor.stop(self.settings.player_stop_grace)
 
     async def stop(self):
         log.info("Stopping player %s", self.proc.pid if self.proc is not None else None)
-        self.quit = self.loop.create_future()
-        quit_proc = await asyncio.create_subprocess_exec("systemctl", "--user", "stop", "himblick-player.slice")
-        returncode = await quit_proc.wait()
-        if returncode != 0:
-            log.info("Stop process return code %d", returncode)
-        else:
-            log.info("Player stop requested")
-        await self.quit
+        with metrics.PLAYER_STOP_SECONDS.time(type=self.__class__.__name__):
+            self.quit = self.loop.create_future()
+            if self.supervisor is not None:
+                if await self.supervisor.stop(self.settings.player_stop_grace):
+                    metrics.PLAYER_KILLS.inc(type=self.__class__.__name__)
+            await self.quit
         log.info("Player stopped")
         self.quit = None
 
@@ -84,6 +313,10 @@ class EmptyPresentation(Presentation):
     def get_files(self):
         return []
 
+    async def wait_visible(self, timeout: float) -> bool:
+        # There is nothing to show
+        return True
+
     async def _run(self):
         log.info("Starting the empty presentation, doing nothing")
         self.proc = self.loop.create_future()
@@ -92,8 +325,12 @@ class EmptyPresentation(Presentation):
 
     async def stop(self):
         log.info("Stopping the empty presentation")
-        self.proc.set_result(True)
-        self.proc = None
+        self.quit = self.loop.create_future()
+        if self.proc is not None:
+            self.proc.set_result(True)
+            self.proc = None
+            await self.quit
+        self.quit = None
         log.info("Stopped the empty presentation")
 
 
@@ -106,7 +343,14 @@ class FilePresentation(Presentation):
         # Directory where the media files are found
         self.root = root
         self.fnames = []
+        # Pathnames of files not stored in root with their own name
+        self.paths: Dict[str, str] = {}
         self.most_recent_fname = None
+        # File list read by the slideshow player, if one is running
+        self.filelist: Optional[str] = None
+        # Pathnames of copies of the files to read instead, by pathname of
+        # their original
+        self.staged: Dict[str, str] = {}
         self.mtime = 0
 
     def __bool__(self):
@@ -115,33 +359,174 @@ class FilePresentation(Presentation):
     def get_files(self):
         return self.fnames
 
+    def media_pathnames(self) -> List[str]:
+        return list(self.pathnames)
+
+    def use_staged(self, staged: Dict[str, str]):
+        self.staged = staged
+
+    def play_pathname(self, pathname: str) -> str:
+        """
+        Return the pathname the player should read for a file, which is its
+        staged copy if there is one
+        """
+        return self.staged.get(pathname, pathname)
+
+    def cycle_time(self) -> Optional[float]:
+        """
+        Return how many seconds it takes to show all the files once, or None
+        if it is not known
+        """
+        return None
+
+    def file_durations(self) -> Optional[List[float]]:
+        """
+        Return how many seconds each of media_pathnames() is shown, or None
+        if it is not known
+        """
+        return None
+
+    async def read_ahead(self):
+        """
+        While each file is shown, read the next one into the page cache if it
+        is not staged in RAM
+        """
+        while True:
+            pathnames = self.media_pathnames()
+            durations = self.file_durations()
+            if durations is None or len(pathnames) < 2 or sum(durations) <= 0:
+                return
+            for idx, duration in enumerate(durations):
+                following = pathnames[(idx + 1) % len(pathnames)]
+                if following not in self.staged:
+                    self.loop.run_in_executor(None, readahead, [following])
+                await asyncio.sleep(duration)
+
+    async def run_player(self, cmd, **kw):
+        reader = asyncio.create_task(self.read_ahead())
+        try:
+            await super().run_player(cmd, **kw)
+        finally:
+            reader.cancel()
+
+    def pathname(self, fname: str) -> str:
+        return self.paths.get(fname) or os.path.join(self.root, fname)
+
     @property
     def pathnames(self):
         for fn in self.fnames:
-            yield os.path.join(self.root, fn)
+            yield self.pathname(fn)
 
     @property
     def most_recent_pathname(self):
-        return os.path.join(self.root, self.most_recent_fname)
+        return self.pathname(self.most_recent_fname)
+
+    def add(self, fname, mtime: Optional[float] = None, path: Optional[str] = None):
+        """
+        Add a media file to the presentation.
 
-    def add(self, fname):
-        mtime = os.path.getmtime(os.path.join(self.root, fname))
+        :arg mtime: modification time of the file, if already known
+        :arg path: pathname of the file contents, if not stored in root as
+                   fname
+        """
+        if path is not None:
+            self.paths[fname] = path
+        if mtime is None:
+            mtime = os.path.getmtime(self.pathname(fname))
         self.fnames.append(fname)
         if self.mtime is None or mtime > self.mtime:
             self.mtime = mtime
             self.most_recent_fname = fname
 
-    def move_assets_to(self, new_root):
+    def adopt(self, new: "FilePresentation"):
+        """
+        Take the list of media files from another presentation
+        """
+        self.root = new.root
+        self.fnames = new.fnames
+        self.paths = new.paths
+        self.most_recent_fname = new.most_recent_fname
+        self.mtime = new.mtime
+        self.staged = new.staged
+
+    def copy(self) -> "FilePresentation":
+        """
+        Return a new presentation of the same files, that can be run again
+        """
+        res = self.__class__(self.settings, root=self.root)
+        res.adopt(self)
+        return res
+
+    def split(self) -> List["FilePresentation"]:
+        """
+        Return one presentation for each file
+        """
+        res = []
         for fname in self.fnames:
-            os.rename(
-                    os.path.join(self.root, fname),
-                    os.path.join(new_root, fname))
-        self.root = new_root
+            pres = self.__class__(self.settings, root=self.root)
+            pres.add(fname, self.mtime, self.paths.get(fname))
+            res.append(pres)
+        return res
+
+    async def run_slideshow(self, pathnames, delay: int):
+        """
+        Show images fullscreen, changing them every delay seconds.
+
+        feh rereads its file list at each change, so the list of images can be
+        updated with write_filelist while it runs
+        """
+        self.filelist = runtime_path(f"{self.unit}.list")
+        self.write_filelist(pathnames)
+        try:
+            await self.run_player(["feh", "-f", self.filelist, "-F", "-Y", "-D", str(delay), "--reload", str(delay)])
+        finally:
+            os.unlink(self.filelist)
 
+    def write_filelist(self, pathnames):
+        with atomic_writer(self.filelist, "wt", sync=False) as fd:
+            for pathname in pathnames:
+                print(pathname, file=fd)
 
-class PDFPresentation(FilePresentation):
+
+class DeckPresentation(FilePresentation):
+    """
+    Base class for presentations of slide decks, which can be shown as
+    images once they have been rendered
+    """
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # Pathnames of the slides of the most recent file rendered as images,
+        # if available
+        self.slides: Optional[List[str]] = None
+
+    def adopt(self, new: "DeckPresentation"):
+        super().adopt(new)
+        self.slides = new.slides
+
+    def media_pathnames(self) -> List[str]:
+        if self.slides:
+            return list(self.slides)
+        return [self.most_recent_pathname]
+
+    def cycle_time(self) -> Optional[float]:
+        if not self.slides:
+            return None
+        return len(self.slides) * self.settings.pdf_transition_time
+
+    def file_durations(self) -> Optional[List[float]]:
+        if not self.slides:
+            return None
+        return [self.settings.pdf_transition_time] * len(self.slides)
+
+
+class PDFPresentation(DeckPresentation):
     async def _run(self):
         pathname = self.most_recent_pathname
+        if self.slides:
+            log.info("%s: PDF presentation of %d rendered slides", pathname, len(self.slides))
+            await self.run_slideshow(
+                    [self.play_pathname(slide) for slide in self.slides], self.settings.pdf_transition_time)
+            return
         log.info("%s: PDF presentation", pathname)
 
         confdir = os.path.expanduser("~/.config")
@@ -168,39 +553,259 @@ class PDFPresentation(FilePresentation):
         if os.path.isdir(docdata):
             shutil.rmtree(docdata)
 
-        await self.run_player(["okular", "--presentation", "--", self.most_recent_pathname])
+        await self.run_player(["okular", "--presentation", "--", self.play_pathname(self.most_recent_pathname)])
 
 
 class VideoPresentation(FilePresentation):
+    PLAYS_CONTINUOUSLY = True
+
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # Length of the videos in seconds, by file name, when known
+        self.durations: Dict[str, float] = {}
+
+    def adopt(self, new: "VideoPresentation"):
+        super().adopt(new)
+        self.durations = new.durations
+
+    def cycle_time(self) -> Optional[float]:
+        if any(fn not in self.durations for fn in self.fnames):
+            return None
+        return sum(self.durations[fn] for fn in self.fnames)
+
+    def file_durations(self) -> Optional[List[float]]:
+        if any(fn not in self.durations for fn in self.fnames):
+            return None
+        return [self.durations[fn] for fn in self.fnames]
+
     async def _run(self):
         self.fnames.sort()
         log.info("Video presentation of %d videos", len(self.fnames))
+        # Socket of the VLC remote control interface, used to change playlist
+        self.rc_socket = runtime_path(f"{self.unit}.rc")
         with tempfile.NamedTemporaryFile("wt", suffix=".vlc") as tf:
             for pathname in self.pathnames:
-                print(pathname, file=tf)
+                print(self.play_pathname(pathname), file=tf)
             tf.flush()
 
-            await self.run_player(
-                    ["cvlc", "--no-audio", "--loop", "--fullscreen",
-                        "--video-on-top", "--no-video-title-show", tf.name])
+            try:
+                await self.run_player(
+                        ["cvlc", "--no-audio", "--loop", "--fullscreen",
+                            "--video-on-top", "--no-video-title-show",
+                            "--extraintf", "oldrc", "--rc-unix", self.rc_socket, "--rc-fake-tty", tf.name])
+            finally:
+                if os.path.exists(self.rc_socket):
+                    os.unlink(self.rc_socket)
+
+    async def update(self, new: Presentation) -> bool:
+        if type(new) is not type(self) or not self.is_running():
+            return False
+        new.fnames.sort()
+        try:
+            reader, writer = await asyncio.wait_for(asyncio.open_unix_connection(self.rc_socket), 2)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("%s: cannot connect to VLC: %s", self.rc_socket, e)
+            return False
+        try:
+            # add replaces what is playing, enqueue appends to the playlist
+            writer.write(b"clear\n")
+            for idx, pathname in enumerate(new.play_pathname(pathname) for pathname in new.pathnames):
+                writer.write(f"{'enqueue' if idx else 'add'} {pathname}\n".encode())
+            await asyncio.wait_for(writer.drain(), 2)
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("%s: cannot update VLC playlist: %s", self.rc_socket, e)
+            return False
+        finally:
+            writer.close()
+        self.adopt(new)
+        log.info("Video presentation updated to %d videos", len(self.fnames))
+        return True
 
 
 class ImagePresentation(FilePresentation):
+    def __init__(self, *args, **kw):
+        super().__init__(*args, **kw)
+        # Pathnames of versions of the images scaled for the screen, by file
+        # name
+        self.scaled: Dict[str, str] = {}
+        # True if some images are still being scaled
+        self.scaling = False
+
+    def slideshow_pathnames(self):
+        for fn in self.fnames:
+            yield self.play_pathname(self.scaled.get(fn) or self.pathname(fn))
+
+    def adopt(self, new: "ImagePresentation"):
+        super().adopt(new)
+        self.scaled = new.scaled
+        self.scaling = new.scaling
+
+    def media_pathnames(self) -> List[str]:
+        return [self.scaled.get(fn) or self.pathname(fn) for fn in self.fnames]
+
+    def cycle_time(self) -> Optional[float]:
+        return len(self.fnames) * self.settings.photo_transition_time
+
+    def file_durations(self) -> Optional[List[float]]:
+        return [self.settings.photo_transition_time] * len(self.fnames)
+
+    async def update(self, new: Presentation) -> bool:
+        if type(new) is not type(self) or not self.is_running():
+            return False
+        new.fnames.sort()
+        self.adopt(new)
+        self.write_filelist(self.slideshow_pathnames())
+        log.info("Image presentation updated to %d images, %d scaled for the screen",
+                 len(self.fnames), len(self.scaled))
+        return True
+
     async def _run(self):
         self.fnames.sort()
-        log.info("Image presentation of %d images", len(self.fnames))
-        with tempfile.NamedTemporaryFile("wt") as tf:
-            for pathname in self.pathnames:
-                print(pathname, file=tf)
-            tf.flush()
-
-            await self.run_player(["feh", "-f", tf.name, "-F", "-Y", "-D", str(self.settings.photo_transition_time)])
+        log.info("Image presentation of %d images, %d scaled for the screen", len(self.fnames), len(self.scaled))
+        await self.run_slideshow(
+                self.slideshow_pathnames(),
+                self.settings.photo_transition_time)
 
 
-class ODPPresentation(FilePresentation):
+class ODPPresentation(DeckPresentation):
     async def _run(self):
         pathname = self.most_recent_pathname
+        if self.slides:
+            log.info("%s: ODP presentation of %d rendered slides", pathname, len(self.slides))
+            await self.run_slideshow(
+                    [self.play_pathname(slide) for slide in self.slides], self.settings.pdf_transition_time)
+            return
         log.info("%s: ODP presentation", pathname)
         await self.run_player(
                 ["loimpress", "--nodefault", "--norestore", "--nologo", "--nolockcheck", "--show",
-                 os.path.join(self.root, pathname)])
+                 self.play_pathname(pathname)])
+
+
+class TimelinePresentation(Presentation):
+    """
+    Presentation of media of different types one after the other, looping.
+
+    Each item of the timeline is a presentation shown for the time it takes
+    to go through its files once. The player of the next item is started
+    shortly before the current one ends, and the current one is stopped once
+    the next one is on screen. The files of the next item are read ahead while
+    the current one plays.
+    """
+    # Seconds before the end of an item when the player of the next one is
+    # started
+    PRESTART = 2
+
+    def __init__(self, *args, items: List[FilePresentation], **kw):
+        super().__init__(*args, **kw)
+        self.items = items
+        # Running players, with the tasks running them
+        self.running: Dict[FilePresentation, asyncio.Task] = {}
+        # Task going through the timeline
+        self.sequence: Optional[asyncio.Task] = None
+
+    def __bool__(self):
+        return bool(self.items)
+
+    def get_files(self):
+        return [fn for item in self.items for fn in item.get_files()]
+
+    def is_running(self):
+        return any(pres.is_running() for pres in self.running)
+
+    def player_pids(self) -> List[int]:
+        return [pid for pres in self.running for pid in pres.player_pids()]
+
+    def media_pathnames(self) -> List[str]:
+        return [pathname for item in self.items for pathname in item.media_pathnames()]
+
+    def use_staged(self, staged: Dict[str, str]):
+        for item in self.items:
+            item.use_staged(staged)
+
+    def playing(self) -> Presentation:
+        # The first running player is the one on screen, until the next one
+        # has taken its place and it is stopped
+        for pres in self.running:
+            return pres
+        return self
+
+    def item_duration(self, item: FilePresentation) -> float:
+        res = item.cycle_time()
+        if res is None:
+            res = self.settings.timeline_item_duration
+        return res
+
+    async def wait_visible(self, timeout: float) -> bool:
+        deadline = time.monotonic() + timeout
+        while not self.running:
+            if self.finished or time.monotonic() >= deadline:
+                return False
+            await asyncio.sleep(0.2)
+        return await self.playing().wait_visible(deadline - time.monotonic())
+
+    def start_item(self, idx: int):
+        """
+        Start the player of an item, returning its presentation and the task
+        running it
+        """
+        pres = self.items[idx].copy()
+        task = asyncio.create_task(pres.run())
+        self.running[pres] = task
+        task.add_done_callback(lambda task: self.running.pop(pres, None))
+        return pres, task
+
+    async def play(self):
+        idx = 0
+        current, task = self.start_item(idx)
+        try:
+            while True:
+                end = time.monotonic() + self.item_duration(self.items[idx])
+                idx = (idx + 1) % len(self.items)
+                # Read the files of the next item that are not staged in RAM
+                # while this one plays
+                item = self.items[idx]
+                self.loop.run_in_executor(
+                        None, readahead, [p for p in item.media_pathnames() if p not in item.staged])
+                done, pending = await asyncio.wait([task], timeout=max(end - self.PRESTART - time.monotonic(), 0))
+                if done:
+                    log.warning("%s: player exited before the end of its time", current.unit)
+                    return
+
+                upcoming, upcoming_task = self.start_item(idx)
+                if not await upcoming.wait_visible(self.settings.handover_timeout):
+                    if upcoming_task.done():
+                        log.warning("%s: player exited before showing anything", upcoming.unit)
+                        return
+                    log.warning("%s: next player not visible after %ds, switching anyway",
+                             upcoming.unit, self.settings.handover_timeout)
+                    metrics.HANDOVER_TIMEOUTS.inc(type=upcoming.__class__.__name__)
+                if current.is_running():
+                    # Do not leave the player half stopped if we get cancelled
+                    await asyncio.shield(current.stop())
+                current, task = upcoming, upcoming_task
+        finally:
+            for pres, task in list(self.running.items()):
+                if pres.is_running() and pres.quit is None:
+                    await pres.stop()
+            if self.running:
+                await asyncio.wait(list(self.running.values()))
+
+    async def _run(self):
+        if self.quit is not None:
+            return
+        log.info("Timeline presentation of %d items", len(self.items))
+        self.sequence = asyncio.create_task(self.play())
+        try:
+            await self.sequence
+        except asyncio.CancelledError:
+            if self.quit is None:
+                raise
+
+    async def stop(self):
+        log.info("Stopping the timeline presentation")
+        self.quit = self.loop.create_future()
+        if self.sequence is not None:
+            self.sequence.cancel()
+        await self.quit
+        log.info("Timeline presentation stopped")
+        self.quit = None
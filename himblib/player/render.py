@@ -0,0 +1,351 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Set, Tuple
+import asyncio
+import os
+import shlex
+import shutil
+import subprocess
+import logging
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ModuleNotFoundError:
+    PIL = None
+
+if TYPE_CHECKING:
+    from .workers import WorkerPool
+
+log = logging.getLogger(__name__)
+
+# Extensions of the images that converters can produce
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg")
+
+
+def run_converter(command: str, src: str, workdir: str, width: int, height: int, timeout: int) -> bool:
+    """
+    Run a converter command template, returning True if it succeeded
+    """
+    args = {"src": src, "workdir": workdir, "width": width, "height": height, "size": max(width, height)}
+    cmd = [arg.format(**args) for arg in shlex.split(command)]
+    try:
+        res = subprocess.run(
+                cmd, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                text=True, timeout=timeout)
+    except (OSError, subprocess.TimeoutExpired) as e:
+        log.warning("%s: cannot render with %s: %s", src, cmd[0], e)
+        return False
+    if res.returncode != 0:
+        log.warning("%s: cannot render with %s: %s", src, cmd[0], res.stderr.strip())
+        return False
+    return True
+
+
+def render_deck(src: str, dest: str, type: str, width: int, height: int,
+                commands: Dict[str, str], timeout: int = 600) -> bool:
+    """
+    Render the slides of a PDF or ODP file into images in the directory dest.
+
+    commands maps a media type to the converter command template to use. A
+    converter can produce images directly, or a PDF, which is then rendered
+    with the "pdf" converter.
+
+    This is run in a worker process. Return False if the deck could not be
+    rendered.
+    """
+    command = commands.get(type)
+    if not command:
+        return False
+
+    workdir = dest + ".tmp"
+    if os.path.exists(workdir):
+        shutil.rmtree(workdir)
+    os.makedirs(workdir)
+    try:
+        if not run_converter(command, src, workdir, width, height, timeout):
+            return False
+
+        outputs = [fn for fn in os.listdir(workdir) if os.path.isfile(os.path.join(workdir, fn))]
+        pdfs = [fn for fn in outputs if fn.endswith(".pdf")]
+        if type != "pdf" and pdfs:
+            pdf = os.path.join(workdir, pdfs[0])
+            if not commands.get("pdf") or not run_converter(commands["pdf"], pdf, workdir, width, height, timeout):
+                return False
+            outputs = [fn for fn in os.listdir(workdir) if os.path.isfile(os.path.join(workdir, fn))]
+
+        # Keep only the rendered pages
+        pages = 0
+        for fn in outputs:
+            if fn.lower().endswith(IMAGE_EXTENSIONS):
+                pages += 1
+            else:
+                os.unlink(os.path.join(workdir, fn))
+        for de in os.scandir(workdir):
+            if de.is_dir():
+                shutil.rmtree(de.path)
+        if not pages:
+            log.warning("%s: rendering produced no images", src)
+            return False
+
+        os.rename(workdir, dest)
+        return True
+    finally:
+        if os.path.exists(workdir):
+            shutil.rmtree(workdir)
+
+
+class RenderCache:
+    """
+    On-disk cache of PDF and ODP decks rendered as images at screen
+    resolution, keyed by the sha256 of the deck and the screen geometry.
+
+    Decks are rendered in the background, and listeners are notified when a
+    rendering is ready.
+    """
+    # Media types that can be rendered
+    TYPES = ("pdf", "odp")
+
+    def __init__(self, root: str, workers: WorkerPool,
+                 get_geometry: Callable[[], Tuple[int, int]], get_commands: Callable[[], Dict[str, str]]):
+        """
+        :arg root: directory where rendered decks are stored
+        :arg workers: worker pool used for rendering
+        :arg get_geometry: function returning the (width, height) of the
+                           screen
+        :arg get_commands: function returning a dict mapping media types to
+                           converter command templates
+        """
+        self.root = root
+        self.workers = workers
+        self.get_geometry = get_geometry
+        self.get_commands = get_commands
+        # Renderings in progress
+        self.pending: Dict[str, asyncio.Task] = {}
+        # Functions called when a rendering becomes available
+        self.listeners: List[Callable[[], None]] = []
+        self.cleanup()
+
+    def cleanup(self):
+        """
+        Remove leftovers of interrupted renderings
+        """
+        if not os.path.isdir(self.root):
+            return
+        for de in os.scandir(self.root):
+            if de.name.endswith(".tmp"):
+                shutil.rmtree(de.path)
+
+    def get_key(self, sha256: str) -> str:
+        width, height = self.get_geometry()
+        return f"{sha256}-{width}x{height}"
+
+    def get(self, sha256: str) -> Optional[List[str]]:
+        """
+        Return the pathnames of the rendered slides of a deck, or None if it
+        has not been rendered
+        """
+        path = os.path.join(self.root, self.get_key(sha256))
+        try:
+            names = sorted(os.listdir(path))
+        except FileNotFoundError:
+            return None
+        return [os.path.join(path, name) for name in names]
+
+    def request(self, pathname: str, sha256: str, type: str):
+        """
+        Start rendering a deck in the background, if it is not already being
+        rendered
+        """
+        if type not in self.TYPES or not self.get_commands().get(type):
+            return
+        key = self.get_key(sha256)
+        if key in self.pending:
+            return
+        self.pending[key] = asyncio.create_task(self.render(key, pathname, type))
+
+    async def render(self, key: str, pathname: str, type: str):
+        width, height = self.get_geometry()
+        log.info("%s: rendering at %dx%d", pathname, width, height)
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            res = await self.workers.run(
+                    render_deck, pathname, os.path.join(self.root, key), type, width, height, self.get_commands())
+        except Exception:
+            log.exception("%s: rendering failed", pathname)
+            res = False
+        finally:
+            del self.pending[key]
+
+        if not res:
+            return
+        log.info("%s: rendering complete", pathname)
+        for listener in self.listeners:
+            listener()
+
+    def prune(self, keep: Iterable[str]):
+        """
+        Remove renderings of decks whose sha256 is not in keep
+        """
+        if not os.path.isdir(self.root):
+            return
+        keep = set(keep)
+        for de in os.scandir(self.root):
+            if de.name.endswith(".tmp") or de.name in self.pending:
+                continue
+            sha256 = de.name.split("-", 1)[0]
+            if sha256 not in keep:
+                shutil.rmtree(de.path)
+
+
+def make_display_image(src: str, dest_base: str, width: int, height: int) -> Optional[str]:
+    """
+    Scale an image to fit a screen of the given size, applying EXIF rotation.
+
+    The result is written to dest_base plus an extension, which is returned.
+    Return "" if the original can be shown as it is, or None if the image
+    could not be read.
+
+    This is run in a worker process.
+    """
+    if PIL is None:
+        log.warning("install python3-pil to scale images for the screen")
+        return None
+    try:
+        with PIL.Image.open(src) as img:
+            # EXIF orientation tag
+            rotated = img.getexif().get(0x0112, 1) != 1
+            if not rotated and img.width <= width and img.height <= height:
+                return ""
+            # Let the JPEG decoder skip detail that we would throw away
+            img.draft("RGB", (width, height))
+            img = PIL.ImageOps.exif_transpose(img)
+            img.thumbnail((width, height), PIL.Image.LANCZOS)
+            if img.mode in ("RGBA", "LA") or "transparency" in img.info:
+                ext, format, kw = ".png", "PNG", {}
+            else:
+                ext, format, kw = ".jpg", "JPEG", {"quality": 90}
+                img = img.convert("RGB")
+            tmp = dest_base + ".tmp"
+            img.save(tmp, format, **kw)
+    except Exception as e:
+        log.warning("%s: cannot scale image: %s", src, e)
+        return None
+    os.rename(tmp, dest_base + ext)
+    return ext
+
+
+class DisplayImageCache:
+    """
+    On-disk cache of images scaled to the screen resolution, keyed by the
+    sha256 of the original and the screen geometry.
+
+    Images are scaled in the background, and listeners are notified when a
+    batch of requested images is ready.
+    """
+    def __init__(self, root: str, workers: WorkerPool, get_geometry: Callable[[], Tuple[int, int]]):
+        """
+        :arg root: directory where scaled images are stored
+        :arg workers: worker pool used for scaling
+        :arg get_geometry: function returning the (width, height) of the
+                           screen
+        """
+        self.root = root
+        self.workers = workers
+        self.get_geometry = get_geometry
+        # File name in root by key. An empty name means that the original
+        # image does not need scaling
+        self.entries: Dict[str, str] = {}
+        # Keys being scaled
+        self.pending: Set[str] = set()
+        # Functions called when requested images become available
+        self.listeners: List[Callable[[], None]] = []
+        self.load()
+
+    def load(self):
+        """
+        Index the existing cache contents
+        """
+        if not os.path.isdir(self.root):
+            return
+        for de in os.scandir(self.root):
+            if de.name.endswith(".tmp"):
+                os.unlink(de.path)
+                continue
+            key, ext = os.path.splitext(de.name)
+            if ext == ".orig":
+                self.entries[key] = ""
+            else:
+                self.entries[key] = de.name
+
+    def get_key(self, sha256: str) -> str:
+        width, height = self.get_geometry()
+        return f"{sha256}-{width}x{height}"
+
+    def get(self, pathname: str, sha256: str) -> Optional[str]:
+        """
+        Return the pathname of the image to show for pathname, or None if it
+        has not been processed yet
+        """
+        name = self.entries.get(self.get_key(sha256))
+        if name is None:
+            return None
+        if not name:
+            return pathname
+        return os.path.join(self.root, name)
+
+    def request(self, images: Iterable[Tuple[str, str]]):
+        """
+        Start scaling the given (pathname, sha256) images in the background,
+        skipping those already available or pending
+        """
+        todo = []
+        for pathname, sha256 in images:
+            key = self.get_key(sha256)
+            if key in self.entries or key in self.pending:
+                continue
+            self.pending.add(key)
+            todo.append((key, pathname))
+        if todo:
+            asyncio.create_task(self.scale(todo))
+
+    async def scale(self, todo: List[Tuple[str, str]]):
+        width, height = self.get_geometry()
+        log.info("scaling %d images to %dx%d", len(todo), width, height)
+        os.makedirs(self.root, exist_ok=True)
+        # Submit the whole batch: the pool scales as many images at a time as
+        # it has workers
+        results = await asyncio.gather(
+                *(self.workers.run(make_display_image, pathname, os.path.join(self.root, key), width, height)
+                  for key, pathname in todo),
+                return_exceptions=True)
+        for (key, pathname), ext in zip(todo, results):
+            self.pending.discard(key)
+            if isinstance(ext, BaseException):
+                log.error("%s: scaling failed", pathname, exc_info=ext)
+                ext = None
+            if ext is None:
+                # Show the original, without trying again until restart
+                self.entries[key] = ""
+            elif ext:
+                self.entries[key] = key + ext
+            else:
+                # Remember that the original is fine as it is
+                with open(os.path.join(self.root, key + ".orig"), "wb"):
+                    pass
+                self.entries[key] = ""
+
+        for listener in self.listeners:
+            listener()
+
+    def prune(self, keep: Iterable[str]):
+        """
+        Remove scaled images whose original sha256 is not in keep
+        """
+        keep = set(keep)
+        for key, name in list(self.entries.items()):
+            if key.split("-", 1)[0] in keep:
+                continue
+            del self.entries[key]
+            try:
+                os.unlink(os.path.join(self.root, name or key + ".orig"))
+            except FileNotFoundError:
+                pass
@@ -0,0 +1,133 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Deque, Dict, Optional
+from collections import deque
+import time
+import logging
+
+if TYPE_CHECKING:
+    from ..settings import PlayerSettings
+    from .presentation import Presentation
+    from .sampler import SystemSampler
+
+log = logging.getLogger(__name__)
+
+
+class RestartPolicy:
+    """
+    Decide how to restart players that exit by themselves.
+
+    The times of player exits are kept for each media source over a sliding
+    window. Each exit in the window doubles the delay before the next restart,
+    up to a ceiling, and a source with too many exits in the window is
+    considered broken until they age out of it.
+    """
+    # Delay before restarting after the first exit, in seconds
+    BASE_DELAY = 1
+
+    def __init__(self, settings: PlayerSettings):
+        self.settings = settings
+        # Exit times by source, as time.monotonic()
+        self.exits: Dict[str, Deque[float]] = {}
+
+    def recent_exits(self, source: str) -> int:
+        """
+        Return how many times players for source exited within the window
+        """
+        exits = self.exits.get(source)
+        if exits is None:
+            return 0
+        cutoff = time.monotonic() - self.settings.restart_window
+        while exits and exits[0] < cutoff:
+            exits.popleft()
+        if not exits:
+            del self.exits[source]
+            return 0
+        return len(exits)
+
+    def failing(self, source: str) -> bool:
+        """
+        Check if players for source exited too often to try them again
+        """
+        limit = self.settings.restart_limit
+        return limit > 0 and self.recent_exits(source) >= limit
+
+    def record_exit(self, source: str) -> float:
+        """
+        Record that a player for source exited, and return how many seconds
+        to wait before restarting it.
+
+        There is no wait once the source is failing, since the restart will
+        use something else
+        """
+        self.exits.setdefault(source, deque()).append(time.monotonic())
+        if self.failing(source):
+            return 0
+        count = self.recent_exits(source)
+        return min(self.BASE_DELAY * 2 ** (count - 1), self.settings.restart_max_delay)
+
+
+class HangDetector:
+    """
+    Detect players that are running but stuck, from the CPU and memory usage
+    of their processes collected by the system sampler
+    """
+    # CPU usage, in percent of one core, of a player that is not working
+    STALLED_CPU = 1.0
+    # CPU usage, in percent of one core, of a player stuck in a loop
+    SPINNING_CPU = 90.0
+
+    def __init__(self, sampler: SystemSampler, settings: PlayerSettings):
+        self.sampler = sampler
+        self.settings = settings
+        # Presentation being watched
+        self.pres: Optional[Presentation] = None
+        # When the current symptom was first seen, as time.monotonic()
+        self.since: Optional[float] = None
+
+    def symptom(self, pres: Presentation) -> Optional[str]:
+        """
+        Return a description of what looks wrong with the player right now,
+        or None if it looks fine
+        """
+        procs = [self.sampler.processes[pid] for pid in pres.player_pids() if pid in self.sampler.processes]
+        if not procs:
+            return None
+
+        sample = self.sampler.latest
+        limit = self.settings.player_memory_limit
+        rss = sum(p.rss for p in procs)
+        if sample is not None and sample.mem_total and limit > 0 and rss * 100 > sample.mem_total * limit:
+            return f"using {rss // (1024 * 1024)}MiB of memory"
+
+        cpu = sum(p.cpu_percent for p in procs)
+        if pres.PLAYS_CONTINUOUSLY and cpu < self.STALLED_CPU:
+            return "not using CPU"
+        if not pres.PLAYS_CONTINUOUSLY and cpu > self.SPINNING_CPU:
+            return f"using {cpu:.0f}% CPU"
+        return None
+
+    def check(self, pres: Presentation) -> Optional[str]:
+        """
+        Return the reason why pres is hung, or None if it is not.
+
+        A player is hung if it showed a symptom in all samples taken over the
+        hang timeout
+        """
+        timeout = self.settings.hang_timeout
+        if pres is not self.pres:
+            self.pres = pres
+            self.since = None
+        if timeout <= 0:
+            return None
+
+        symptom = self.symptom(pres)
+        if symptom is None:
+            self.since = None
+            return None
+        now = time.monotonic()
+        if self.since is None:
+            self.since = now
+        if now - self.since < timeout:
+            return None
+        self.since = None
+        return f"{symptom} for {timeout}s"
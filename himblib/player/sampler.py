@@ -0,0 +1,254 @@
+from __future__ import annotations
+from typing import Dict, List, Optional
+from collections import deque
+import asyncio
+import os
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+
+# Mount points of the unified cgroup hierarchy: the second one is used by
+# systems in hybrid mode
+CGROUP_V2_MOUNTS = ("/sys/fs/cgroup", "/sys/fs/cgroup/unified")
+
+
+def read_file(pathname: str) -> Optional[str]:
+    """
+    Read a small text file from /proc or /sys, returning None if it does not
+    exist anymore
+    """
+    try:
+        with open(pathname, "rt") as fd:
+            return fd.read()
+    except (FileNotFoundError, ProcessLookupError, PermissionError):
+        return None
+
+
+def cgroup_v2_dirs(relpath: str) -> List[str]:
+    """
+    Return the possible directories of a cgroup of the unified hierarchy,
+    given its path as found in /proc/[pid]/cgroup
+    """
+    relpath = relpath.lstrip("/")
+    return [os.path.join(mount, relpath) for mount in CGROUP_V2_MOUNTS]
+
+
+def find_cgroup_v2_dir(relpath: str) -> Optional[str]:
+    """
+    Return the directory of a cgroup of the unified hierarchy, or None if it
+    does not exist
+    """
+    for path in cgroup_v2_dirs(relpath):
+        if os.path.isdir(path):
+            return path
+    return None
+
+
+class ProcessInfo:
+    """
+    Resource usage of a process, from /proc/[pid]/stat
+    """
+    def __init__(self, pid: int, stat: str):
+        self.pid = pid
+        # The command name is in parentheses, and can itself contain spaces
+        # and parentheses
+        head, tail = stat.rsplit(")", 1)
+        self.comm = head.split("(", 1)[1]
+        fields = tail.split()
+        self.state = fields[0]
+        # CPU time in clock ticks
+        self.cpu_ticks = int(fields[11]) + int(fields[12])
+        self.starttime = int(fields[19])
+        self.rss = int(fields[21]) * PAGE_SIZE
+        # Filled by the sampler
+        self.cmdline = self.comm
+        self.cpu_percent = 0.0
+        self.mem_percent = 0.0
+
+
+class Sample:
+    """
+    System-wide resource usage at a given time
+    """
+    def __init__(self):
+        self.time = time.time()
+        self.uptime = 0.0
+        self.loadavg = (0.0, 0.0, 0.0)
+        # (busy, total) CPU clock ticks
+        self.cpu_ticks = (0, 0)
+        self.cpu_percent = 0.0
+        # Contents of /proc/meminfo, in bytes
+        self.meminfo: Dict[str, int] = {}
+        # Processes in the player slice
+        self.player_pids: List[int] = []
+        # Memory used by the player slice, if available
+        self.player_memory: Optional[int] = None
+
+    @property
+    def mem_total(self) -> int:
+        return self.meminfo.get("MemTotal", 0)
+
+    @property
+    def mem_used(self) -> int:
+        return self.mem_total - self.meminfo.get("MemAvailable", 0)
+
+
+class SystemSampler:
+    """
+    Periodically sample system resource usage from /proc and the player cgroup,
+    keeping a time series of the results in memory
+    """
+    def __init__(self, interval: float = 5, history: int = 720, slice_name: str = "himblick-player.slice"):
+        """
+        :arg interval: seconds between samples
+        :arg history: number of samples to keep
+        :arg slice_name: name of the systemd slice where players are run
+        """
+        self.interval = interval
+        self.samples = deque(maxlen=history)
+        self.cgroup_dirs = self.find_cgroup_dirs(slice_name)
+        # Process table from the last sample
+        self.processes: Dict[int, ProcessInfo] = {}
+        self.task: Optional[asyncio.Task] = None
+
+    def find_cgroup_dirs(self, slice_name: str) -> List[str]:
+        """
+        Return the possible locations of the player slice in the cgroup
+        hierarchy.
+
+        The players are run with systemd-run --user, so the slice is in the
+        user manager, and nested according to the dashes in its name
+        """
+        uid = os.getuid()
+        path = [f"user.slice/user-{uid}.slice/user@{uid}.service"]
+        name = slice_name[:-len(".slice")]
+        parts = name.split("-")
+        for idx in range(1, len(parts) + 1):
+            path.append("-".join(parts[:idx]) + ".slice")
+        relpath = os.path.join(*path)
+        return cgroup_v2_dirs(relpath) + [os.path.join("/sys/fs/cgroup/memory", relpath)]
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        loop = asyncio.get_event_loop()
+        while True:
+            try:
+                sample, processes = await loop.run_in_executor(None, self.sample)
+            except Exception:
+                log.exception("cannot sample system status")
+            else:
+                self.samples.append(sample)
+                self.processes = processes
+            await asyncio.sleep(self.interval)
+
+    @property
+    def latest(self) -> Optional[Sample]:
+        if not self.samples:
+            return None
+        return self.samples[-1]
+
+    def sample(self):
+        """
+        Read the current system status.
+
+        This is run in a worker thread, and only reads the previous state
+        """
+        res = Sample()
+        prev = self.latest
+
+        uptime = read_file("/proc/uptime")
+        if uptime:
+            res.uptime = float(uptime.split()[0])
+
+        loadavg = read_file("/proc/loadavg")
+        if loadavg:
+            res.loadavg = tuple(float(x) for x in loadavg.split()[:3])
+
+        stat = read_file("/proc/stat")
+        if stat:
+            for line in stat.splitlines():
+                if line.startswith("cpu "):
+                    ticks = [int(x) for x in line.split()[1:]]
+                    # idle and iowait are not busy time
+                    total = sum(ticks)
+                    res.cpu_ticks = (total - ticks[3] - ticks[4], total)
+                    break
+        if prev is not None and res.cpu_ticks[1] > prev.cpu_ticks[1]:
+            res.cpu_percent = (
+                    100.0 * (res.cpu_ticks[0] - prev.cpu_ticks[0])
+                    / (res.cpu_ticks[1] - prev.cpu_ticks[1]))
+
+        meminfo = read_file("/proc/meminfo")
+        if meminfo:
+            for line in meminfo.splitlines():
+                name, value = line.split(":", 1)
+                value = value.split()
+                res.meminfo[name] = int(value[0]) * (1024 if len(value) > 1 else 1)
+
+        processes = self.sample_processes(res, prev)
+
+        pids = set()
+        for cgroup_dir in self.cgroup_dirs:
+            # Players run in scopes below the slice: under cgroup v2 the
+            # slice itself cannot contain processes
+            for root, dirs, files in os.walk(cgroup_dir):
+                procs = read_file(os.path.join(root, "cgroup.procs"))
+                if procs:
+                    pids.update(int(x) for x in procs.split())
+            if res.player_memory is None:
+                memory = (read_file(os.path.join(cgroup_dir, "memory.current"))
+                          or read_file(os.path.join(cgroup_dir, "memory.usage_in_bytes")))
+                if memory:
+                    res.player_memory = int(memory)
+        res.player_pids = sorted(pids)
+
+        return res, processes
+
+    def sample_processes(self, res: Sample, prev: Optional[Sample]) -> Dict[int, ProcessInfo]:
+        processes = {}
+        elapsed = res.time - prev.time if prev is not None else 0
+        for de in os.scandir("/proc"):
+            if not de.name.isdigit():
+                continue
+            pid = int(de.name)
+            stat = read_file(os.path.join(de.path, "stat"))
+            if stat is None:
+                continue
+            info = ProcessInfo(pid, stat)
+
+            old = self.processes.get(pid)
+            if old is not None and old.starttime == info.starttime:
+                # Only read the command line of new processes
+                info.cmdline = old.cmdline
+                if elapsed > 0:
+                    info.cpu_percent = 100.0 * (info.cpu_ticks - old.cpu_ticks) / CLOCK_TICKS / elapsed
+            else:
+                cmdline = read_file(os.path.join(de.path, "cmdline"))
+                if cmdline:
+                    info.cmdline = cmdline.replace("\0", " ").strip()
+
+            if res.mem_total:
+                info.mem_percent = 100.0 * info.rss / res.mem_total
+            processes[pid] = info
+        return processes
+
+    def top(self, key: str = "cpu_percent", limit: int = 30) -> List[ProcessInfo]:
+        """
+        Return the processes using most of the given resource
+        """
+        return sorted(self.processes.values(), key=lambda p: getattr(p, key), reverse=True)[:limit]
+
+    def player_processes(self) -> List[ProcessInfo]:
+        """
+        Return the processes running in the player slice
+        """
+        sample = self.latest
+        if sample is None:
+            return []
+        return [self.processes[pid] for pid in sample.player_pids if pid in self.processes]
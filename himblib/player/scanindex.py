@@ -0,0 +1,131 @@
+from __future__ import annotations
+from typing import Dict, List, Optional, Callable
+import json
+import os
+import logging
+from ..utils import atomic_writer
+
+log = logging.getLogger(__name__)
+
+
+class ScanEntry:
+    """
+    What we know about a file in a media directory
+    """
+    def __init__(self, name: str, ino: int, size: int, mtime: float, type: Optional[str]):
+        self.name = name
+        self.ino = ino
+        self.size = size
+        self.mtime = mtime
+        # Media type, as returned by classify()
+        self.type = type
+
+    def to_json(self):
+        return {"ino": self.ino, "size": self.size, "mtime": self.mtime, "type": self.type}
+
+    @classmethod
+    def from_json(cls, name: str, data):
+        return cls(name, data["ino"], data["size"], data["mtime"], data["type"])
+
+
+class ScanIndex:
+    """
+    Persistent index of the files in a media directory.
+
+    Files are only examined again if their inode, size or modification time
+    changed since the last scan. If the directory itself has not been
+    modified and contains the same names, the previous results are reused
+    without looking at the files at all.
+
+    The index is kept in a hidden subdirectory, so that writing it does not
+    change the modification time of the directory.
+    """
+    DIR_NAME = ".himblick"
+    FILE_NAME = "index.json"
+    # Where older versions kept the index
+    OLD_FILE_NAME = ".himblick-index.json"
+
+    # Increase when the way files are classified changes, to examine them
+    # again
+    VERSION = 2
+
+    def __init__(self, path: str, classify: Callable[[str], Optional[str]]):
+        """
+        :arg path: directory to index
+        :arg classify: function computing the media type of a file, given its
+                       pathname
+        """
+        self.path = path
+        self.classify = classify
+        self.index_dir = os.path.join(self.path, self.DIR_NAME)
+        self.pathname = os.path.join(self.index_dir, self.FILE_NAME)
+        # Modification time of the directory when the index was last updated
+        self.dir_mtime: Optional[int] = None
+        self.entries: Dict[str, ScanEntry] = {}
+        self.loaded = False
+
+    def load(self):
+        self.loaded = True
+        try:
+            os.unlink(os.path.join(self.path, self.OLD_FILE_NAME))
+        except FileNotFoundError:
+            pass
+        try:
+            with open(self.pathname, "rt") as fd:
+                data = json.load(fd)
+        except FileNotFoundError:
+            return
+        except ValueError as e:
+            log.warning("%s: ignoring corrupted scan index: %s", self.pathname, e)
+            return
+        if data.get("version") != self.VERSION:
+            log.info("%s: scan index is outdated, rebuilding it", self.pathname)
+            return
+        self.dir_mtime = data.get("dir_mtime")
+        self.entries = {name: ScanEntry.from_json(name, entry) for name, entry in data["entries"].items()}
+
+    def save(self):
+        try:
+            with atomic_writer(self.pathname, "wt", sync=False) as fd:
+                json.dump({
+                    "version": self.VERSION,
+                    "dir_mtime": self.dir_mtime,
+                    "entries": {name: entry.to_json() for name, entry in self.entries.items()},
+                }, fd)
+        except OSError as e:
+            log.warning("%s: cannot save scan index: %s", self.pathname, e)
+
+    def scan(self) -> List[ScanEntry]:
+        """
+        Return the list of files in the directory
+        """
+        if not self.loaded:
+            self.load()
+
+        # Create the index directory before taking the modification time,
+        # since creating it changes it
+        try:
+            os.makedirs(self.index_dir, exist_ok=True)
+        except OSError as e:
+            log.warning("%s: cannot create index directory: %s", self.index_dir, e)
+
+        dir_mtime = os.stat(self.path).st_mtime_ns
+        with os.scandir(self.path) as it:
+            dir_entries = [de for de in it if not de.name.startswith(".") and de.is_file()]
+
+        if dir_mtime == self.dir_mtime and {de.name for de in dir_entries} == self.entries.keys():
+            return list(self.entries.values())
+
+        entries = {}
+        for de in dir_entries:
+            st = de.stat()
+            old = self.entries.get(de.name)
+            if (old is not None and old.ino == de.inode()
+                    and old.size == st.st_size and old.mtime == st.st_mtime):
+                entries[de.name] = old
+            else:
+                entries[de.name] = ScanEntry(de.name, de.inode(), st.st_size, st.st_mtime, self.classify(de.path))
+        self.entries = entries
+        self.dir_mtime = dir_mtime
+        self.save()
+        return list(entries.values())
@@ -0,0 +1,251 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Callable, FrozenSet, Iterator, List, Optional, Tuple
+import asyncio
+import datetime
+import heapq
+import itertools
+import re
+import logging
+
+if TYPE_CHECKING:
+    from ..settings import PlayerSettings
+
+log = logging.getLogger(__name__)
+
+WEEKDAYS = ("mon", "tue", "wed", "thu", "fri", "sat", "sun")
+
+
+def parse_day(name: str) -> int:
+    try:
+        return WEEKDAYS.index(name[:3])
+    except ValueError:
+        raise ValueError(f"{name!r} is not a day of the week") from None
+
+
+def parse_days(value: str) -> FrozenSet[int]:
+    """
+    Parse a list of weekdays like "mon-fri sat", returning their numbers as
+    in datetime.weekday()
+    """
+    res = set()
+    for token in re.split(r"[\s,]+", value.strip().lower()):
+        if not token:
+            continue
+        if "-" in token:
+            first, last = token.split("-", 1)
+            first, last = parse_day(first), parse_day(last)
+            day = first
+            while True:
+                res.add(day)
+                if day == last:
+                    break
+                day = (day + 1) % 7
+        else:
+            res.add(parse_day(token))
+    return frozenset(res)
+
+
+def parse_time(value: str) -> datetime.time:
+    return datetime.datetime.strptime(value.strip(), "%H:%M").time()
+
+
+class ScheduleRule:
+    """
+    Content to show every day in a time window, on some days of the week.
+
+    A window ending at or before its start time ends the next day, and one
+    that starts and ends at the same time lasts the whole day
+    """
+    def __init__(self, name: str, days: FrozenSet[int], start: datetime.time, end: datetime.time,
+                 media: Optional[str] = None, generation: Optional[str] = None):
+        self.name = name
+        self.days = days
+        self.start = start
+        self.end = end
+        # Subdirectory of the media directory with the content to show
+        self.media = media
+        # Name of the generation in the media store with the content to show
+        self.generation = generation
+
+    def __str__(self):
+        return self.name
+
+    def __eq__(self, other):
+        return isinstance(other, ScheduleRule) and self.key() == other.key()
+
+    def __hash__(self):
+        return hash(self.key())
+
+    def key(self):
+        return (self.name, self.days, self.start, self.end, self.media, self.generation)
+
+    @classmethod
+    def from_config(cls, name: str, section) -> "ScheduleRule":
+        """
+        Create a rule from a [schedule name] section of himblick.conf, raising
+        ValueError if it is invalid
+        """
+        days = parse_days(section.get("days", " ".join(WEEKDAYS)))
+        if not days:
+            raise ValueError("no days given")
+        start = parse_time(section.get("start", "00:00"))
+        end = parse_time(section.get("end", "00:00"))
+        media = section.get("media", "").strip() or None
+        generation = section.get("generation", "").strip() or None
+        if (media is None) == (generation is None):
+            raise ValueError("one of media or generation is needed")
+        if media is not None and (media.startswith(".") or "/" in media):
+            raise ValueError(f"{media!r} is not a subdirectory of the media directory")
+        return cls(name, days, start, end, media=media, generation=generation)
+
+    def windows(self, after: datetime.datetime) -> Iterator[Tuple[datetime.datetime, datetime.datetime]]:
+        """
+        Generate the (begin, end) time windows of the rule that end after the
+        given time, in the following week
+        """
+        for offset in range(-1, 8):
+            day = after.date() + datetime.timedelta(days=offset)
+            if day.weekday() not in self.days:
+                continue
+            begin = datetime.datetime.combine(day, self.start)
+            end = datetime.datetime.combine(day, self.end)
+            if end <= begin:
+                end += datetime.timedelta(days=1)
+            if end > after:
+                yield begin, end
+
+    def is_active(self, now: datetime.datetime) -> bool:
+        return any(begin <= now for begin, end in self.windows(now))
+
+    def next_begin(self, after: datetime.datetime) -> Optional[datetime.datetime]:
+        return min((begin for begin, end in self.windows(after) if begin > after), default=None)
+
+    def next_end(self, after: datetime.datetime) -> Optional[datetime.datetime]:
+        return min((end for begin, end in self.windows(after)), default=None)
+
+
+def load_rules(settings: PlayerSettings) -> List[ScheduleRule]:
+    """
+    Read the schedule rules from the player settings, skipping invalid ones
+    """
+    res = []
+    for name, section in settings.schedule:
+        try:
+            res.append(ScheduleRule.from_config(name, section))
+        except ValueError as e:
+            log.warning("%s: schedule %s: ignoring invalid rule: %s", settings.pathname, name, e)
+    return res
+
+
+class Scheduler:
+    """
+    Keep track of the times when schedule rules begin and end, sleeping until
+    the next one.
+
+    Transitions are kept in a heap, with for each rule its next begin and end,
+    and the time to stage the content of its next window. When one is
+    reached, it is replaced with the following one for the same rule.
+    """
+    # Longest time to sleep, in seconds, so that changes to the system clock
+    # are noticed
+    MAX_SLEEP = 3600
+
+    def __init__(self, on_switch: Callable[[ScheduleRule], None], on_stage: Callable[[ScheduleRule], None]):
+        """
+        :arg on_switch: function called when a rule begins or ends
+        :arg on_stage: function called when the content of a rule should be
+                       prepared, before the rule begins
+        """
+        self.on_switch = on_switch
+        self.on_stage = on_stage
+        # Rules in order of priority
+        self.rules: List[ScheduleRule] = []
+        # Seconds before the beginning of a rule when its content is staged
+        self.stage_ahead = datetime.timedelta(0)
+        # (time, sequence, kind, rule, begin) of the upcoming transitions.
+        # begin is the beginning of the window that a stage transition is for
+        self.heap: List[Tuple[datetime.datetime, int, str, ScheduleRule, Optional[datetime.datetime]]] = []
+        self.sequence = itertools.count()
+        self.changed = asyncio.Event()
+        self.task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def set_rules(self, rules: List[ScheduleRule], stage_ahead: int):
+        """
+        Replace the schedule rules, rebuilding the transitions if they changed
+        """
+        stage_ahead = datetime.timedelta(seconds=stage_ahead)
+        if rules == self.rules and stage_ahead == self.stage_ahead:
+            return
+        self.rules = rules
+        self.stage_ahead = stage_ahead
+        self.heap = []
+        now = datetime.datetime.now()
+        for rule in rules:
+            self.push(rule, "end", now)
+            self.push(rule, "begin", now)
+            self.push(rule, "stage", now)
+        log.info("schedule: %d rules", len(rules))
+        self.changed.set()
+
+    def push(self, rule: ScheduleRule, kind: str, after: datetime.datetime):
+        """
+        Add the next transition of the given kind for a rule after the given
+        time
+        """
+        begin = None
+        if kind == "end":
+            when = rule.next_end(after)
+        elif kind == "begin":
+            when = rule.next_begin(after)
+        else:
+            begin = rule.next_begin(after)
+            when = begin - self.stage_ahead if begin is not None else None
+            # If the staging time is already past, stage right away
+            if when is not None and when < after:
+                when = after
+        if when is None:
+            return
+        heapq.heappush(self.heap, (when, next(self.sequence), kind, rule, begin))
+
+    def active_rule(self) -> Optional[ScheduleRule]:
+        """
+        Return the rule in effect now, if any
+        """
+        now = datetime.datetime.now()
+        for rule in self.rules:
+            if rule.is_active(now):
+                return rule
+        return None
+
+    async def run(self):
+        while True:
+            self.changed.clear()
+            now = datetime.datetime.now()
+            delay = self.MAX_SLEEP
+            if self.heap:
+                delay = min(delay, (self.heap[0][0] - now).total_seconds())
+            if delay > 0:
+                try:
+                    await asyncio.wait_for(self.changed.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            when, seq, kind, rule, begin = heapq.heappop(self.heap)
+            # Look for the following transition starting from now, so that
+            # a jump forward of the clock does not replay missed ones
+            if kind == "stage":
+                self.push(rule, kind, max(begin, now))
+            else:
+                self.push(rule, kind, now)
+            log.info("schedule: %s: %s", rule, kind)
+            try:
+                if kind == "stage":
+                    self.on_stage(rule)
+                else:
+                    self.on_switch(rule)
+            except Exception:
+                log.exception("schedule: %s: cannot handle %s", rule, kind)
@@ -1,11 +1,15 @@
 from __future__ import annotations
-from typing import TYPE_CHECKING, Set
+from typing import TYPE_CHECKING, Dict, Optional
+import asyncio
 import logging
 import json
 import os
+import re
 import time
 import datetime
-import subprocess
+import calendar
+import mimetypes
+import email.utils
 from collections import deque
 import tornado.web
 from tornado.web import url
@@ -13,8 +17,13 @@ import tornado.httpserver
 import tornado.netutil
 import tornado.websocket
 import tornado.ioloop
+import tornado.iostream
 from tornado.escape import xhtml_escape
 from .static import StaticFileHandler
+from .broadcast import Broadcaster
+from . import metrics
+from .thumbnails import ThumbnailCache
+from . import upload
 
 
 if TYPE_CHECKING:
@@ -36,7 +45,7 @@ class Socket(tornado.websocket.WebSocketHandler):
         try:
             data = json.loads(message)
         except Exception as e:
-            log.warn("Cannot decode incoming ws message %r: %s", message, e)
+            log.warning("Cannot decode incoming ws message %r: %s", message, e)
             return
 
         command = data.get("command")
@@ -45,10 +54,22 @@ class Socket(tornado.websocket.WebSocketHandler):
 
         if self.is_admin:
             if command == "reload_media":
-                self.application.player.command_queue.put_nowait("rescan")
+                self.application.player.commands.put("rescan", "websocket", user=True)
+            elif command == "subscribe_logs":
+                level = logging.getLevelName(data.get("level", "INFO"))
+                if not isinstance(level, int):
+                    log.warning("Invalid log level %r in subscription request", data.get("level"))
+                    return
+                self.application.logbuffer.subscribe(self, level)
+            elif command == "unsubscribe_logs":
+                self.application.logbuffer.unsubscribe(self)
+
+    def on_pong(self, data):
+        self.application.broadcaster.on_pong(self)
 
     def on_close(self):
         log.debug("WebSocket connection closed")
+        self.application.logbuffer.unsubscribe(self)
         self.application.remove_socket(self)
 
 
@@ -58,24 +79,36 @@ def format_timestamp(ts):
     return f"<span data-timestamp='{ts}'>{text}</span>"
 
 
-def runcmd(*cmd):
-    res = subprocess.run(cmd, capture_output=True, text=True)
-    return res.stdout
+def format_size(size):
+    for unit in ("B", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            break
+        size /= 1024
+    else:
+        unit = "TiB"
+    return f"{size:.1f}{unit}" if unit != "B" else f"{size}{unit}"
 
 
-def get_uploaded_media(player):
-    uploaded_media = []
-    media_dir = player.media_dir.path
-    for de in os.scandir(media_dir):
-        if de.is_dir():
-            continue
-        if de.name in ("current", "previus", "logo", "himblick.conf", "remove-when-done"):
-            continue
-        if de.name.startswith("."):
-            continue
-        uploaded_media.append(de.name)
-    uploaded_media.sort()
-    return uploaded_media
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    days, hours = divmod(hours, 24)
+    if days:
+        return f"{days}d {hours}:{minutes:02d}"
+    return f"{hours}:{minutes:02d}:{seconds:02d}"
+
+
+def sparkline(values, vmax, width=300, height=40):
+    """
+    Return the points attribute of a SVG polyline plotting values
+    """
+    values = list(values)
+    if len(values) < 2 or not vmax:
+        return ""
+    step = width / (len(values) - 1)
+    return " ".join(
+            f"{idx * step:.1f},{height - height * min(val, vmax) / vmax:.1f}"
+            for idx, val in enumerate(values))
 
 
 class BaseHandler(tornado.web.RequestHandler):
@@ -95,6 +128,9 @@ class BaseHandler(tornado.web.RequestHandler):
         res["now"] = time.time()
         res["presentation"] = self.application.player.current_presentation
         res["format_timestamp"] = format_timestamp
+        res["format_size"] = format_size
+        res["format_duration"] = format_duration
+        res["thumbnail_url"] = self.application.thumbnail_url
         res["is_admin"] = self.is_admin
 
         return res
@@ -106,7 +142,9 @@ class MainPage(BaseHandler):
 
         self.render("main.html",
                     title=_("Himblick"),
-                    uploaded_media=get_uploaded_media(self.application.player))
+                    uploaded_media=self.application.player.media_index.list(),
+                    previous_media=self.application.player.store.previous,
+                    rejected_media=self.application.player.preflight.quarantine.list())
 
     def post(self):
         password = self.get_body_argument("password", "")
@@ -123,11 +161,15 @@ class StatusPage(BaseHandler):
     def get(self):
         _ = self.locale.translate
 
+        sampler = self.application.player.sampler
+        sample = sampler.latest
+        mem_total = sample.mem_total if sample is not None else 0
         self.render("status.html",
                     title=_("Himblick status"),
-                    uptime=runcmd("uptime"),
-                    free=runcmd("free", "-h"),
-                    systemctl_status=runcmd("systemctl", "--user", "status", "himblick-player.slice"))
+                    sample=sample,
+                    cpu_history=sparkline((s.cpu_percent for s in sampler.samples), 100),
+                    mem_history=sparkline((s.mem_used for s in sampler.samples), mem_total),
+                    player_processes=sampler.player_processes())
 
 
 class TopCpuPage(BaseHandler):
@@ -136,7 +178,8 @@ class TopCpuPage(BaseHandler):
 
         self.render("top.html",
                     title=_("Himblick status - CPU top"),
-                    top=runcmd("top", "-b", "-n", "1", "-o", "%CPU", "-w", "512"))
+                    sample=self.application.player.sampler.latest,
+                    processes=self.application.player.sampler.top("cpu_percent"))
 
 
 class TopMemPage(BaseHandler):
@@ -145,26 +188,368 @@ class TopMemPage(BaseHandler):
 
         self.render("top.html",
                     title=_("Himblick status - MEM top"),
-                    top=runcmd("top", "-b", "-n", "1", "-o", "%MEM", "-w", "512"))
+                    sample=self.application.player.sampler.latest,
+                    processes=self.application.player.sampler.top("rss"))
 
 
+@tornado.web.stream_request_body
 class MediaUpload(BaseHandler):
+    """
+    Receive media uploads as multipart/form-data, streaming them to disk as
+    they arrive instead of buffering them in memory.
+
+    Since the body is not parsed before the handler runs, the XSRF token needs
+    to be sent in the X-XSRFToken header
+    """
+    # Maximum size of an upload request
+    MAX_BODY_SIZE = 16 * 1024 * 1024 * 1024
+
+    def prepare(self):
+        super().prepare()
+        self.parser = None
+        # Parse error found while receiving the body
+        self.error = None
+        if not self.is_admin:
+            raise tornado.web.HTTPError(403)
+        self.request.connection.set_max_body_size(self.MAX_BODY_SIZE)
+        try:
+            boundary = upload.get_boundary(self.request.headers.get("Content-Type", ""))
+        except ValueError as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.parser = upload.MultipartParser(
+                boundary, upload.make_upload_part(self.application.player.media_dir.path))
+
+    def data_received(self, chunk):
+        if self.error is not None:
+            return
+        try:
+            self.parser.feed(chunk)
+        except (ValueError, OSError) as e:
+            # Discard the rest of the body, and report the error once it has
+            # been received
+            self.error = str(e)
+            self.parser.abort()
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        if self.parser is not None:
+            self.parser.abort()
+
+    def post(self):
+        if self.error is None:
+            try:
+                self.parser.finish()
+            except ValueError as e:
+                self.error = str(e)
+                self.parser.abort()
+        if self.error is not None:
+            raise tornado.web.HTTPError(400, self.error)
+        for part in self.parser.parts:
+            if isinstance(part, upload.UploadedFile):
+                self.application.player.hashes.set(part.pathname, os.stat(part.pathname), part.hash.hexdigest())
+                metrics.UPLOADS.inc(method="stream")
+                metrics.UPLOAD_BYTES.inc(part.size, method="stream")
+        self.finish({
+            "files": [
+                {"name": part.name, "size": part.size, "sha256": part.hash.hexdigest()}
+                for part in self.parser.parts if isinstance(part, upload.UploadedFile)
+            ],
+        })
+
+
+class MediaUploadCreate(BaseHandler):
+    """
+    Start a resumable upload
+    """
     def post(self):
         if not self.is_admin:
             self.send_error(403)
             return
-        # _ = self.locale.translate
+        try:
+            data = json.loads(self.request.body)
+            session = self.application.uploads.create(data["name"], int(data["size"]))
+        except (ValueError, KeyError, TypeError) as e:
+            raise tornado.web.HTTPError(400, str(e))
+        self.set_status(201)
+        self.finish(session.to_json())
+
+
+@tornado.web.stream_request_body
+class MediaUploadSession(BaseHandler):
+    """
+    Query, send data to, finalize or cancel a resumable upload.
+
+    Data is sent with PUT requests carrying a Content-Range header, and
+    written to disk as it arrives: if a request is interrupted, what was
+    received so far is kept, and the upload can resume from the offset
+    returned by GET
+    """
+    re_content_range = re.compile(r"^bytes (\d+)-(\d+)/(\d+)$")
+
+    def prepare(self):
+        super().prepare()
+        self.fd = None
+        if not self.is_admin:
+            raise tornado.web.HTTPError(403)
+        self.session = self.application.uploads.get(self.path_args[0])
+        if self.session is None:
+            raise tornado.web.HTTPError(404)
+
+        if self.request.method != "PUT":
+            return
+
+        mo = self.re_content_range.match(self.request.headers.get("Content-Range", ""))
+        if not mo:
+            raise tornado.web.HTTPError(400, "missing or invalid Content-Range")
+        start, end, total = (int(x) for x in mo.groups())
+        if total != self.session.size or start > end or end >= total:
+            raise tornado.web.HTTPError(416)
+        self.range_start = start
+        self.range_size = end - start + 1
+        self.received = 0
+        self.request.connection.set_max_body_size(self.range_size)
+        self.fd = self.session.open(start)
+
+    def data_received(self, chunk):
+        if self.fd is None:
+            return
+        chunk = chunk[:self.range_size - self.received]
+        self.fd.write(chunk)
+        self.received += len(chunk)
+        metrics.UPLOAD_BYTES.inc(len(chunk), method="resumable")
+
+    def save_received(self):
+        """
+        Record the data received so far
+        """
+        if self.fd is None:
+            return
+        self.fd.close()
+        self.fd = None
+        self.session.record_range(self.range_start, self.range_start + self.received)
+
+    def on_connection_close(self):
+        super().on_connection_close()
+        self.save_received()
+
+    def get(self, id):
+        self.finish(self.session.to_json())
+
+    def put(self, id):
+        self.save_received()
+        self.finish(self.session.to_json())
+
+    async def post(self, id):
+        if not self.session.complete:
+            raise tornado.web.HTTPError(409, "upload is not complete")
+        loop = tornado.ioloop.IOLoop.current()
         media_dir = self.application.player.media_dir.path
-        for name, files in self.request.files.items():
-            for f in files:
-                name = os.path.basename(f["filename"])
-                with open(os.path.join(media_dir, name), "wb") as fd:
-                    fd.write(f.body)
-        self.application.send_ws_message({
-            "event": "uploaded_media_changed",
-            "files": get_uploaded_media(self.application.player),
-        })
-        self.finish("OK")
+        sha256 = await loop.run_in_executor(None, self.session.finalize, media_dir)
+        pathname = os.path.join(media_dir, self.session.name)
+        self.application.player.hashes.set(pathname, os.stat(pathname), sha256)
+        metrics.UPLOADS.inc(method="resumable")
+        self.finish({"name": self.session.name, "size": self.session.size, "sha256": sha256})
+
+    def delete(self, id):
+        log.info("%s: resumable upload %s cancelled", self.session.name, self.session.id)
+        self.session.remove()
+        self.set_status(204)
+        self.finish()
+
+
+class MediaThumbnail(BaseHandler):
+    """
+    Serve thumbnails of uploaded or currently playing media
+    """
+    # Thumbnails are keyed by file contents, so they can be cached for long
+    CACHE_MAX_AGE = 86400
+
+    async def get(self, where, name):
+        player = self.application.player
+        if where == "uploaded":
+            # Media that has not been activated is only visible to admins
+            if not self.is_admin:
+                self.send_error(403)
+                return
+            media_dir = player.media_dir
+        else:
+            media_dir = player.current_dir
+        name = os.path.basename(name)
+        pathname = media_dir.pathname(name)
+        if pathname is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            st = os.stat(pathname)
+        except FileNotFoundError:
+            raise tornado.web.HTTPError(404)
+
+        # Answer conditional requests without looking at the cache
+        key = self.application.thumbnails.get_key(pathname, st)
+        self.set_header("Etag", f'"{key}"')
+        self.set_header("Last-Modified", datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc))
+        self.set_header("Cache-Control", f"max-age={self.CACHE_MAX_AGE}")
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        ims = self.request.headers.get("If-Modified-Since")
+        if ims is not None and "If-None-Match" not in self.request.headers:
+            date_tuple = email.utils.parsedate(ims)
+            if date_tuple is not None and calendar.timegm(date_tuple) >= int(st.st_mtime):
+                self.set_status(304)
+                return
+
+        thumbnail = await self.application.thumbnails.get(pathname, media_dir.file_type(name), st)
+        if thumbnail is None:
+            raise tornado.web.HTTPError(404)
+        with open(thumbnail, "rb") as fd:
+            data = fd.read()
+        self.set_header("Content-Type", "image/jpeg")
+        self.finish(data)
+
+
+class MediaFile(tornado.web.RequestHandler):
+    """
+    Read-only access to the media being played, with support for range and
+    conditional requests.
+
+    Files are streamed in CHUNK_SIZE blocks read in a worker thread, waiting
+    for each block to be sent before reading the next, so that neither memory
+    use nor the event loop depend on the file size.
+
+    The ETag is the sha256 of the file contents. If it is not known yet, it is
+    computed in the background, and the response goes out without it.
+    """
+    CHUNK_SIZE = 64 * 1024
+
+    re_range = re.compile(r"^bytes=(\d*)-(\d*)$")
+
+    def parse_range(self, size):
+        """
+        Return the (start, end) range requested, with end excluded, None to
+        send the whole file, or False if the range cannot be satisfied
+        """
+        header = self.request.headers.get("Range")
+        if header is None:
+            return None
+        mo = self.re_range.match(header.strip())
+        if not mo:
+            # Multiple or unsupported ranges: send the whole file
+            return None
+        start, end = mo.groups()
+        if not start:
+            if not end:
+                return None
+            # Suffix range: last N bytes
+            start = max(0, size - int(end))
+            end = size
+        else:
+            start = int(start)
+            end = min(int(end) + 1, size) if end else size
+        if start >= size or start >= end:
+            return False
+        return start, end
+
+    def if_range_matches(self, etag, st):
+        """
+        Check if the If-Range header, if present, allows sending a partial
+        response
+        """
+        value = self.request.headers.get("If-Range")
+        if value is None:
+            return True
+        if value.startswith('"') or value.startswith("W/"):
+            return etag is not None and value == etag
+        date_tuple = email.utils.parsedate(value)
+        return date_tuple is not None and calendar.timegm(date_tuple) == int(st.st_mtime)
+
+    def is_not_modified(self, etag, st):
+        if "If-None-Match" in self.request.headers:
+            return etag is not None and self.check_etag_header()
+        ims = self.request.headers.get("If-Modified-Since")
+        if ims is not None:
+            date_tuple = email.utils.parsedate(ims)
+            return date_tuple is not None and calendar.timegm(date_tuple) >= int(st.st_mtime)
+        return False
+
+    async def get(self, where, name, include_body=True):
+        player = self.application.player
+        if where == "current":
+            media_dir = player.current_dir
+        else:
+            media_dir = player.logo_dir
+        pathname = media_dir.pathname(os.path.basename(name))
+        if pathname is None:
+            raise tornado.web.HTTPError(404)
+        try:
+            fd = open(pathname, "rb")
+        except (FileNotFoundError, IsADirectoryError):
+            raise tornado.web.HTTPError(404)
+
+        with fd:
+            st = os.fstat(fd.fileno())
+            sha256 = player.hashes.get_cached(pathname, st)
+            if sha256 is None:
+                player.hashes.prefetch(pathname, st)
+                etag = None
+            else:
+                etag = f'"{sha256}"'
+                self.set_header("Etag", etag)
+            self.set_header("Last-Modified", datetime.datetime.fromtimestamp(st.st_mtime, datetime.timezone.utc))
+            self.set_header("Accept-Ranges", "bytes")
+            content_type, encoding = mimetypes.guess_type(pathname)
+            self.set_header("Content-Type", content_type or "application/octet-stream")
+
+            if self.is_not_modified(etag, st):
+                self.set_status(304)
+                return
+
+            size = st.st_size
+            byte_range = self.parse_range(size) if self.if_range_matches(etag, st) else None
+            if byte_range is False:
+                self.set_status(416)
+                self.set_header("Content-Range", f"bytes */{size}")
+                self.clear_header("Content-Type")
+                return
+            elif byte_range is None:
+                start, end = 0, size
+            else:
+                start, end = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range", f"bytes {start}-{end - 1}/{size}")
+            self.set_header("Content-Length", end - start)
+
+            if not include_body:
+                return
+
+            loop = tornado.ioloop.IOLoop.current()
+            fd.seek(start)
+            remaining = end - start
+            while remaining > 0:
+                chunk = await loop.run_in_executor(None, fd.read, min(self.CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                self.write(chunk)
+                try:
+                    await self.flush()
+                except tornado.iostream.StreamClosedError:
+                    return
+
+    def compute_etag(self):
+        # The ETag is set explicitly, do not hash the response body
+        return None
+
+    async def head(self, where, name):
+        await self.get(where, name, include_body=False)
+
+
+class MetricsPage(tornado.web.RequestHandler):
+    """
+    Export metrics in Prometheus text format
+    """
+    def get(self):
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics.REGISTRY.expose())
 
 
 class MediaActivate(BaseHandler):
@@ -172,20 +557,100 @@ class MediaActivate(BaseHandler):
         if not self.is_admin:
             self.send_error(403)
             return
-        self.application.player.command_queue.put_nowait("rescan")
+        self.application.player.commands.put("rescan", "web activate", user=True)
+        self.redirect("/")
+
+
+class MediaRollback(BaseHandler):
+    def post(self):
+        if not self.is_admin:
+            self.send_error(403)
+            return
+        player = self.application.player
+        generation = player.store.rollback()
+        if generation is None:
+            log.warning("%s: no previous media to restore", player.store)
+        else:
+            player.commands.put("rescan", "web rollback", user=True)
         self.redirect("/")
 
 
 class WebLoggingHandler(logging.Handler):
-    def __init__(self, *args, **kw):
+    """
+    Keep the most recent log records for the web UI, and stream new ones to
+    subscribed websockets.
+
+    Records are only formatted when someone looks at them, and updates are
+    sent in batches at most every FLUSH_INTERVAL seconds
+    """
+    # Minimum time between log updates sent to subscribers
+    FLUSH_INTERVAL = 0.5
+
+    def __init__(self, broadcaster: Broadcaster, *args, **kw):
         super().__init__(*args, **kw)
-        self.queue = deque(maxlen=100)
-        # TODO: add a formatter and a filter
+        self.broadcaster = broadcaster
+        self.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        self.records = deque(maxlen=100)
+        # Records not yet sent to subscribers
+        self.pending = deque(maxlen=500)
+        # Subscribed sockets, with the minimum level they want
+        self.subscribers: Dict[Socket, int] = {}
+        # Event loop used to schedule updates, set when the server starts
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+        self.flush_scheduled = False
+        self.last_flush = 0.0
+
+    def lines(self):
+        """
+        Return the formatted log lines, most recent first
+        """
+        return [self.format(record) for record in reversed(self.records)]
+
+    def subscribe(self, socket: Socket, level: int):
+        log.debug("Log subscription at level %s", logging.getLevelName(level))
+        self.subscribers[socket] = level
+
+    def unsubscribe(self, socket: Socket):
+        self.subscribers.pop(socket, None)
 
     def emit(self, record):
-        formatted = self.format(record)
-        self.queue.append(formatted)
-        # TODO: notify a log update via websocket
+        self.records.append(record)
+        if not self.subscribers or self.loop is None:
+            return
+        self.pending.append(record)
+        if not self.flush_scheduled:
+            self.flush_scheduled = True
+            # Records can also be logged by worker threads
+            self.loop.call_soon_threadsafe(self.schedule_flush)
+
+    def schedule_flush(self):
+        delay = max(0, self.last_flush + self.FLUSH_INTERVAL - time.time())
+        self.loop.call_later(delay, self.flush)
+
+    def flush(self):
+        self.flush_scheduled = False
+        self.last_flush = time.time()
+        records = []
+        while self.pending:
+            records.append(self.pending.popleft())
+        if not records:
+            return
+
+        # Format each record at most once, regardless of the number of
+        # subscribers
+        formatted = {}
+        for socket, level in list(self.subscribers.items()):
+            batch = []
+            for record in records:
+                if record.levelno < level:
+                    continue
+                text = formatted.get(id(record))
+                if text is None:
+                    text = formatted[id(record)] = self.format(record)
+                batch.append({"time": record.created, "level": record.levelname, "text": text})
+            if not batch:
+                continue
+            self.broadcaster.send(socket, {"event": "log", "records": batch})
 
 
 class WebUI(tornado.web.Application):
@@ -196,8 +661,14 @@ class WebUI(tornado.web.Application):
             url(r"^/status$", StatusPage, name="status"),
             url(r"^/status/top-cpu$", TopCpuPage, name="status_top_cpu"),
             url(r"^/status/top-mem$", TopMemPage, name="status_top_mem"),
+            url(r"^/metrics$", MetricsPage, name="metrics"),
             url(r"^/media/upload$", MediaUpload, name="media_upload"),
+            url(r"^/media/uploads$", MediaUploadCreate, name="media_uploads"),
+            url(r"^/media/uploads/([0-9a-f]+)$", MediaUploadSession, name="media_upload_session"),
             url(r"^/media/activate$", MediaActivate, name="media_activate"),
+            url(r"^/media/rollback$", MediaRollback, name="media_rollback"),
+            url(r"^/media/thumbnail/(uploaded|current)/([^/]+)$", MediaThumbnail, name="media_thumbnail"),
+            url(r"^/media/files/(current|logo)/([^/]+)$", MediaFile, name="media_file"),
         ]
 
         cookie_secret = player.settings.general("cookie secret")
@@ -218,26 +689,58 @@ class WebUI(tornado.web.Application):
             **settings,
         )
 
-        self.player: Player = player
-        self.sockets: Set[Socket] = set()
+        StaticFileHandler.build_table(settings["static_path"])
 
-        self.logbuffer = WebLoggingHandler(level=logging.INFO)
+        self.player: Player = player
+        self.broadcaster = Broadcaster()
+        stats = self.broadcaster.stats
+        metrics.WEBSOCKET_CLIENTS.set_function(lambda: len(self.broadcaster.clients))
+        metrics.WEBSOCKET_MESSAGES_SENT.set_function(lambda: stats.sent)
+        metrics.WEBSOCKET_MESSAGES_DROPPED.set_function(lambda: stats.dropped)
+        metrics.WEBSOCKET_MESSAGES_COALESCED.set_function(lambda: stats.coalesced)
+        metrics.WEBSOCKET_CLIENTS_PRUNED.set_function(lambda: stats.pruned)
+        self.uploads = upload.ResumableUploads(os.path.join(player.media_dir.path, ".uploads"))
+        player.media_index.listeners.append(self.on_uploaded_media_changed)
+        self.thumbnails = ThumbnailCache(
+                os.path.join(player.media_dir.path, ".cache", "thumbnails"), player.workers,
+                lambda: player.player_settings.thumbnail_cache_size * 1024 * 1024)
+
+        self.logbuffer = WebLoggingHandler(self.broadcaster, level=logging.INFO)
         logging.getLogger().addHandler(self.logbuffer)
 
     def add_socket(self, handler):
-        self.sockets.add(handler)
+        self.broadcaster.add(handler)
 
     def remove_socket(self, handler):
-        self.sockets.discard(handler)
+        self.broadcaster.remove(handler)
 
     def trigger_reload(self):
         log.info("Content change detected: reloading site")
         self.send_ws_message({"event": "reload"})
 
+    def thumbnail_url(self, where: str, name: str) -> Optional[str]:
+        """
+        Return the URL of the thumbnail of a media file, or None if we cannot
+        make a thumbnail for it
+        """
+        media_dir = self.player.media_dir if where == "uploaded" else self.player.current_dir
+        if media_dir.file_type(name) not in ThumbnailCache.TYPES:
+            return None
+        return self.reverse_url("media_thumbnail", where, name)
+
+    def on_uploaded_media_changed(self):
+        files = []
+        for entry in self.player.media_index.list():
+            info = entry.to_json()
+            info["thumbnail"] = self.thumbnail_url("uploaded", entry.name)
+            files.append(info)
+        self.send_ws_message({
+            "event": "uploaded_media_changed",
+            "files": files,
+        })
+
     def send_ws_message(self, data):
-        payload = json.dumps(data)
-        for handler in self.sockets:
-            handler.write_message(payload)
+        self.broadcaster.broadcast(data)
 
     def start_server(self, host=None, port=8018):
         sockets = tornado.netutil.bind_sockets(port, host)
@@ -253,3 +756,25 @@ class WebUI(tornado.web.Application):
 
         server = tornado.httpserver.HTTPServer(self)
         server.add_sockets(sockets)
+
+        self.logbuffer.loop = asyncio.get_event_loop()
+        self.compress_static_assets()
+        self.broadcaster.start()
+
+        # Periodically clean up abandoned resumable uploads
+        tornado.ioloop.PeriodicCallback(self.expire_uploads, 3600 * 1000).start()
+
+    def compress_static_assets(self):
+        """
+        Generate compressed versions of static assets in the background
+        """
+        cache_dir = os.path.expanduser("~/.cache/himblick/static")
+        future = asyncio.get_event_loop().run_in_executor(None, StaticFileHandler.compress_assets, cache_dir)
+
+        def on_done(future):
+            if future.exception() is not None:
+                log.error("Cannot compress static assets: %s", future.exception())
+        future.add_done_callback(on_done)
+
+    def expire_uploads(self):
+        self.uploads.expire(self.player.player_settings.upload_expiry * 3600)
@@ -0,0 +1,184 @@
+from __future__ import annotations
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import asyncio
+import hashlib
+import os
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def copy_to_ram(src: str, dest: str):
+    """
+    Copy a file into the staging area, dropping the original from the page
+    cache, since it will not be read again.
+
+    This is run in a worker thread.
+    """
+    tmp = dest + ".tmp"
+    try:
+        shutil.copyfile(src, tmp)
+        os.rename(tmp, dest)
+    finally:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+    with open(src, "rb") as fd:
+        os.posix_fadvise(fd.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
+
+
+class RamStage:
+    """
+    Copies in RAM of the media files played by the current presentation,
+    within a memory budget.
+
+    Files are copied to a tmpfs in the order they are played, and players
+    read the copies instead of the media partition. Files that do not fit are
+    read ahead by the presentations shortly before they are shown.
+
+    Copies are named after the pathname, size and mtime of their original,
+    so they can be reused after the player is restarted.
+    """
+    # Longest time to wait for staging before starting a presentation, in
+    # seconds. Copying continues in the background afterwards
+    MAX_WAIT = 20
+
+    def __init__(self, root: str, get_budget: Callable[[], int]):
+        """
+        :arg root: directory in a tmpfs where copies are stored
+        :arg get_budget: function returning the maximum size in bytes of the
+                         copies
+        """
+        self.root = root
+        self.get_budget = get_budget
+        # Size of the copies, by file name in root
+        self.files: Dict[str, int] = {}
+        # Pathnames of the copies, by pathname of their original
+        self.paths: Dict[str, str] = {}
+        # (pathname, copy name, size) of the files to stage, in playing order
+        self.plan: List[Tuple[str, str, int]] = []
+        # Originals used by the presentation on screen, whose copies must not
+        # be removed
+        self.pinned: Set[str] = set()
+        self.task: Optional[asyncio.Task] = None
+        self.load()
+
+    @property
+    def used(self) -> int:
+        return sum(self.files.values())
+
+    def load(self):
+        """
+        Index the copies left by a previous run
+        """
+        os.makedirs(self.root, exist_ok=True)
+        for de in os.scandir(self.root):
+            if de.name.endswith(".tmp"):
+                os.unlink(de.path)
+            else:
+                self.files[de.name] = de.stat().st_size
+
+    def copy_name(self, pathname: str, st: os.stat_result) -> str:
+        key = hashlib.sha256(f"{pathname}\0{st.st_size}\0{st.st_mtime_ns}".encode()).hexdigest()
+        return key + os.path.splitext(pathname)[1].lower()
+
+    async def stage(self, pathnames: List[str], interrupt: Optional[asyncio.Event] = None):
+        """
+        Stage the given files, in the order in which they will be played,
+        replacing the previous ones except those that are pinned.
+
+        Stop waiting for the copies if interrupt gets set
+        """
+        plan = []
+        seen = set()
+        for pathname in pathnames:
+            if pathname in seen:
+                continue
+            seen.add(pathname)
+            try:
+                st = os.stat(pathname)
+            except FileNotFoundError:
+                continue
+            name = self.copy_name(pathname, st)
+            plan.append((pathname, name, st.st_size))
+            if name in self.files:
+                self.paths[pathname] = os.path.join(self.root, name)
+        self.plan = plan
+        self.evict()
+
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.fill())
+        waits = [asyncio.shield(self.task)]
+        if interrupt is not None:
+            waits.append(asyncio.ensure_future(interrupt.wait()))
+        done, pending = await asyncio.wait(waits, timeout=self.MAX_WAIT, return_when=asyncio.FIRST_COMPLETED)
+        # Cancelling the shield leaves the copy running
+        for fut in pending:
+            fut.cancel()
+        if not self.task.done():
+            log.info("%s: media still being copied, continuing in the background", self.root)
+
+    def release(self, pathnames: List[str]):
+        """
+        Pin the files used by the presentation now on screen, removing copies
+        that are not needed anymore
+        """
+        self.pinned = set(pathnames)
+        if self.evict() and (self.task is None or self.task.done()):
+            # Freed space can be used for the rest of the plan
+            self.task = asyncio.create_task(self.fill())
+
+    def evict(self) -> bool:
+        """
+        Remove the copies of files that are neither planned nor pinned.
+
+        Return True if something was removed
+        """
+        keep = {name for pathname, name, size in self.plan}
+        keep.update(os.path.basename(self.paths[pathname]) for pathname in self.pinned if pathname in self.paths)
+        for pathname, path in list(self.paths.items()):
+            if os.path.basename(path) not in keep:
+                del self.paths[pathname]
+        removed = False
+        for name in list(self.files):
+            if name in keep:
+                continue
+            try:
+                os.unlink(os.path.join(self.root, name))
+            except FileNotFoundError:
+                pass
+            del self.files[name]
+            removed = True
+        return removed
+
+    async def fill(self):
+        """
+        Copy the planned files that fit in the budget
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            plan = self.plan
+            for pathname, name, size in plan:
+                if self.plan is not plan:
+                    break
+                if name in self.files:
+                    continue
+                if self.used + size > self.get_budget():
+                    continue
+                dest = os.path.join(self.root, name)
+                try:
+                    await loop.run_in_executor(None, copy_to_ram, pathname, dest)
+                except OSError as e:
+                    log.warning("%s: cannot copy to %s: %s", pathname, self.root, e)
+                    continue
+                self.files[name] = size
+                self.paths[pathname] = dest
+                if self.plan is not plan:
+                    # The copy may not be needed anymore
+                    self.evict()
+            else:
+                break
+
+        leftovers = [pathname for pathname, name, size in self.plan if name not in self.files]
+        log.info("%s: %d files staged in RAM (%dMiB), %d left on disk",
+                 self.root, len(self.plan) - len(leftovers), self.used // (1024 * 1024), len(leftovers))
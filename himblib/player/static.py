@@ -1,64 +1,234 @@
+from __future__ import annotations
+from typing import Dict, Optional
 from tornado import web
+import gzip
+import hashlib
 import pathlib
 import os
+import shutil
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def accepts_gzip(accept_encoding: str) -> bool:
+    """
+    Check if an Accept-Encoding header allows gzip content coding
+    """
+    qvalues = {}
+    for item in accept_encoding.split(","):
+        coding, *params = item.split(";")
+        q = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip().lower() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding.strip().lower()] = q
+    if "gzip" in qvalues:
+        return qvalues["gzip"] > 0
+    if "x-gzip" in qvalues:
+        return qvalues["x-gzip"] > 0
+    return qvalues.get("*", 0) > 0
+
+
+class Asset:
+    """
+    A static file that can be served
+    """
+    # Size of the chunks read when hashing the file
+    CHUNK_SIZE = 256 * 1024
+
+    def __init__(self, path: str):
+        # Absolute path of the file
+        self.path = path
+        # Hash of the contents, computed when first needed
+        self._version: Optional[str] = None
+        # Absolute path of a gzip-compressed version, if available
+        self.gzipped: Optional[str] = None
+
+    @property
+    def version(self) -> str:
+        """
+        Hash of the contents, used for versioned URLs
+        """
+        if self._version is None:
+            h = hashlib.sha512()
+            with open(self.path, "rb") as fd:
+                while True:
+                    buf = fd.read(self.CHUNK_SIZE)
+                    if not buf:
+                        break
+                    h.update(buf)
+            self._version = h.hexdigest()
+        return self._version
 
 
 class StaticFileHandler(web.StaticFileHandler):
     """
     StaticFileHandler that allows overriding paths in the static directory with
-    system provided versions
+    system provided versions.
+
+    Paths are resolved at startup into a table, and compressible assets can
+    be served from precompressed copies. Other system assets are added to the
+    table when first requested.
     """
     SYSTEM_ASSET_PATH = pathlib.Path("/usr/share/javascript")
 
+    # Directories of SYSTEM_ASSET_PATH used by the templates, indexed at
+    # startup so that they get precompressed
+    SYSTEM_ASSET_PACKAGES = ("jquery", "popper.js", "bootstrap4", "fork-awesome", "libjs-dropzone")
+
+    # Extensions of files worth compressing
+    COMPRESSIBLE = (".js", ".css", ".map", ".svg", ".json", ".html", ".txt", ".ttf", ".otf", ".eot")
+
+    # Assets by path relative to the static root
+    assets: Optional[Dict[str, Asset]] = None
+    # Assets by absolute path
+    assets_by_path: Dict[str, Asset] = {}
+
     @classmethod
-    def get_absolute_path(self, root, path):
-        orig_path = super().get_absolute_path(root, path)
+    def build_table(cls, root: str):
+        """
+        Resolve all the static assets available.
+
+        Files are not read here: their hashes are computed when first needed
+        """
+        assets = {}
+        # (st_dev, st_ino) of the directories already scanned, to avoid
+        # symlink loops
+        visited = set()
 
-        path = pathlib.PurePath(path)
-        if not path.parts:
-            return orig_path
+        def scan(top: pathlib.Path, prefix: pathlib.PurePath = pathlib.PurePath()):
+            for dirpath, dirnames, filenames in os.walk(top, followlinks=True):
+                st = os.stat(dirpath)
+                if (st.st_dev, st.st_ino) in visited:
+                    dirnames[:] = []
+                    continue
+                visited.add((st.st_dev, st.st_ino))
+                reldir = prefix.joinpath(pathlib.Path(dirpath).relative_to(top))
+                for fn in filenames:
+                    relpath = reldir.joinpath(fn).as_posix()
+                    abspath = os.path.join(dirpath, fn)
+                    if not os.path.isfile(abspath):
+                        continue
+                    assets[relpath] = Asset(abspath)
 
-        if os.path.exists(orig_path):
-            return orig_path
+        # Static directory contents take precedence over system assets
+        for name in cls.SYSTEM_ASSET_PACKAGES:
+            path = cls.SYSTEM_ASSET_PATH / name
+            if path.is_dir():
+                scan(path, pathlib.PurePath(name))
+        # Directories of the static root are indexed under their own names
+        # even if they link to a system package
+        visited.clear()
+        scan(pathlib.Path(root))
 
-        system_dir = self.SYSTEM_ASSET_PATH.joinpath(path.parts[0])
-        if system_dir.is_dir():
-            # If that asset directory exists in the system, look for things in
-            # there
-            return self.SYSTEM_ASSET_PATH.joinpath(path).as_posix()
-        else:
-            return orig_path
+        cls.assets = assets
+        cls.assets_by_path = {a.path: a for a in assets.values()}
+        log.info("%d static assets found", len(assets))
+
+    @classmethod
+    def compress_assets(cls, cache_dir: str):
+        """
+        Make gzip-compressed copies of compressible assets in cache_dir, reusing
+        those still up to date.
+
+        This can take a while, and is meant to be run in a worker thread.
+        """
+        for relpath, asset in list(cls.assets.items()):
+            if not relpath.endswith(cls.COMPRESSIBLE):
+                continue
+            # Name the compressed file after the contents, so that stale
+            # versions are never used
+            dest = os.path.join(cache_dir, asset.version[:32] + ".gz")
+            if not os.path.exists(dest):
+                os.makedirs(cache_dir, exist_ok=True)
+                tmp = dest + ".tmp"
+                with open(asset.path, "rb") as infd:
+                    with gzip.open(tmp, "wb", compresslevel=9) as outfd:
+                        shutil.copyfileobj(infd, outfd)
+                if os.path.getsize(tmp) >= os.path.getsize(asset.path):
+                    os.unlink(tmp)
+                    continue
+                os.rename(tmp, dest)
+            asset.gzipped = dest
+
+    @classmethod
+    def find_system_asset(cls, path: str) -> Optional[Asset]:
+        """
+        Look up a system asset not indexed at startup, adding it to the table
+        """
+        relpath = pathlib.PurePosixPath(path)
+        if relpath.is_absolute() or ".." in relpath.parts:
+            return None
+        abspath = os.path.join(cls.SYSTEM_ASSET_PATH, relpath)
+        if not os.path.isfile(abspath):
+            return None
+        asset = cls.assets_by_path.get(abspath)
+        if asset is None:
+            asset = cls.assets_by_path[abspath] = Asset(abspath)
+        cls.assets[path] = asset
+        return asset
+
+    @classmethod
+    def get_absolute_path(self, root, path):
+        if self.assets is None:
+            self.build_table(root)
+
+        path = pathlib.PurePath(path).as_posix()
+        asset = self.assets.get(path)
+        if asset is None:
+            asset = self.find_system_asset(path)
+        if asset is None:
+            return super().get_absolute_path(root, path)
+        return asset.path
+
+    @classmethod
+    def get_version(cls, settings, path):
+        abspath = cls.get_absolute_path(settings["static_path"], path)
+        asset = cls.assets_by_path.get(abspath)
+        if asset is None:
+            return None
+        return asset.version
 
     def validate_absolute_path(self, root, absolute_path):
         """
-        Rewrite of tornado's validate_absolute_path not to raise an error for
-        paths in /usr/share/javascript/
+        Only allow serving files from the asset table
         """
-        root = pathlib.Path(root)
-        absolute_path = pathlib.Path(absolute_path)
-
-        is_system_root = absolute_path.parts[
-            :len(self.SYSTEM_ASSET_PATH.parts)
-            ] == self.SYSTEM_ASSET_PATH.parts
-        is_static_root = absolute_path.parts[:len(root.parts)] == root.parts
-
-        if not is_system_root and not is_static_root:
-            raise web.HTTPError(
-                403,
-                "%s is not in root static directory or system assets path",
-                self.path
-                )
-
-        if absolute_path.is_dir() and self.default_filename is not None:
-            # need to look at the request.path here for when path is empty
-            # but there is some prefix to the path that was already
-            # trimmed by the routing
-            if not self.request.path.endswith("/"):
-                self.redirect(self.request.path + "/", permanent=True)
-                return
-            absolute_path = absolute_path.joinpath(self.default_filename)
-        if not absolute_path.exists():
+        asset = self.assets_by_path.get(absolute_path)
+        if asset is None:
             raise web.HTTPError(404)
-        if not absolute_path.is_file():
-            raise web.HTTPError(403, "%s is not a file", self.path)
-        return str(absolute_path)
+        self.asset = asset
+
+        if asset.path.endswith(self.COMPRESSIBLE):
+            self.set_header("Vary", "Accept-Encoding")
+            if asset.gzipped is not None and accepts_gzip(self.request.headers.get("Accept-Encoding", "")):
+                self.set_header("Content-Encoding", "gzip")
+                return asset.gzipped
+
+        return asset.path
+
+    def get_content_type(self):
+        # Use the type of the original file also when serving a compressed
+        # version
+        absolute_path = self.absolute_path
+        self.absolute_path = self.asset.path
+        try:
+            return super().get_content_type()
+        finally:
+            self.absolute_path = absolute_path
+
+    def compute_etag(self):
+        version = self.asset.version
+        if self.absolute_path != self.asset.path:
+            version += "-gzip"
+        return f'"{version}"'
+
+    def set_extra_headers(self, path):
+        # Versioned URLs change when the contents change, so their contents
+        # never do
+        if self.get_argument("v", None) == self.asset.version:
+            self.set_header("Cache-Control", f"public, max-age={self.CACHE_MAX_AGE}, immutable")
@@ -1,6 +1,21 @@
 (function($) {
 "use strict";
 
+/**
+ * Format a size in bytes in a human readable way
+ */
+function format_size(size)
+{
+    const units = ["B", "KiB", "MiB", "GiB", "TiB"];
+    let idx = 0;
+    while (size >= 1024 && idx < units.length - 1)
+    {
+        size /= 1024;
+        ++idx;
+    }
+    return idx == 0 ? `${size}${units[idx]}` : `${size.toFixed(1)}${units[idx]}`;
+}
+
 /**
  * Communicate with himblick over the websocket interface
  */
@@ -28,6 +43,7 @@ class HimblickSocket
 
     on_open() {
         console.debug("Websocket channel open");
+        document.dispatchEvent(new CustomEvent("himblick.open"));
     }
 
     on_close() {
@@ -49,6 +65,135 @@ class HimblickSocket
     }
 }
 
+/**
+ * Upload a file using the resumable upload API, sending it in chunks and
+ * resuming from the last offset received by the server in case of errors.
+ *
+ * Upload sessions are remembered in localStorage, so that uploading the same
+ * file again after a page reload resumes the previous upload.
+ */
+class ResumableUpload
+{
+    constructor(file, options) {
+        this.file = file;
+        this.chunk_size = options.chunk_size || 4 * 1024 * 1024;
+        this.on_progress = options.on_progress || (() => {});
+        this.max_retry_interval = 30000; // ms
+        this.storage_key = `himblick.upload:${file.name}:${file.size}:${file.lastModified}`;
+        this.session = null;
+    }
+
+    async request(method, url, body, headers) {
+        const res = await fetch(url, {
+            method: method,
+            body: body,
+            credentials: "same-origin",
+            headers: Object.assign({"X-XSRFToken": window.himblick.config.xsrf_token}, headers || {}),
+        });
+        if (!res.ok)
+        {
+            let err = new Error(`${method} ${url}: ${res.status} ${res.statusText}`);
+            err.status = res.status;
+            throw err;
+        }
+        if (res.status == 204)
+            return null;
+        return await res.json();
+    }
+
+    session_url() {
+        return `${window.himblick.config.uploads}/${this.session.id}`;
+    }
+
+    async open_session() {
+        const id = window.localStorage.getItem(this.storage_key);
+        if (id)
+        {
+            try {
+                this.session = await this.request("GET", `${window.himblick.config.uploads}/${id}`);
+                console.debug("Resuming upload", this.session);
+                return;
+            } catch (e) {
+                if (e.status != 404)
+                    throw e;
+                window.localStorage.removeItem(this.storage_key);
+            }
+        }
+        this.session = await this.request("POST", window.himblick.config.uploads, JSON.stringify({
+            name: this.file.name,
+            size: this.file.size,
+        }), {"Content-Type": "application/json"});
+        window.localStorage.setItem(this.storage_key, this.session.id);
+    }
+
+    async send_chunks() {
+        let retry_interval = 1000;
+        while (this.session.offset < this.file.size)
+        {
+            const start = this.session.offset;
+            const end = Math.min(start + this.chunk_size, this.file.size);
+            try {
+                this.session = await this.request("PUT", this.session_url(), this.file.slice(start, end), {
+                    "Content-Range": `bytes ${start}-${end - 1}/${this.file.size}`,
+                });
+                retry_interval = 1000;
+            } catch (e) {
+                // Give up on client errors, retry on everything else
+                if (e.status >= 400 && e.status < 500)
+                    throw e;
+                console.debug("Upload chunk failed, retrying", e);
+                await new Promise(resolve => setTimeout(resolve, retry_interval));
+                retry_interval = Math.min(retry_interval * 2, this.max_retry_interval);
+                // Ask the server how much it has actually received
+                try {
+                    this.session = await this.request("GET", this.session_url());
+                } catch (e) {
+                    if (e.status >= 400 && e.status < 500)
+                        throw e;
+                }
+            }
+            this.on_progress(this.session.offset);
+        }
+    }
+
+    async upload() {
+        await this.open_session();
+        this.on_progress(this.session.offset);
+        await this.send_chunks();
+        const res = await this.request("POST", this.session_url());
+        window.localStorage.removeItem(this.storage_key);
+        return res;
+    }
+}
+
+/**
+ * Make a Dropzone instance upload files using ResumableUpload
+ */
+function use_resumable_upload(dropzone)
+{
+    dropzone.uploadFiles = files => {
+        for (let file of files)
+        {
+            const upload = new ResumableUpload(file, {
+                chunk_size: dropzone.options.chunkSize,
+                on_progress: offset => {
+                    const progress = file.size ? 100 * offset / file.size : 100;
+                    file.upload.progress = progress;
+                    file.upload.bytesSent = offset;
+                    dropzone.emit("uploadprogress", file, progress, offset);
+                },
+            });
+            upload.upload().then(
+                res => { dropzone._finished([file], JSON.stringify(res), null); },
+                err => { dropzone._errorProcessing([file], err.message, null); }
+            );
+        }
+    };
+}
+
+window.himblick.ResumableUpload = ResumableUpload;
+window.himblick.use_resumable_upload = use_resumable_upload;
+
 function main()
 {
     window.himblick.socket = new HimblickSocket();
@@ -58,25 +203,61 @@ function main()
         {
             console.debug("Reloading page");
             window.location.reload(true);
-        } if (evt.detail.event == "uploaded_media_changed") {
+        } else if (evt.detail.event == "uploaded_media_changed") {
             console.debug("Uploaded media changed");
             let ul = document.getElementById("uploaded_media");
             if (!ul)
                 return;
             while (ul.lastChild)
                 ul.lastChild.remove();
-            for (let fname of evt.detail.files)
+            for (let entry of evt.detail.files)
             {
                 let li = document.createElement("li");
                 li.setAttribute("class", "list-group-item");
-                li.textContent = fname;
+                if (entry.thumbnail)
+                {
+                    let img = document.createElement("img");
+                    img.setAttribute("src", entry.thumbnail);
+                    img.setAttribute("loading", "lazy");
+                    img.setAttribute("class", "img-thumbnail mr-2");
+                    img.setAttribute("style", "max-width: 80px; max-height: 80px");
+                    li.append(img);
+                }
+                li.append(entry.name + " ");
+                let size = document.createElement("span");
+                size.setAttribute("class", "badge badge-secondary");
+                size.textContent = format_size(entry.size);
+                li.append(size);
                 ul.append(li);
             }
+        } else if (evt.detail.event == "log") {
+            let ul = document.getElementById("log");
+            if (!ul)
+                return;
+            for (let record of evt.detail.records)
+            {
+                let li = document.createElement("li");
+                li.textContent = record.text;
+                ul.prepend(li);
+            }
+            while (ul.children.length > 100)
+                ul.lastChild.remove();
         } else {
             console.log("Unknown event received", evt.detail);
         }
     });
 
+    // Stream log updates on pages that show the log
+    const log_level = document.getElementById("log_level");
+    if (log_level)
+    {
+        const subscribe = () => {
+            window.himblick.socket.send({command: "subscribe_logs", level: log_level.value});
+        };
+        document.addEventListener("himblick.open", subscribe);
+        log_level.addEventListener("change", subscribe);
+    }
+
     document.addEventListener("click", evt => {
         const ds = evt.target.dataset;
         if (!ds)
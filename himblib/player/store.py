@@ -0,0 +1,271 @@
+from __future__ import annotations
+from typing import Dict, Iterable, List, Optional, Set
+import json
+import os
+import time
+import logging
+from ..utils import atomic_writer
+
+log = logging.getLogger(__name__)
+
+
+class StoredFile:
+    """
+    A media file in a generation, pointing to its contents in the blob store
+    """
+    def __init__(self, name: str, sha256: str, size: int, mtime: float, type: Optional[str]):
+        self.name = name
+        self.sha256 = sha256
+        self.size = size
+        self.mtime = mtime
+        # Media type, as returned by media_type()
+        self.type = type
+
+    @property
+    def blob(self) -> str:
+        """
+        Name of the blob with the file contents.
+
+        The extension is kept, since some players look at it to decide how to
+        open a file
+        """
+        base, ext = os.path.splitext(self.name)
+        return self.sha256 + ext.lower()
+
+    def to_json(self):
+        return {"sha256": self.sha256, "size": self.size, "mtime": self.mtime, "type": self.type}
+
+    @classmethod
+    def from_json(cls, name: str, data):
+        return cls(name, data["sha256"], data["size"], data["mtime"], data["type"])
+
+
+class Generation:
+    """
+    A named set of media files that can be activated as a whole
+    """
+    def __init__(self, name: str, created: float, files: Iterable[StoredFile], synced: Iterable[str] = ()):
+        self.name = name
+        self.created = created
+        self.files: Dict[str, StoredFile] = {f.name: f for f in files}
+        # Hosts to which this generation has been replicated
+        self.synced: Set[str] = set(synced)
+
+    def __str__(self):
+        return self.name
+
+    def blobs(self) -> Set[str]:
+        return {f.blob for f in self.files.values()}
+
+    def to_json(self):
+        return {
+            "created": self.created,
+            "files": {name: f.to_json() for name, f in self.files.items()},
+            "synced": sorted(self.synced),
+        }
+
+    @classmethod
+    def from_json(cls, name: str, data):
+        return cls(
+                name, data["created"],
+                (StoredFile.from_json(fname, f) for fname, f in data["files"].items()),
+                data.get("synced", ()))
+
+
+class MediaStore:
+    """
+    Content-addressed store of media files.
+
+    File contents are stored once as blobs named after their sha256 hash.
+    Generations are JSON manifests mapping file names to blobs, and a pointer
+    file names the active generation. The media partition is exFAT, which has
+    no links, so activating a generation is done by atomically replacing the
+    pointer file: activation and rollback cost the same regardless of the
+    number of files.
+    """
+    def __init__(self, root: str):
+        self.root = os.path.abspath(root)
+        self.blobs_dir = os.path.join(self.root, "blobs")
+        self.generations_dir = os.path.join(self.root, "generations")
+        self.active_file = os.path.join(self.root, "active")
+        self.generations: Optional[Dict[str, Generation]] = None
+        self.active_name: Optional[str] = None
+
+    def __str__(self):
+        return self.root
+
+    def load(self):
+        """
+        Read the store state from disk
+        """
+        generations = {}
+        if os.path.isdir(self.generations_dir):
+            for de in os.scandir(self.generations_dir):
+                if not de.name.endswith(".json"):
+                    continue
+                name = de.name[:-5]
+                try:
+                    with open(de.path, "rt") as fd:
+                        generations[name] = Generation.from_json(name, json.load(fd))
+                except (OSError, ValueError, KeyError) as e:
+                    log.warning("%s: ignoring unreadable generation: %s", de.path, e)
+        self.generations = generations
+
+        try:
+            with open(self.active_file, "rt") as fd:
+                self.active_name = fd.read().strip() or None
+        except FileNotFoundError:
+            self.active_name = None
+
+    def list(self) -> List[Generation]:
+        """
+        Return all generations, oldest first
+        """
+        if self.generations is None:
+            self.load()
+        return sorted(self.generations.values(), key=lambda g: g.created)
+
+    def get(self, name: str) -> Optional[Generation]:
+        if self.generations is None:
+            self.load()
+        return self.generations.get(name)
+
+    @property
+    def active(self) -> Optional[Generation]:
+        if self.generations is None:
+            self.load()
+        if self.active_name is None:
+            return None
+        return self.generations.get(self.active_name)
+
+    @property
+    def previous(self) -> Optional[Generation]:
+        """
+        Return the generation created before the active one
+        """
+        active = self.active
+        if active is None:
+            return None
+        res = None
+        for gen in self.list():
+            if gen.created >= active.created:
+                break
+            res = gen
+        return res
+
+    def blob_path(self, file: StoredFile) -> str:
+        return os.path.join(self.blobs_dir, file.blob)
+
+    def save(self, generation: Generation):
+        """
+        Write the manifest of a generation
+        """
+        pathname = os.path.join(self.generations_dir, generation.name + ".json")
+        with atomic_writer(pathname, "wt") as fd:
+            json.dump(generation.to_json(), fd)
+
+    def new_name(self) -> str:
+        if self.generations is None:
+            self.load()
+        base = time.strftime("%Y%m%d-%H%M%S")
+        name = base
+        idx = 1
+        while name in self.generations:
+            idx += 1
+            name = f"{base}-{idx}"
+        return name
+
+    def add(self, root: str, files: List[StoredFile]) -> Generation:
+        """
+        Create a new generation with files moved from the root directory.
+
+        The manifest is written before moving the files, so that blobs in the
+        store are always referenced by some generation. The new generation is
+        not activated.
+        """
+        generation = Generation(self.new_name(), time.time(), files)
+        os.makedirs(self.blobs_dir, exist_ok=True)
+        self.save(generation)
+        self.generations[generation.name] = generation
+
+        for file in files:
+            src = os.path.join(root, file.name)
+            dest = self.blob_path(file)
+            if os.path.exists(dest):
+                # Same contents are already stored
+                os.unlink(src)
+            else:
+                os.rename(src, dest)
+        log.info("%s: created generation %s with %d files", self, generation, len(files))
+        return generation
+
+    def activate(self, name: str):
+        """
+        Make the named generation the active one
+        """
+        if self.get(name) is None:
+            raise KeyError(f"generation {name} not found")
+        with atomic_writer(self.active_file, "wt") as fd:
+            fd.write(name + "\n")
+        self.active_name = name
+        log.info("%s: activated generation %s", self, name)
+
+    def rollback(self) -> Optional[Generation]:
+        """
+        Activate the generation before the active one, returning it, or None if
+        there is none
+        """
+        previous = self.previous
+        if previous is None:
+            return None
+        self.activate(previous.name)
+        return previous
+
+    def mark_synced(self, generation: Generation, hostname: str):
+        generation.synced.add(hostname)
+        self.save(generation)
+
+    def gc(self, quota: int, keep: Iterable[str] = ()):
+        """
+        Remove the oldest generations until the blobs that only they use fit
+        in quota bytes, then delete blobs that are not used anymore.
+
+        The active generation, and those named in keep, are never removed,
+        and their blobs are not counted against the quota.
+        """
+        keep = set(keep)
+        if self.active_name is not None:
+            keep.add(self.active_name)
+        generations = self.list()
+        kept_blobs = set()
+        for gen in generations:
+            if gen.name in keep:
+                kept_blobs.update(gen.blobs())
+
+        def used_size():
+            sizes = {}
+            for gen in generations:
+                for f in gen.files.values():
+                    if f.blob not in kept_blobs:
+                        sizes[f.blob] = f.size
+            return sum(sizes.values())
+
+        for gen in list(generations):
+            if used_size() <= quota:
+                break
+            if gen.name in keep:
+                continue
+            log.info("%s: removing generation %s", self, gen)
+            os.unlink(os.path.join(self.generations_dir, gen.name + ".json"))
+            del self.generations[gen.name]
+            generations.remove(gen)
+
+        used = set()
+        for gen in generations:
+            used.update(gen.blobs())
+        if not os.path.isdir(self.blobs_dir):
+            return
+        for de in os.scandir(self.blobs_dir):
+            if de.name not in used:
+                log.info("%s: removing unused blob %s", self, de.name)
+                os.unlink(de.path)
@@ -4,59 +4,58 @@ import os
 import asyncio
 import asyncssh
 import logging
+from . import metrics
 
 if TYPE_CHECKING:
-    from .mediadir import MediaDir
+    from .mediadir import StoreDir
+    from .store import Generation
 
 log = logging.getLogger(__name__)
 
 
 class Syncer:
-    def __init__(self, hostname: str, media_dir: MediaDir):
+    def __init__(self, hostname: str, media_dir: StoreDir):
         self.hostname = hostname
         self.media_dir = media_dir
         self.media_key = asyncssh.read_private_key(os.path.expanduser("~/.ssh/id_media"))
         self.sync_task: Optional[asyncio.Task] = None
 
     def rescan(self):
-        log.info("syncer:%s: rescanning %s", self.hostname, self.media_dir.path)
-        to_sync = []
-        for fn in os.listdir(self.media_dir.path):
-            if fn.endswith(".synced"):
-                if fn == f"{self.hostname}.synced":
-                    log.info("syncer:%s: already synced", self.hostname)
-                    return
-                else:
-                    pass  # Ignore .synced files for other hosts
-            else:
-                log.info("syncer:%s: %s to be synced", self.hostname, fn)
-                to_sync.append(fn)
-
-        if to_sync:
-            if self.sync_task is not None:
-                self.sync_task.cancel()
-                self.sync_task = None
-
-            self.sync_task = asyncio.create_task(self.sync(to_sync))
-
-    async def sync(self, fnames):
+        generation = self.media_dir.generation
+        if generation is None:
+            return
+        log.info("syncer:%s: rescanning generation %s", self.hostname, generation)
+        if self.hostname in generation.synced:
+            log.info("syncer:%s: already synced", self.hostname)
+            return
+
+        if self.sync_task is not None:
+            self.sync_task.cancel()
+            self.sync_task = None
+
+        self.sync_task = asyncio.create_task(self.sync(generation))
+
+    async def sync(self, generation: Generation):
+        store = self.media_dir.store
         while True:
             try:
-                async with asyncssh.connect(
-                        self.hostname, username="media", client_keys=[self.media_key], known_hosts=None) as conn:
-                    async with conn.start_sftp_client() as sftp:
-                        sources = []
-                        for fname in fnames:
-                            sources.append(os.path.join(self.media_dir.path, fname))
-                        await sftp.put(sources, "media/")
-                        await sftp.remove("media/remove-when-done")
+                with metrics.SYNC_SECONDS.time(host=self.hostname):
+                    async with asyncssh.connect(
+                            self.hostname, username="media", client_keys=[self.media_key], known_hosts=None) as conn:
+                        async with conn.start_sftp_client() as sftp:
+                            # Blobs are named after their contents, so they
+                            # are copied one by one with their media names
+                            for file in generation.files.values():
+                                log.info("syncer:%s: syncing %s", self.hostname, file.name)
+                                await sftp.put(store.blob_path(file), f"media/{file.name}")
+                            await sftp.remove("media/remove-when-done")
             except Exception:
                 log.exception("%s: failed to sync, retrying", self.hostname)
+                metrics.SYNC_FAILURES.inc(host=self.hostname)
                 await asyncio.sleep(1)
             else:
+                metrics.SYNC_BYTES.inc(sum(f.size for f in generation.files.values()), host=self.hostname)
                 break
 
-        # Create the .synced file
-        with open(os.path.join(self.media_dir.path, f"{self.hostname}.synced"), "wt"):
-            pass
+        store.mark_synced(generation, self.hostname)
         self.sync_task = None
@@ -0,0 +1,159 @@
+from __future__ import annotations
+from typing import TYPE_CHECKING, Dict, Optional, Callable
+from collections import OrderedDict
+import asyncio
+import hashlib
+import os
+import subprocess
+import logging
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ModuleNotFoundError:
+    PIL = None
+
+if TYPE_CHECKING:
+    from .workers import WorkerPool
+
+log = logging.getLogger(__name__)
+
+
+def make_thumbnail(src: str, dest: str, type: str, size: int) -> bool:
+    """
+    Generate a JPEG thumbnail of src into dest, fitting into a square of the
+    given size.
+
+    This is run in a worker process. Return False if the thumbnail could not
+    be generated.
+    """
+    tmp = dest + ".tmp"
+    if type == "image":
+        if PIL is None:
+            log.warning("install python3-pil to generate thumbnails of images")
+            return False
+        try:
+            with PIL.Image.open(src) as img:
+                # Let the JPEG decoder skip detail that we would throw away
+                img.draft("RGB", (size, size))
+                img = PIL.ImageOps.exif_transpose(img)
+                img.thumbnail((size, size))
+                img.convert("RGB").save(tmp, "JPEG", quality=80)
+        except Exception as e:
+            log.warning("%s: cannot generate thumbnail: %s", src, e)
+            return False
+    elif type == "pdf":
+        # pdftoppm adds the extension to the output file name
+        res = subprocess.run(
+                ["pdftoppm", "-jpeg", "-f", "1", "-l", "1", "-singlefile", "-scale-to", str(size), src, tmp],
+                stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if res.returncode != 0:
+            log.warning("%s: cannot generate thumbnail: %s", src, res.stderr.strip())
+            return False
+        os.rename(tmp + ".jpg", tmp)
+    else:
+        return False
+    os.rename(tmp, dest)
+    return True
+
+
+class ThumbnailCache:
+    """
+    On-disk cache of thumbnails of media files, generated in worker processes
+    and evicted in least recently used order when over a size budget
+    """
+    # Media types we can make thumbnails of
+    TYPES = ("image", "pdf")
+
+    def __init__(self, root: str, workers: WorkerPool, get_budget: Callable[[], int], size: int = 160):
+        """
+        :arg root: directory where thumbnails are stored
+        :arg workers: worker pool used to generate thumbnails
+        :arg get_budget: function returning the maximum size in bytes of the
+                         cache
+        :arg size: size in pixels of the thumbnails
+        """
+        self.root = root
+        self.workers = workers
+        self.get_budget = get_budget
+        self.size = size
+        # Size of cached thumbnails by key, in least recently used order
+        self.entries: Dict[str, int] = OrderedDict()
+        self.total_size = 0
+        # Thumbnails currently being generated
+        self.pending: Dict[str, asyncio.Future] = {}
+        self.load()
+
+    def load(self):
+        """
+        Index the existing cache contents
+        """
+        if not os.path.isdir(self.root):
+            return
+        entries = []
+        for de in os.scandir(self.root):
+            if de.name.endswith(".tmp") or de.name.endswith(".tmp.jpg"):
+                os.unlink(de.path)
+                continue
+            st = de.stat()
+            entries.append((st.st_mtime, de.name, st.st_size))
+        entries.sort()
+        for mtime, name, size in entries:
+            self.entries[name] = size
+            self.total_size += size
+
+    def get_key(self, pathname: str, st: os.stat_result) -> str:
+        key = f"{pathname}\0{st.st_size}\0{st.st_mtime}\0{self.size}"
+        return hashlib.sha1(key.encode()).hexdigest()
+
+    def pathname(self, key: str) -> str:
+        return os.path.join(self.root, key)
+
+    async def get(self, pathname: str, type: str, st: os.stat_result) -> Optional[str]:
+        """
+        Return the pathname of the thumbnail for a media file, generating it if
+        needed, or None if a thumbnail cannot be generated.
+        """
+        if type not in self.TYPES:
+            return None
+        key = self.get_key(pathname, st)
+        if key in self.entries:
+            self.entries.move_to_end(key)
+            return self.pathname(key)
+
+        # If someone else is already generating this thumbnail, wait for it
+        pending = self.pending.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = self.pending[key] = asyncio.get_event_loop().create_future()
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            dest = self.pathname(key)
+            if await self.workers.run(make_thumbnail, pathname, dest, type, self.size):
+                size = os.path.getsize(dest)
+                self.entries[key] = size
+                self.total_size += size
+                self.evict()
+                result = dest
+            else:
+                result = None
+            future.set_result(result)
+            return result
+        except Exception:
+            future.set_result(None)
+            raise
+        finally:
+            del self.pending[key]
+
+    def evict(self):
+        """
+        Remove least recently used thumbnails until the cache fits its budget
+        """
+        budget = self.get_budget()
+        while self.total_size > budget and len(self.entries) > 1:
+            key, size = self.entries.popitem(last=False)
+            self.total_size -= size
+            try:
+                os.unlink(self.pathname(key))
+            except FileNotFoundError:
+                pass
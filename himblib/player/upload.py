@@ -0,0 +1,428 @@
+from __future__ import annotations
+from typing import Callable, Union, List, Optional, Tuple
+import email.message
+import hashlib
+import json
+import os
+import re
+import secrets
+import tempfile
+import time
+import logging
+from tornado.httputil import HTTPHeaders
+from ..utils import atomic_writer
+from .hashes import file_sha256
+
+log = logging.getLogger(__name__)
+
+
+def get_boundary(content_type: str) -> bytes:
+    """
+    Extract the multipart boundary from a Content-Type header value
+    """
+    msg = email.message.Message()
+    msg["content-type"] = content_type
+    if msg.get_content_type() != "multipart/form-data":
+        raise ValueError(f"unsupported content type {content_type!r}")
+    boundary = msg.get_param("boundary")
+    if not boundary:
+        raise ValueError("multipart boundary missing from content type")
+    return boundary.encode()
+
+
+def get_disposition(headers: HTTPHeaders):
+    """
+    Return the field name and file name from the Content-Disposition header of
+    a multipart part. File name is None for fields that are not files.
+    """
+    msg = email.message.Message()
+    msg["content-disposition"] = headers.get("Content-Disposition", "")
+    if msg.get_content_disposition() != "form-data":
+        raise ValueError("multipart part is not form-data")
+    name = msg.get_param("name", header="content-disposition")
+    if name is None:
+        raise ValueError("multipart part has no name")
+    return name, msg.get_filename()
+
+
+class UploadedFile:
+    """
+    Receive an uploaded file into a temporary file in the destination
+    directory, hashing it as it arrives, and atomically rename it into place
+    when complete
+    """
+    def __init__(self, dest_dir: str, name: str):
+        self.dest_dir = dest_dir
+        self.name = name
+        self.size = 0
+        self.hash = hashlib.sha256()
+        # Hidden file name, so that partial uploads do not show up as media
+        fd, self.tmp_pathname = tempfile.mkstemp(dir=self.dest_dir, prefix=".upload-", suffix=".tmp")
+        self.fd = open(fd, "wb")
+
+    @property
+    def pathname(self):
+        return os.path.join(self.dest_dir, self.name)
+
+    def write(self, data: bytes):
+        self.fd.write(data)
+        self.hash.update(data)
+        self.size += len(data)
+
+    def close(self):
+        """
+        Complete the upload, moving the file into its final place
+        """
+        self.fd.close()
+        os.rename(self.tmp_pathname, self.pathname)
+        log.info("%s: upload complete, %d bytes, sha256 %s", self.pathname, self.size, self.hash.hexdigest())
+
+    def abort(self):
+        """
+        Discard a partial upload
+        """
+        if self.fd.closed:
+            return
+        self.fd.close()
+        log.info("%s: upload aborted after %d bytes", self.pathname, self.size)
+        try:
+            os.unlink(self.tmp_pathname)
+        except FileNotFoundError:
+            pass
+
+
+class UploadedField:
+    """
+    Accumulate the value of a non-file form field
+    """
+    # Form fields are only used for small things like _xsrf: refuse to buffer
+    # anything bigger than this
+    MAX_SIZE = 4096
+
+    def __init__(self, name: str):
+        self.name = name
+        self.chunks = []
+        self.size = 0
+
+    @property
+    def value(self) -> bytes:
+        return b"".join(self.chunks)
+
+    def write(self, data: bytes):
+        self.size += len(data)
+        if self.size > self.MAX_SIZE:
+            raise ValueError(f"form field {self.name!r} is too long")
+        self.chunks.append(data)
+
+    def close(self):
+        pass
+
+    def abort(self):
+        pass
+
+
+class MultipartParser:
+    """
+    Incremental parser for multipart/form-data bodies.
+
+    Data is fed in arbitrary chunks, and part contents are passed on to the
+    objects returned by ``make_part`` as soon as they can be told apart from
+    the part boundary, so that memory use does not depend on the size of the
+    parts.
+    """
+    # Maximum size of the headers of a part
+    MAX_HEADER_SIZE = 16384
+
+    def __init__(self, boundary: bytes, make_part: Callable[[HTTPHeaders], Union[UploadedFile, UploadedField]]):
+        """
+        :arg boundary: multipart boundary from the Content-Type header
+        :arg make_part: function called with the headers of each new part,
+                        returning an object with write(), close() and abort()
+                        methods that receives the part contents
+        """
+        self.make_part = make_part
+        # Prepending a newline to the data allows to look for the same
+        # delimiter also for the first boundary
+        self.buffer = bytearray(b"\r\n")
+        self.delimiter = b"\r\n--" + boundary
+        self.state = "preamble"
+        self.part = None
+        self.parts: List[Union[UploadedFile, UploadedField]] = []
+
+    def feed(self, data: bytes):
+        """
+        Parse a new chunk of data
+        """
+        self.buffer.extend(data)
+        while True:
+            if self.state in ("preamble", "delimiter"):
+                if not self._parse_delimiter():
+                    break
+            elif self.state == "headers":
+                if not self._parse_headers():
+                    break
+            elif self.state == "body":
+                if not self._parse_body():
+                    break
+            else:
+                # Ignore the epilogue
+                self.buffer.clear()
+                break
+
+    def finish(self):
+        """
+        Signal the end of input, raising ValueError if the body was truncated
+        """
+        if self.state != "epilogue":
+            raise ValueError("multipart body is truncated")
+
+    def abort(self):
+        """
+        Abort all parts that have not been completed
+        """
+        if self.part is not None:
+            self.part.abort()
+            self.part = None
+
+    def _parse_delimiter(self) -> bool:
+        """
+        Consume a delimiter line at the beginning of the buffer.
+
+        Return False if more data is needed
+        """
+        # Delimiter, followed by either -- or \r\n
+        if len(self.buffer) < len(self.delimiter) + 2:
+            return False
+        if not self.buffer.startswith(self.delimiter):
+            if self.state == "preamble":
+                # Skip preamble data until we find a delimiter
+                pos = self.buffer.find(self.delimiter)
+                if pos == -1:
+                    del self.buffer[:-len(self.delimiter)]
+                    return False
+                del self.buffer[:pos]
+                return True
+            raise ValueError("multipart delimiter not found")
+        tail = bytes(self.buffer[len(self.delimiter):len(self.delimiter) + 2])
+        del self.buffer[:len(self.delimiter) + 2]
+        if tail == b"--":
+            self.state = "epilogue"
+        elif tail == b"\r\n":
+            self.state = "headers"
+        else:
+            raise ValueError("invalid multipart delimiter line")
+        return True
+
+    def _parse_headers(self) -> bool:
+        pos = self.buffer.find(b"\r\n\r\n")
+        if pos == -1:
+            if len(self.buffer) > self.MAX_HEADER_SIZE:
+                raise ValueError("multipart part headers are too long")
+            return False
+        headers = HTTPHeaders.parse(self.buffer[:pos].decode("utf-8"))
+        del self.buffer[:pos + 4]
+        self.part = self.make_part(headers)
+        self.parts.append(self.part)
+        self.state = "body"
+        return True
+
+    def _parse_body(self) -> bool:
+        pos = self.buffer.find(self.delimiter)
+        if pos == -1:
+            # Pass on all data that cannot be the beginning of a delimiter
+            safe = len(self.buffer) - len(self.delimiter) + 1
+            if safe > 0:
+                self.part.write(bytes(self.buffer[:safe]))
+                del self.buffer[:safe]
+            return False
+        if pos > 0:
+            self.part.write(bytes(self.buffer[:pos]))
+            del self.buffer[:pos]
+        self.part.close()
+        self.part = None
+        self.state = "delimiter"
+        return True
+
+
+def make_upload_part(dest_dir: str) -> Callable[[HTTPHeaders], Union[UploadedFile, UploadedField]]:
+    """
+    Return a make_part function for MultipartParser that stores uploaded files
+    in dest_dir
+    """
+    def make_part(headers: HTTPHeaders):
+        name, filename = get_disposition(headers)
+        if filename is None:
+            return UploadedField(name)
+        filename = os.path.basename(filename)
+        if not filename or filename.startswith("."):
+            raise ValueError(f"invalid upload file name {filename!r}")
+        return UploadedFile(dest_dir, filename)
+    return make_part
+
+
+class ResumableUpload:
+    """
+    Upload session whose data can be sent in byte ranges, over multiple
+    requests.
+
+    Data is stored in a sparse file preallocated to the full upload size, and
+    the list of ranges received so far is kept in a JSON file alongside it, so
+    that interrupted uploads can be resumed also after a restart.
+    """
+    re_id = re.compile(r"^[0-9a-f]{32}$")
+
+    def __init__(self, root: str, id: str, name: str, size: int, ranges: List[Tuple[int, int]]):
+        self.root = root
+        self.id = id
+        self.name = name
+        self.size = size
+        # Sorted, non-overlapping list of [start, end) byte ranges received
+        self.ranges = ranges
+
+    @property
+    def data_pathname(self):
+        return os.path.join(self.root, self.id + ".part")
+
+    @property
+    def meta_pathname(self):
+        return os.path.join(self.root, self.id + ".json")
+
+    @property
+    def offset(self) -> int:
+        """
+        Offset up to which all data has been received
+        """
+        if not self.ranges or self.ranges[0][0] != 0:
+            return 0
+        return self.ranges[0][1]
+
+    @property
+    def complete(self) -> bool:
+        return self.offset == self.size
+
+    def to_json(self):
+        return {"id": self.id, "name": self.name, "size": self.size, "offset": self.offset}
+
+    @classmethod
+    def create(cls, root: str, name: str, size: int) -> "ResumableUpload":
+        res = cls(root, secrets.token_hex(16), name, size, [])
+        with open(res.data_pathname, "wb") as fd:
+            fd.truncate(size)
+        res.save()
+        return res
+
+    @classmethod
+    def load(cls, root: str, id: str) -> Optional["ResumableUpload"]:
+        if not cls.re_id.match(id):
+            return None
+        try:
+            with open(os.path.join(root, id + ".json"), "rt") as fd:
+                meta = json.load(fd)
+        except FileNotFoundError:
+            return None
+        return cls(root, id, meta["name"], meta["size"], [tuple(r) for r in meta["ranges"]])
+
+    def save(self):
+        with atomic_writer(self.meta_pathname, "wt", sync=False) as fd:
+            json.dump({"name": self.name, "size": self.size, "ranges": self.ranges, "mtime": time.time()}, fd)
+
+    def add_range(self, start: int, end: int):
+        """
+        Record that the data in [start, end) has been received
+        """
+        if start >= end:
+            return
+        merged = []
+        for rstart, rend in sorted(self.ranges + [(start, end)]):
+            if merged and rstart <= merged[-1][1]:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], rend))
+            else:
+                merged.append((rstart, rend))
+        self.ranges = merged
+
+    def record_range(self, start: int, end: int):
+        """
+        Record and save that the data in [start, end) has been received.
+
+        Other requests for the same session can have saved ranges since this
+        one was loaded, so they are read again and merged. There is no await
+        in between, so this cannot interleave with other requests.
+
+        Nothing is saved if the session has been finalized or cancelled
+        meanwhile.
+        """
+        try:
+            with open(self.meta_pathname, "rt") as fd:
+                meta = json.load(fd)
+        except FileNotFoundError:
+            return
+        for rstart, rend in meta["ranges"]:
+            self.add_range(rstart, rend)
+        self.add_range(start, end)
+        self.save()
+
+    def open(self, offset: int):
+        """
+        Open the data file for writing at the given offset
+        """
+        fd = open(self.data_pathname, "r+b")
+        fd.seek(offset)
+        return fd
+
+    def finalize(self, dest_dir: str) -> str:
+        """
+        Move the completed upload to dest_dir, returning the sha256 of its
+        contents.
+
+        This reads the whole file, and is meant to be run in a worker thread
+        """
+        sha256 = file_sha256(self.data_pathname)
+        os.rename(self.data_pathname, os.path.join(dest_dir, self.name))
+        os.unlink(self.meta_pathname)
+        log.info("%s: resumable upload complete, %d bytes, sha256 %s", self.name, self.size, sha256)
+        return sha256
+
+    def remove(self):
+        for pathname in (self.data_pathname, self.meta_pathname):
+            try:
+                os.unlink(pathname)
+            except FileNotFoundError:
+                pass
+
+
+class ResumableUploads:
+    """
+    Manage the resumable upload sessions stored in a directory
+    """
+    def __init__(self, root: str):
+        self.root = root
+
+    def create(self, name: str, size: int) -> ResumableUpload:
+        name = os.path.basename(name)
+        if not name or name.startswith("."):
+            raise ValueError(f"invalid upload file name {name!r}")
+        if size < 0:
+            raise ValueError(f"invalid upload size {size}")
+        os.makedirs(self.root, exist_ok=True)
+        res = ResumableUpload.create(self.root, name, size)
+        log.info("%s: created resumable upload %s for %d bytes", name, res.id, size)
+        return res
+
+    def get(self, id: str) -> Optional[ResumableUpload]:
+        return ResumableUpload.load(self.root, id)
+
+    def expire(self, max_age: float):
+        """
+        Remove upload sessions that have not been updated in max_age seconds
+        """
+        if not os.path.isdir(self.root):
+            return
+        threshold = time.time() - max_age
+        for de in os.scandir(self.root):
+            if de.stat().st_mtime >= threshold:
+                continue
+            log.info("%s: removing expired partial upload", de.path)
+            try:
+                os.unlink(de.path)
+            except FileNotFoundError:
+                pass
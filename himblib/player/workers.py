@@ -0,0 +1,72 @@
+from __future__ import annotations
+from typing import Optional
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import logging
+
+log = logging.getLogger(__name__)
+
+
+def lower_priority():
+    """
+    Make the current process run only when the CPU would otherwise be idle, so
+    that background jobs do not take CPU time away from playback
+    """
+    os.nice(19)
+    try:
+        os.sched_setscheduler(0, os.SCHED_IDLE, os.sched_param(0))
+    except (AttributeError, OSError):
+        pass
+
+
+class WorkerPool:
+    """
+    Pool of low priority worker processes for CPU intensive background jobs
+    """
+    def __init__(self, max_workers: int = 1):
+        self.max_workers = max_workers
+        self.executor: Optional[concurrent.futures.ProcessPoolExecutor] = None
+
+    def get_executor(self) -> concurrent.futures.ProcessPoolExecutor:
+        if self.executor is None:
+            # Do not fork the player process, which has threads and an event
+            # loop running
+            self.executor = concurrent.futures.ProcessPoolExecutor(
+                    max_workers=self.max_workers,
+                    mp_context=multiprocessing.get_context("forkserver"),
+                    initializer=lower_priority)
+        return self.executor
+
+    async def run(self, func, *args):
+        """
+        Run func(*args) in a worker process, returning its result
+        """
+        loop = asyncio.get_event_loop()
+        return await loop.run_in_executor(self.get_executor(), func, *args)
+
+    def shutdown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+
+    def kill(self):
+        """
+        Kill the worker processes, to stop jobs that are taking too long.
+
+        Jobs still running will fail with BrokenProcessPool, and a new pool is
+        started on the next run
+        """
+        if self.executor is None:
+            return
+        executor, self.executor = self.executor, None
+        # ProcessPoolExecutor has no public way of stopping running jobs
+        # before Python 3.14
+        kill_workers = getattr(executor, "kill_workers", None)
+        if kill_workers is not None:
+            kill_workers()
+        else:
+            for proc in list((executor._processes or {}).values()):
+                proc.kill()
+        executor.shutdown(wait=False)
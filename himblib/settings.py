@@ -103,6 +103,87 @@ class PlayerSettings:
 
                 # Transition time for PDF presentations
                 "pdf transition time": "5",
+
+                # When the media directory has files of different types, show
+                # them all one after the other instead of only the type with
+                # the most recent files. Items whose length is not known, like
+                # decks that have not been rendered, are shown for timeline
+                # item duration seconds
+                "mixed media": "yes",
+                "timeline item duration": "60",
+
+                # Content can be scheduled at different times of the day with
+                # [schedule name] sections containing:
+                #   days = mon-fri sat   (default: every day)
+                #   start = 07:00        (default: 00:00)
+                #   end = 10:30          (default: same as start, for all day)
+                #   media = breakfast    (subdirectory of the media directory)
+                #   generation = name    (or a generation of uploaded media)
+                # The first section whose time window includes the current time
+                # is shown. Its content is prepared this many seconds before
+                # the window begins
+                "schedule staging time": "600",
+
+                # Hours after which incomplete uploads are discarded
+                "upload expiry": "48",
+
+                # Maximum disk space used for thumbnails, in megabytes
+                "thumbnail cache size": "64",
+
+                # Maximum memory used to keep copies of the media being played
+                # in RAM, in megabytes. Media that does not fit is read ahead
+                # from the media partition instead. Use 0 to always play from
+                # the media partition
+                "ram staging size": "256",
+
+                # Maximum disk space used by old generations of media, in
+                # megabytes. The active generation is always kept
+                "media store size": "4096",
+
+                # Activate new media automatically once no files have been
+                # written to the media directory for this many seconds. Use 0
+                # to activate only when remove-when-done is deleted
+                "auto activate delay": "0",
+
+                # When switching presentations, keep the old player on screen
+                # until the new one shows a fullscreen window, waiting at most
+                # this many seconds. Use 0 to stop the old player first
+                "handover timeout": "10",
+
+                # Seconds given to a player to exit after being asked to stop,
+                # before it is killed
+                "player stop grace": "5",
+
+                # Players that exit by themselves are restarted after a delay
+                # that doubles at each exit within this many seconds, up to
+                # restart max delay seconds. After restart limit exits within
+                # the window, the previous media is played instead, or the
+                # logo. Use a limit of 0 to always retry the same media
+                "restart window": "300",
+                "restart limit": "5",
+                "restart max delay": "60",
+
+                # Restart a player that looks stuck for this many seconds:
+                # a video player using no CPU, another player keeping a CPU
+                # busy, or any player using more than player memory limit
+                # percent of the system memory. Use 0 to disable
+                "hang timeout": "120",
+                "player memory limit": "80",
+
+                # Maximum time in seconds for validating a media file before
+                # activating it
+                "preflight timeout": "60",
+
+                # Commands used to render slide decks as images, to show them
+                # without starting a full document viewer. {src} is the
+                # file to render, {workdir} the directory where images are
+                # written, {width}, {height} and {size} the screen size and
+                # its largest side. A command can also write a PDF, which is
+                # then rendered with the PDF command. Leave empty to always
+                # use the document viewer
+                "pdf render command": "pdftoppm -png -scale-to {size} {src} {workdir}/page",
+                "odp render command": "soffice -env:UserInstallation=file://{workdir}/profile"
+                                      " --headless --convert-to pdf --outdir {workdir} {src}",
             }
         })
         log.info("Reading configuration from %s", self.pathname)
@@ -120,3 +201,83 @@ class PlayerSettings:
     @property
     def pdf_transition_time(self):
         return int(self.cfg["player"].get("pdf transition time", "5"))
+
+    @property
+    def upload_expiry(self):
+        return int(self.cfg["player"].get("upload expiry", "48"))
+
+    @property
+    def thumbnail_cache_size(self):
+        return int(self.cfg["player"].get("thumbnail cache size", "64"))
+
+    @property
+    def media_store_size(self):
+        return int(self.cfg["player"].get("media store size", "4096"))
+
+    @property
+    def preflight_timeout(self):
+        return int(self.cfg["player"].get("preflight timeout", "60"))
+
+    @property
+    def pdf_render_command(self):
+        return self.cfg["player"].get("pdf render command", "")
+
+    @property
+    def odp_render_command(self):
+        return self.cfg["player"].get("odp render command", "")
+
+    @property
+    def auto_activate_delay(self):
+        return int(self.cfg["player"].get("auto activate delay", "0"))
+
+    @property
+    def handover_timeout(self):
+        return int(self.cfg["player"].get("handover timeout", "10"))
+
+    @property
+    def player_stop_grace(self):
+        return float(self.cfg["player"].get("player stop grace", "5"))
+
+    @property
+    def restart_window(self):
+        return int(self.cfg["player"].get("restart window", "300"))
+
+    @property
+    def restart_limit(self):
+        return int(self.cfg["player"].get("restart limit", "5"))
+
+    @property
+    def restart_max_delay(self):
+        return int(self.cfg["player"].get("restart max delay", "60"))
+
+    @property
+    def hang_timeout(self):
+        return int(self.cfg["player"].get("hang timeout", "120"))
+
+    @property
+    def player_memory_limit(self):
+        return int(self.cfg["player"].get("player memory limit", "80"))
+
+    @property
+    def mixed_media(self):
+        return self.cfg["player"].getboolean("mixed media", True)
+
+    @property
+    def timeline_item_duration(self):
+        return int(self.cfg["player"].get("timeline item duration", "60"))
+
+    @property
+    def schedule_staging_time(self):
+        return int(self.cfg["player"].get("schedule staging time", "600"))
+
+    @property
+    def schedule(self):
+        """
+        Return (name, section) for the [schedule name] sections, in the order
+        they appear in the configuration
+        """
+        return [(name[9:].strip(), self.cfg[name]) for name in self.cfg.sections() if name.startswith("schedule ")]
+
+    @property
+    def ram_staging_size(self):
+        return int(self.cfg["player"].get("ram staging size", "256"))
@@ -35,7 +35,10 @@ class atomic_writer(object):
         dirname = os.path.dirname(self.fname)
         if not os.path.isdir(dirname):
             os.makedirs(dirname)
-        self.fd, self.abspath = tempfile.mkstemp(dir=dirname, text="b" not in mode)
+        # Use a hidden name, so that directory watchers can ignore the
+        # temporary file
+        self.fd, self.abspath = tempfile.mkstemp(
+                dir=dirname, prefix="." + os.path.basename(self.fname) + ".", text="b" not in mode)
         self.outfd = open(self.fd, mode, closefd=True, **kw)
 
     def __enter__(self):
@@ -67,7 +70,7 @@ class NullProgressBar:
 
 def make_progressbar(maxval=None):
     if progressbar is None:
-        log.warn("install python3-progressbar for a fancier progressbar")
+        log.warning("install python3-progressbar for a fancier progressbar")
         return NullProgressBar()
 
     if not os.isatty(sys.stdout.fileno()):
@@ -90,7 +93,7 @@ def make_progressbar(maxval=None):
 def progress(lst):
     if os.isatty(sys.stdout.fileno()):
         if progressbar is None:
-            log.warn("install python3-progressbar for a fancier progressbar")
+            log.warning("install python3-progressbar for a fancier progressbar")
 
         total = len(lst)
         if progressbar:
@@ -110,3 +113,19 @@ def progress(lst):
             print(f"{total}/{total}")
     else:
         yield from lst
+
+
+def readahead(pathnames: List[str]):
+    """
+    Ask the kernel to start reading files into the page cache
+    """
+    for pathname in pathnames:
+        try:
+            fd = os.open(pathname, os.O_RDONLY)
+        except OSError as e:
+            log.warning("%s: cannot read ahead: %s", pathname, e)
+            continue
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        finally:
+            os.close(fd)
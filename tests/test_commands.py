@@ -0,0 +1,68 @@
+import asyncio
+import time
+import unittest
+from himblib.player.commands import CommandBus
+
+
+class TestCommandBus(unittest.TestCase):
+    def run_async(self, coro):
+        return asyncio.run(asyncio.wait_for(coro, 5))
+
+    def test_coalesce_restarts(self):
+        bus = CommandBus()
+        bus.put("rescan", "test")
+        bus.put("player_exited", "test")
+        bus.put("rescan", "test")
+        self.assertEqual(list(bus.pending), ["restart"])
+        cmd = self.run_async(bus.get())
+        self.assertEqual(cmd.name, "rescan")
+        self.assertEqual(bus.pending, {})
+
+    def test_quit_first(self):
+        bus = CommandBus()
+        bus.put("rescan", "test")
+        bus.put("quit", "test")
+        self.assertTrue(bus.quit_requested.is_set())
+        self.assertEqual(self.run_async(bus.get()).name, "quit")
+        self.assertEqual(self.run_async(bus.get()).name, "rescan")
+
+    def test_backoff_kept(self):
+        bus = CommandBus()
+        bus.put("player_exited", "test", delay=60)
+        not_before = bus.pending["restart"].not_before
+        # A rescan from the schedule or a file event does not cut the backoff
+        bus.put("rescan", "test")
+        self.assertEqual(bus.pending["restart"].not_before, not_before)
+
+    def test_backoff_extended(self):
+        bus = CommandBus()
+        bus.put("rescan", "test")
+        bus.put("player_exited", "test", delay=60)
+        self.assertGreater(bus.pending["restart"].not_before, time.monotonic() + 50)
+
+    def test_user_skips_backoff(self):
+        bus = CommandBus()
+        bus.put("player_exited", "test", delay=60)
+        bus.put("rescan", "test", user=True)
+        self.assertLessEqual(bus.pending["restart"].not_before, time.monotonic())
+        self.assertEqual(self.run_async(bus.get()).name, "player_exited")
+
+    def test_delay(self):
+        async def main():
+            bus = CommandBus()
+            bus.put("rescan", "test", delay=0.05)
+            start = time.monotonic()
+            await bus.get()
+            return time.monotonic() - start
+        self.assertGreaterEqual(self.run_async(main()), 0.05)
+
+    def test_min_restart_interval(self):
+        async def main():
+            bus = CommandBus(min_restart_interval=0.05)
+            bus.put("rescan", "test")
+            await bus.get()
+            start = time.monotonic()
+            bus.put("rescan", "test")
+            await bus.get()
+            return time.monotonic() - start
+        self.assertGreaterEqual(self.run_async(main()), 0.04)
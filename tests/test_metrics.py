@@ -0,0 +1,48 @@
+import unittest
+from himblib.player.metrics import Histogram, Metric, format_labels
+
+
+class TestHistogram(unittest.TestCase):
+    def test_buckets(self):
+        hist = Histogram("test_seconds", "Test histogram", buckets=(1, 0.1, 10))
+        self.assertEqual(hist.buckets, (0.1, 1, 10, float("inf")))
+        for value in (0.05, 0.1, 0.5, 1, 20):
+            hist.observe(value)
+        self.assertEqual(hist.samples(), [
+            'test_seconds_bucket{le="0.1"} 2',
+            'test_seconds_bucket{le="1"} 4',
+            'test_seconds_bucket{le="10"} 4',
+            'test_seconds_bucket{le="+Inf"} 5',
+            "test_seconds_sum 21.65",
+            "test_seconds_count 5",
+        ])
+
+    def test_labels(self):
+        hist = Histogram("test_labeled_seconds", "Test histogram", labels=("type",), buckets=(1,))
+        hist.observe(2, type="video")
+        hist.observe(0.5, type="image")
+        self.assertEqual(hist.samples(), [
+            'test_labeled_seconds_bucket{type="image",le="1"} 1',
+            'test_labeled_seconds_bucket{type="image",le="+Inf"} 1',
+            'test_labeled_seconds_sum{type="image"} 0.5',
+            'test_labeled_seconds_count{type="image"} 1',
+            'test_labeled_seconds_bucket{type="video",le="1"} 0',
+            'test_labeled_seconds_bucket{type="video",le="+Inf"} 1',
+            'test_labeled_seconds_sum{type="video"} 2',
+            'test_labeled_seconds_count{type="video"} 1',
+        ])
+
+    def test_function(self):
+        hist = Histogram("test_function", "Test histogram")
+        hist.set_function(lambda: 3)
+        self.assertEqual(hist.expose().splitlines()[-1], "test_function 3")
+
+
+class TestMetric(unittest.TestCase):
+    def test_abstract(self):
+        with self.assertRaises(TypeError):
+            Metric("test_abstract", "Test metric")
+
+    def test_format_labels(self):
+        self.assertEqual(format_labels((), ()), "")
+        self.assertEqual(format_labels(("name",), ('a"b\\c\n',)), r'{name="a\"b\\c\n"}')
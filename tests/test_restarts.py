@@ -0,0 +1,57 @@
+import unittest
+from unittest import mock
+from himblib.player import restarts
+from himblib.player.restarts import RestartPolicy
+
+
+class Settings:
+    restart_window = 60
+    restart_limit = 4
+    restart_max_delay = 5
+
+
+class TestRestartPolicy(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000.0
+        patcher = mock.patch.object(restarts.time, "monotonic", lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.policy = RestartPolicy(Settings())
+
+    def test_backoff(self):
+        self.assertEqual(self.policy.record_exit("video"), 1)
+        self.assertEqual(self.policy.record_exit("video"), 2)
+        self.assertEqual(self.policy.record_exit("video"), 4)
+        self.assertFalse(self.policy.failing("video"))
+        # Other sources are tracked separately
+        self.assertEqual(self.policy.record_exit("image"), 1)
+
+    def test_max_delay(self):
+        settings = Settings()
+        settings.restart_limit = 0
+        policy = RestartPolicy(settings)
+        delays = [policy.record_exit("video") for i in range(5)]
+        self.assertEqual(delays, [1, 2, 4, 5, 5])
+        self.assertFalse(policy.failing("video"))
+
+    def test_failing(self):
+        for i in range(3):
+            self.policy.record_exit("video")
+        # No wait once the source is failing, since something else is played
+        self.assertEqual(self.policy.record_exit("video"), 0)
+        self.assertTrue(self.policy.failing("video"))
+        self.assertFalse(self.policy.failing("image"))
+
+    def test_window(self):
+        for i in range(4):
+            self.policy.record_exit("video")
+            self.now += 10
+        self.assertTrue(self.policy.failing("video"))
+        # Exits age out of the window
+        self.now += 31
+        self.assertEqual(self.policy.recent_exits("video"), 2)
+        self.assertFalse(self.policy.failing("video"))
+        self.now += 60
+        self.assertEqual(self.policy.recent_exits("video"), 0)
+        self.assertEqual(self.policy.exits, {})
+        self.assertEqual(self.policy.record_exit("video"), 1)
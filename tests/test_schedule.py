@@ -0,0 +1,105 @@
+import datetime
+import unittest
+from himblib.player.schedule import ScheduleRule, Scheduler, parse_days
+
+
+def at(day: int, hour: int, minute: int = 0) -> datetime.datetime:
+    # 2024-01-01 is a Monday
+    return datetime.datetime(2024, 1, day, hour, minute)
+
+
+class TestParseDays(unittest.TestCase):
+    def test_list(self):
+        self.assertEqual(parse_days("mon, wed sat"), {0, 2, 5})
+        self.assertEqual(parse_days("Monday Sunday"), {0, 6})
+
+    def test_range(self):
+        self.assertEqual(parse_days("mon-fri"), {0, 1, 2, 3, 4})
+
+    def test_wraparound_range(self):
+        self.assertEqual(parse_days("fri-mon"), {4, 5, 6, 0})
+        self.assertEqual(parse_days("sun-sun"), {6})
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            parse_days("mon-xyz")
+
+
+class TestScheduleRule(unittest.TestCase):
+    def make_rule(self, days: str, start: str, end: str) -> ScheduleRule:
+        return ScheduleRule(
+                "test", parse_days(days),
+                datetime.time.fromisoformat(start), datetime.time.fromisoformat(end), media="test")
+
+    def test_window(self):
+        rule = self.make_rule("mon", "09:00", "17:00")
+        self.assertEqual(next(rule.windows(at(1, 8))), (at(1, 9), at(1, 17)))
+        self.assertFalse(rule.is_active(at(1, 8, 59)))
+        self.assertTrue(rule.is_active(at(1, 9)))
+        self.assertFalse(rule.is_active(at(1, 17)))
+        self.assertFalse(rule.is_active(at(2, 10)))
+
+    def test_across_midnight(self):
+        rule = self.make_rule("mon", "22:00", "02:00")
+        self.assertEqual(next(rule.windows(at(1, 23))), (at(1, 22), at(2, 2)))
+        self.assertTrue(rule.is_active(at(1, 23)))
+        # The window started on Monday is still active on Tuesday morning
+        self.assertTrue(rule.is_active(at(2, 1)))
+        self.assertFalse(rule.is_active(at(2, 2)))
+        self.assertFalse(rule.is_active(at(2, 23)))
+        self.assertEqual(rule.next_end(at(2, 1)), at(2, 2))
+        self.assertEqual(rule.next_begin(at(2, 1)), at(8, 22))
+
+    def test_whole_day(self):
+        rule = self.make_rule("sat", "00:00", "00:00")
+        self.assertFalse(rule.is_active(at(5, 23, 59)))
+        self.assertTrue(rule.is_active(at(6, 0)))
+        self.assertTrue(rule.is_active(at(6, 23, 59)))
+        self.assertFalse(rule.is_active(at(7, 0)))
+        self.assertEqual(rule.next_end(at(6, 12)), at(7, 0))
+
+    def test_from_config(self):
+        rule = ScheduleRule.from_config("test", {"days": "sat-sun", "start": "10:00", "media": "weekend"})
+        self.assertEqual(rule.days, {5, 6})
+        self.assertEqual(rule.start, datetime.time(10))
+        self.assertEqual(rule.end, datetime.time(0))
+        self.assertEqual(rule.media, "weekend")
+
+        with self.assertRaises(ValueError):
+            ScheduleRule.from_config("test", {})
+        with self.assertRaises(ValueError):
+            ScheduleRule.from_config("test", {"media": "a", "generation": "b"})
+        with self.assertRaises(ValueError):
+            ScheduleRule.from_config("test", {"media": "../etc"})
+
+
+class TestScheduler(unittest.TestCase):
+    def make_scheduler(self, stage_ahead: int) -> Scheduler:
+        scheduler = Scheduler(on_switch=lambda rule: None, on_stage=lambda rule: None)
+        scheduler.stage_ahead = datetime.timedelta(seconds=stage_ahead)
+        return scheduler
+
+    def test_stage_ahead(self):
+        rule = ScheduleRule("test", parse_days("mon"), datetime.time(9), datetime.time(17), media="test")
+        scheduler = self.make_scheduler(600)
+        scheduler.push(rule, "stage", at(1, 8))
+        when, seq, kind, pushed, begin = scheduler.heap[0]
+        self.assertEqual(kind, "stage")
+        self.assertEqual(begin, at(1, 9))
+        self.assertEqual(when, at(1, 8, 50))
+
+    def test_stage_time_clamped(self):
+        rule = ScheduleRule("test", parse_days("mon"), datetime.time(9), datetime.time(17), media="test")
+        scheduler = self.make_scheduler(600)
+        # The staging time is past: stage right away
+        scheduler.push(rule, "stage", at(1, 8, 55))
+        when, seq, kind, pushed, begin = scheduler.heap[0]
+        self.assertEqual(begin, at(1, 9))
+        self.assertEqual(when, at(1, 8, 55))
+
+    def test_no_transitions(self):
+        rule = ScheduleRule("test", frozenset(), datetime.time(9), datetime.time(17), media="test")
+        scheduler = self.make_scheduler(0)
+        for kind in ("begin", "end", "stage"):
+            scheduler.push(rule, kind, at(1, 8))
+        self.assertEqual(scheduler.heap, [])